@@ -1,11 +1,14 @@
 from .handshake import standard_connect
 from .configuration import default_configuration
 from .processor import Processor
+from .dispatcher import PoisonTaskError
+from .future import as_completed, wait, FIRST_COMPLETED, FIRST_EXCEPTION, ALL_COMPLETED
+from .future import CancelledError, TimeoutError
 
-def JobProcessor( secret, address, port = 12456):
+def JobProcessor( secret, address, port = 12456, timeout = None):
     dispatcher, library = standard_connect( (address, port), secret )
     config = default_configuration()
     library.add(config)
-    processor = Processor(config.hash, dispatcher)
+    processor = Processor(config.hash, dispatcher, timeout = timeout)
     return processor
 
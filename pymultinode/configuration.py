@@ -12,8 +12,19 @@ import hashlib
 import contextlib
 import tempfile
 import sys
+import imp
+import marshal
+import pickle
+import collections
+import time
+import eventlet
 
 
+# where anything kept between runs goes
+CACHE_HOME = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+        'pymultinode')
+
 class Configuration(object):
     """
     The configuration object holds the contents of the code. In particular the
@@ -23,45 +34,173 @@ class Configuration(object):
     There is also a hash attribute which is the hash of the contents
 
     The attribute name refers to the name of the module that should be __main__
+
+    If the zip file was put together by assemble_zip, manifest is the list
+    of (filename, file hash) pairs it was built from, otherwise it is None
     """
-    def __init__(self, contents, name):
+    def __init__(self, contents, name, manifest = None):
         self.contents = contents
         self.name = name
+        self.manifest = manifest
 
         hasher = hashlib.sha256()
         hasher.update(self.contents)
         self.hash = hasher.digest()
 
-    @contextlib.contextmanager
     def apply(self):
         """
         Return a context manager which will make the contents accessible
 
-        When the context manager closes it will delete the file.
+        The modules are imported straight from the contents in memory, so
+        nothing is written to disk.
         However, it does nothing to unload the modules from memory.
         """
-        
-        # in order to be able to import from it, we need a .zip file
-        temporary_library = tempfile.NamedTemporaryFile(
-                suffix = '.zip', delete = False)
+        return applied( add_memory_zip(self.hash, self.contents), self.name )
+
+    def file_contents(self):
+        """
+        Return a dictionary from file hash to the contents of that file,
+        for each file in the manifest
+        """
+        zipped = zipfile.ZipFile( StringIO(self.contents) )
+        return dict( (hash, zipped.read(filename)) for filename, hash in self.manifest )
 
-        # dump our contents into that file
-        with temporary_library.file as library:
-            library.write(self.contents)
+class CachedConfiguration(object):
+    """
+    A configuration whose zip file is already on disk, as stored by a
+    ConfigurationCache. It only holds the path, so it is cheap to send to
+    the slaves.
+    """
+    def __init__(self, hash, name, path):
+        self.hash = hash
+        self.name = name
+        self.path = path
+
+    def apply(self):
+        """
+        Return a context manager which will make the contents accessible
+        The file is left alone since other slaves may be using it
+        """
+        return applied(self.path, self.name)
+
+# the zip files which can be imported from memory, by their sys.path entry
+MEMORY_ZIPS = {}
+
+def add_memory_zip(hash, contents):
+    """
+    Make the zip file in contents importable from memory
+    Returns the entry to put on sys.path to do so
+    """
+    root = '<pymultinode %s>' % hash.encode('hex')
+    if root not in MEMORY_ZIPS:
+        zipped = zipfile.ZipFile( StringIO(contents) )
+        MEMORY_ZIPS[root] = dict( (filename, zipped.read(filename)) for filename in zipped.namelist() )
+    if memory_path_hook not in sys.path_hooks:
+        sys.path_hooks.insert(0, memory_path_hook)
+    return root
+
+def memory_path_hook(path):
+    """
+    Entry for sys.path_hooks, which handles the paths of memory zips and
+    the packages inside them
+    """
+    for root, files in MEMORY_ZIPS.items():
+        if path == root:
+            return MemoryImporter(root, files, '')
+        elif path.startswith(root + '/'):
+            return MemoryImporter(root, files, path[len(root) + 1:] + '/')
+    raise ImportError()
+
+class MemoryImporter(object):
+    """
+    PEP 302 importer for the modules in a zip file held in memory, it works
+    like zipimport but never touches the disk.
+
+    prefix is the directory within the zip file being imported from
+    """
+    def __init__(self, root, files, prefix):
+        self._root = root
+        self._files = files
+        self._prefix = prefix
+
+    def _find(self, fullname):
+        """
+        Return the filename holding the module and whether it is a package,
+        or None if it isn't here
+        """
+        base = self._prefix + fullname.rpartition('.')[2]
+        for path, package in [(base + '/__init__', True), (base, False)]:
+            for extension in ['.pyc', '.py']:
+                if path + extension in self._files:
+                    return path + extension, package
+        return None
+
+    def _found(self, fullname):
+        found = self._find(fullname)
+        if found is None:
+            raise ImportError('No module named %s' % fullname)
+        return found
+
+    def find_module(self, fullname, path = None):
+        if self._find(fullname) is not None:
+            return self
+        return None
+
+    def is_package(self, fullname):
+        return self._found(fullname)[1]
+
+    def get_source(self, fullname):
+        filename, package = self._found(fullname)
+        source = os.path.splitext(filename)[0] + '.py'
+        return self._files.get(source)
+
+    def get_code(self, fullname):
+        filename, package = self._found(fullname)
+        contents = self._files[filename]
+        if filename.endswith('.pyc') and contents[:4] == imp.get_magic():
+            # skip the magic number and timestamp
+            return marshal.loads(contents[8:])
+
+        source = self.get_source(fullname)
+        if source is None:
+            raise ImportError('Cannot load %s compiled for another python' % fullname)
+        return compile(source.replace('\r\n', '\n'), self._root + '/' + filename, 'exec')
+
+    def load_module(self, fullname):
+        filename, package = self._found(fullname)
+        code = self.get_code(fullname)
+
+        module = sys.modules.setdefault(fullname, imp.new_module(fullname))
+        module.__file__ = self._root + '/' + filename
+        module.__loader__ = self
+        if package:
+            module.__path__ = [self._root + '/' + filename.rpartition('/')[0]]
+            module.__package__ = fullname
+        else:
+            module.__package__ = fullname.rpartition('.')[0]
 
         try:
-            # this makes the contents of the library accesible
-            sys.path.append(temporary_library.name)
-            # the __main__ here will be different then the orignal
-            # but the user may have pickled objects that refer to stuff in __main__
-            # so we do this quick hack to switch it over
-            sys.modules['__main__'] = __import__(self.name)
-            yield # the code inside the with block runs here
-            # I make no attempt to remove what I have done
-            # my previous attempts to do that ended poorly
-        finally:
-            # whatever happens, we should get rid of the file
-            os.remove(temporary_library.name)
+            exec code in module.__dict__
+        except:
+            del sys.modules[fullname]
+            raise
+        return sys.modules[fullname]
+
+@contextlib.contextmanager
+def applied(path, name):
+    """
+    Make the zip file at path importable, with the module name as __main__
+    path may also be a memory zip from add_memory_zip
+    """
+    # this makes the contents of the library accesible
+    sys.path.append(path)
+    # the __main__ here will be different then the orignal
+    # but the user may have pickled objects that refer to stuff in __main__
+    # so we do this quick hack to switch it over
+    sys.modules['__main__'] = __import__(name)
+    yield # the code inside the with block runs here
+    # I make no attempt to remove what I have done
+    # my previous attempts to do that ended poorly
 
 
 def get_python_files(base_directory):
@@ -82,19 +221,69 @@ def get_python_files(base_directory):
             if os.path.exists( os.path.join(path, '__init__.py') ):
                 yield path
 
-def construct_zip_file(base_directory):
+# every file in an assembled zip gets this date, so that putting the same
+# files together always gives exactly the same zip
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+# and is marked as made on unix, since zipfile otherwise picks this from
+# the platform and a zip built on windows would get a different hash
+ZIP_SYSTEM = 3
+ZIP_VERSION = 20
+
+def file_hash(contents):
+    return hashlib.sha256(contents).digest()
+
+def assemble_zip(manifest, files):
     """
-    Given a base_directory return a string of a zip file containing all of
-    the python files
+    Put together a zip file from the manifest, a list of (filename, file hash)
+    pairs, and files, a dictionary from file hash to contents
+    """
+    output = StringIO()
+    zipped = zipfile.ZipFile(output, 'w')
+    for filename, hash in manifest:
+        info = zipfile.ZipInfo(filename, ZIP_DATE)
+        info.create_system = ZIP_SYSTEM
+        info.create_version = ZIP_VERSION
+        info.extract_version = ZIP_VERSION
+        info.compress_type = zipfile.ZIP_STORED
+        info.external_attr = 0644 << 16
+        zipped.writestr(info, files[hash])
+    zipped.close()
+    return output.getvalue()
+
+def compile_python_file(python_file):
+    """
+    Compile a single python script or package, returning a list of
+    (filename, contents) pairs of what should go into the zip file
     """
     output = StringIO()
     pyzip = zipfile.PyZipFile(output, 'w')
+    pyzip.writepy(python_file)
+    pyzip.close()
+
+    pyzip = zipfile.ZipFile( StringIO(output.getvalue()) )
+    return [(filename, pyzip.read(filename)) for filename in pyzip.namelist()]
 
+def construct_manifest(base_directory):
+    """
+    Given a base_directory compile all of the python files, returning a
+    manifest of (filename, file hash) pairs and a dictionary from file
+    hash to contents
+    """
+    manifest = []
+    files = {}
     for python_file in get_python_files(base_directory):
-        pyzip.writepy(python_file)
+        for filename, contents in compile_python_file(python_file):
+            hash = file_hash(contents)
+            manifest.append( (filename, hash) )
+            files[hash] = contents
+    return manifest, files
 
-    pyzip.close()
-    return output.getvalue()
+def construct_zip_file(base_directory):
+    """
+    Given a base_directory return a string of a zip file containing all of
+    the python files
+    """
+    return assemble_zip( *construct_manifest(base_directory) )
 
 def module_name(filepath):
     """
@@ -109,15 +298,134 @@ def extract_configuration(main_python_file):
     Given the file which should be __main__, construct a configuration for it
     """
     base_directory = os.path.dirname(main_python_file)
-    contents = construct_zip_file(base_directory)
-    return Configuration(contents, module_name(main_python_file))
+    manifest, files = construct_manifest(base_directory)
+    return Configuration( assemble_zip(manifest, files), module_name(main_python_file), manifest )
 
 def default_configuration():
     """
     Build a Configuration based on the current __main__ module
     """
     import __main__
-    return extract_configuration(__main__.__file__)
+    return DEFAULT_MANIFEST_CACHE.extract_configuration(__main__.__file__)
+
+def file_signature(python_file):
+    """
+    Return the (path, size, mtime) of every script making up python_file,
+    which may be a script or a package
+    """
+    if os.path.isdir(python_file):
+        paths = []
+        for directory, subdirectories, filenames in os.walk(python_file):
+            subdirectories.sort()
+            paths.extend( os.path.join(directory, filename)
+                    for filename in sorted(filenames) if filename.endswith('.py') )
+    else:
+        paths = [python_file]
+
+    signature = []
+    for path in paths:
+        status = os.stat(path)
+        signature.append( (path, status.st_size, status.st_mtime) )
+    return tuple(signature)
+
+class ManifestCache(object):
+    """
+    The ManifestCache remembers the compiled scripts of a directory, and the
+    configuration made from them, in a file on disk. Scripts are only
+    compiled again when their path, size, or mtime changes, and if nothing
+    changed the previous configuration is used as it is.
+    """
+    def __init__(self, directory = None):
+        """
+        directory is where the cache files go, by default in the user's
+        cache directory. Failing to write them is not an error.
+        """
+        if directory is None:
+            directory = os.path.join(CACHE_HOME, 'manifests')
+        self._directory = directory
+        # the state for each base directory, as saved to disk
+        self._states = {}
+
+    def _path(self, base_directory):
+        return os.path.join(self._directory,
+                hashlib.sha256(base_directory).hexdigest() + '.pickle')
+
+    def _state(self, base_directory):
+        """
+        The cached state for the base directory, a dictionary with:
+            scripts - maps each script to (signature, manifest)
+            files - maps file hashes to contents
+            configuration - (name, signature of everything, Configuration)
+        """
+        if base_directory not in self._states:
+            try:
+                with open( self._path(base_directory), 'rb' ) as cached:
+                    state = pickle.load(cached)
+            except Exception:
+                # a missing or broken cache just means compiling everything
+                state = {'scripts' : {}, 'files' : {}, 'configuration' : None}
+            self._states[base_directory] = state
+        return self._states[base_directory]
+
+    def _save(self, base_directory, state):
+        try:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            temporary = tempfile.NamedTemporaryFile(dir = self._directory,
+                    suffix = '.tmp', delete = False)
+            with temporary.file as output:
+                pickle.dump(state, output, pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary.name, self._path(base_directory))
+        except (IOError, OSError):
+            pass
+
+    def extract_configuration(self, main_python_file):
+        """
+        Same as extract_configuration, only with the work of previous calls
+        being reused
+        """
+        base_directory = os.path.abspath( os.path.dirname(main_python_file) )
+        name = module_name(main_python_file)
+        state = self._state(base_directory)
+
+        scripts = {}
+        manifest = []
+        files = {}
+        for python_file in get_python_files(base_directory):
+            signature = file_signature(python_file)
+            cached = state['scripts'].get(python_file)
+            if cached is not None and cached[0] == signature:
+                script_manifest = cached[1]
+                for filename, hash in script_manifest:
+                    files[hash] = state['files'][hash]
+            else:
+                script_manifest = []
+                for filename, contents in compile_python_file(python_file):
+                    hash = file_hash(contents)
+                    script_manifest.append( (filename, hash) )
+                    files[hash] = contents
+            scripts[python_file] = (signature, script_manifest)
+            manifest.extend(script_manifest)
+
+        everything = sorted( scripts.items() )
+        previous = state['configuration']
+        if previous is not None and previous[:2] == (name, everything):
+            return previous[2]
+
+        configuration = Configuration( assemble_zip(manifest, files), name, manifest )
+        state = {
+            'scripts' : scripts,
+            'files' : files,
+            'configuration' : (name, everything, configuration)
+        }
+        self._states[base_directory] = state
+        self._save(base_directory, state)
+        return configuration
+
+DEFAULT_MANIFEST_CACHE = ManifestCache()
+
+# how long the files of an upload are kept waiting for its manifest
+UPLOAD_TIMEOUT = 600
 
 class ConfigurationLibrary(object):
     """
@@ -126,27 +434,110 @@ class ConfigurationLibrary(object):
 
     The only thing that this object assumes is the prescence of the hash
     attribute.
+
+    It also keeps the individual files of configurations added through
+    add_manifest, so that a new version of a configuration only needs the
+    files which changed to be sent over.
     """
-    def __init__(self):
-        self._configurations = {}
+    def __init__(self, max_configurations = None):
+        """
+        max_configurations limits how many configurations are kept, the
+        least recently used ones are dropped along with the files only they
+        needed. None means no limit.
+        """
+        self._max_configurations = max_configurations
+        # in order of use, the most recent last
+        self._configurations = collections.OrderedDict()
+        # contents of files by their hash
+        self._files = {}
+        # when files were last asked about by uploads whose manifest
+        # hasn't arrived yet
+        self._uploading = {}
 
     def add(self, configuration):
         """
         Add a configuration to the hash
         """
+        self._configurations.pop(configuration.hash, None)
         self._configurations[configuration.hash] = configuration
+        if (self._max_configurations is not None
+                and len(self._configurations) > self._max_configurations):
+            while len(self._configurations) > self._max_configurations:
+                self._configurations.popitem(last = False)
+            self._prune()
 
     def get(self, hash):
         """
         Return the configuration corresponding to the hash
         """
-        return self._configurations[hash]
+        configuration = self._configurations.pop(hash)
+        self._configurations[hash] = configuration
+        return configuration
 
     def remove(self, hash):
         """
         Remove the configuration corresponding to the hash
         """
         del self._configurations[hash]
+        self._prune()
+
+    def _prune(self):
+        """
+        Forget the files no configuration or upload needs anymore
+        """
+        now = time.time()
+        for file_hash, asked in self._uploading.items():
+            if now - asked > UPLOAD_TIMEOUT:
+                # whoever was uploading has given up on it
+                del self._uploading[file_hash]
+
+        needed = set(self._uploading)
+        for configuration in self._configurations.values():
+            for filename, file_hash in getattr(configuration, 'manifest', None) or []:
+                needed.add(file_hash)
+        for file_hash in self._files.keys():
+            if file_hash not in needed:
+                del self._files[file_hash]
+
+    def missing_files(self, hashes):
+        """
+        Return those of the file hashes for which we do not have the contents
+
+        This starts an upload, the files are kept until add_manifest is called
+        """
+        now = time.time()
+        for hash in hashes:
+            self._uploading[hash] = now
+        return [hash for hash in hashes if hash not in self._files]
+
+    def add_files(self, files):
+        """
+        Add the contents of files, given as a list of (file hash, contents)
+        Raises ValueError if the contents do not match the hash
+        """
+        for hash, contents in files:
+            if file_hash(contents) != hash:
+                raise ValueError('contents do not match file hash')
+            self._files[hash] = contents
+
+    def add_manifest(self, name, manifest, hash = None):
+        """
+        Put together and add a configuration from the files in the manifest,
+        which should have been added already. Returns the new configuration.
+
+        If hash is given, it is what the configuration is expected to come
+        out as, and ValueError is raised if it doesn't rather than adding it
+        under a hash nobody will ask for.
+        """
+        files = dict( (file_hash, self._files[file_hash]) for filename, file_hash in manifest )
+        for file_hash in files:
+            self._uploading.pop(file_hash, None)
+        configuration = Configuration( assemble_zip(manifest, files), name, manifest )
+        if hash is not None and configuration.hash != hash:
+            self._prune()
+            raise ValueError('assembled configuration does not match its hash')
+        self.add(configuration)
+        return configuration
 
 def single_file_configuration(name, contents):
     output = StringIO()
@@ -155,3 +546,178 @@ def single_file_configuration(name, contents):
     zipped.close()
     return Configuration( output.getvalue(), name)
 
+
+# where workers keep configurations between runs, and how much space
+# they may take up there
+DEFAULT_CACHE_DIRECTORY = os.path.join(CACHE_HOME, 'configurations')
+DEFAULT_CACHE_BYTES = 2 ** 30
+# how much of a cached zip is read at once to check its hash
+HASH_BLOCK = 1024 * 1024
+
+class ConfigurationCache(object):
+    """
+    The ConfigurationCache sits in front of another library, typically a
+    ConfigurationLibraryClient, and keeps the zip files of the
+    configurations fetched from it in a directory named by their hash.
+
+    Since the directory survives restarts, asking for a configuration
+    which has been seen before is just a check for the file. What it hands
+    out are CachedConfigurations, which refer to the file rather than
+    holding the contents.
+
+    Objects which are not Configurations are passed through as they are.
+    """
+    def __init__(self, library, directory = DEFAULT_CACHE_DIRECTORY,
+            max_bytes = DEFAULT_CACHE_BYTES):
+        """
+        max_bytes limits the size of the cache, the least recently
+        used configurations are removed to keep within it. None means
+        no limit.
+
+        in_use may be set to a function returning the hashes of the
+        configurations which are being imported from, those are never
+        removed. Worker.configurations_in_use is one.
+        """
+        self._library = library
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self.in_use = None
+        self._configurations = {}
+        # events for configurations currently being fetched, so that
+        # nothing is fetched twice at once
+        self._fetching = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, hash, extension):
+        return os.path.join(self._directory, hash.encode('hex') + extension)
+
+    def add(self, configuration):
+        self._library.add(configuration)
+
+    def remove(self, hash):
+        self._configurations.pop(hash, None)
+        self._library.remove(hash)
+
+    def get(self, hash):
+        """
+        Return the configuration corresponding to the hash, only fetching
+        it from the library if it has not been cached
+        """
+        if hash in self._configurations:
+            configuration = self._configurations[hash]
+            if not isinstance(configuration, CachedConfiguration) or os.path.exists(configuration.path):
+                self._touch(configuration)
+                return configuration
+
+        if hash in self._fetching:
+            return self._fetching[hash].wait()
+
+        event = eventlet.event.Event()
+        self._fetching[hash] = event
+        try:
+            configuration = self._load(hash)
+            if configuration is None:
+                configuration = self._store( self._library.get(hash) )
+        except Exception as error:
+            event.send_exception(error)
+            raise
+        else:
+            self._configurations[hash] = configuration
+            event.send(configuration)
+            return configuration
+        finally:
+            del self._fetching[hash]
+
+    def _load(self, hash):
+        """
+        Return the configuration from the disk, or None if it is not there
+        """
+        path = self._path(hash, '.zip')
+        try:
+            with open( self._path(hash, '.name') ) as name_file:
+                name = name_file.read()
+            with open(path, 'rb') as contents:
+                hasher = hashlib.sha256()
+                for block in iter(lambda: contents.read(HASH_BLOCK), ''):
+                    hasher.update(block)
+        except IOError:
+            return None
+        if hasher.digest() != hash:
+            # left damaged by a crash, so fetch it again
+            self._discard(hash)
+            return None
+        configuration = CachedConfiguration(hash, name, path)
+        self._touch(configuration)
+        return configuration
+
+    def _store(self, configuration):
+        """
+        Write the configuration to disk, returning the CachedConfiguration
+        """
+        if not isinstance(configuration, Configuration):
+            return configuration
+
+        # write to temporary files first, so nobody sees half a file
+        # the zip is moved in last since it marks the entry as complete
+        for extension, contents in [('.name', configuration.name),
+                ('.zip', configuration.contents)]:
+            temporary = tempfile.NamedTemporaryFile(dir = self._directory,
+                    suffix = '.tmp', delete = False)
+            with temporary.file as output:
+                output.write(contents)
+            os.rename(temporary.name, self._path(configuration.hash, extension))
+
+        self._trim(configuration.hash)
+        return CachedConfiguration(configuration.hash, configuration.name,
+                self._path(configuration.hash, '.zip'))
+
+    def _touch(self, configuration):
+        if isinstance(configuration, CachedConfiguration):
+            try:
+                os.utime(configuration.path, None)
+            except OSError:
+                pass
+
+    def _trim(self, keep):
+        """
+        Remove the least recently used configurations until the cache
+        fits in max_bytes again, except for the one with hash keep
+        """
+        if self._max_bytes is None:
+            return
+        in_use = set(self.in_use()) if self.in_use is not None else set()
+
+        entries = []
+        total = 0
+        for filename in os.listdir(self._directory):
+            if not filename.endswith('.zip'):
+                continue
+            path = os.path.join(self._directory, filename)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append( (status.st_mtime, status.st_size, filename[:-4].decode('hex')) )
+            total += status.st_size
+
+        entries.sort()
+        for modified, size, hash in entries:
+            if total <= self._max_bytes:
+                break
+            if hash == keep or hash in in_use:
+                continue
+            self._discard(hash)
+            total -= size
+
+    def _discard(self, hash):
+        """
+        Remove the configuration's files from the cache
+        """
+        for extension in ['.zip', '.name']:
+            try:
+                os.remove( self._path(hash, extension) )
+            except OSError:
+                pass
+        self._configurations.pop(hash, None)
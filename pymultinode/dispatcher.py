@@ -1,24 +1,238 @@
 """
 pymultinode.dispatcher
 
-The dispatcher is responsible for keeping track of the workers and submitting 
+The dispatcher is responsible for keeping track of the workers and submitting
 tasks to them
 """
 from .protocol import ConnectionLost
+from .future import Future
+from .worker import SlaveCrashed
+from greenlet import GreenletExit
 import eventlet
+import collections
+import itertools
+import bisect
+import time
 
+# how many of the most recently requested configurations to remember
+RECENT_CONFIGURATIONS = 16
+# how many task durations per element are remembered for each configuration
+DURATION_SAMPLES = 100
+# how many durations are needed before guessing how long a task should take
+MIN_DURATION_SAMPLES = 5
+
+
+class PoisonTaskError(Exception):
+    """
+    Raised for a task which kept crashing the slaves running it, so it was
+    given up on rather than being allowed to take down more of them
+    """
+
+
+class TaskStolen(Exception):
+    """
+    Raised for a task a worker handed back before starting it, so that
+    an idle worker could have it
+    """
+
+
+class TaskRecord(object):
+    """
+    Everything the dispatcher keeps track of for a single task
+    """
+    def __init__(self, configuration_id, task, event, timeout = None, speculative = False,
+            priority = 0, weight = 1.0, client = None, count = 1):
+        self.configuration_id = configuration_id
+        self.task = task
+        self.event = event
+        self.timeout = timeout
+        self.speculative = speculative
+        # how many elements of an iteration the task covers
+        self.count = count
+        self.priority = priority
+        self.weight = weight
+        # the tasks sharing a flow share its turns in the queue
+        self.flow = (client, configuration_id)
+        # where the task is in the TaskQueue, None when it isn't waiting
+        self.queued = None
+        # how many times a later task was handed out ahead of this one
+        self.skipped = 0
+        # the green threads running copies of the task, by worker
+        self.running = {}
+        # when each copy actually started, leaving out time spent
+        # prefetched in a worker's queue
+        self.started = {}
+        # the timer which checks on a speculative task when it runs long
+        self.timer = None
+        # how many times the task crashed a slave, and the workers it did so on
+        self.crashes = 0
+        self.crashed_on = set()
+
+class Durations(object):
+    """
+    Remembers how long the most recent tasks for each configuration took
+    for each element they covered, so chunks of any size can share them
+    """
+    def __init__(self):
+        self._durations = {}
+
+    def record(self, configuration_id, elapsed, count = 1):
+        durations = self._durations.get(configuration_id)
+        if durations is None:
+            durations = collections.deque(maxlen = DURATION_SAMPLES)
+            self._durations[configuration_id] = durations
+        durations.append(elapsed / count)
+
+    def expected(self, configuration_id, count = 1):
+        """
+        Return how long a task for the configuration covering count elements
+        should take, from the median per element, or None if there haven't
+        been enough of them to tell
+        """
+        durations = self._durations.get(configuration_id, ())
+        if len(durations) < MIN_DURATION_SAMPLES:
+            return None
+        return sorted(durations)[len(durations) // 2] * count
+
+    def forget(self, configuration_id):
+        self._durations.pop(configuration_id, None)
+
+class TaskQueue(object):
+    """
+    The tasks waiting for a worker, in the order they should be handed out
+
+    Higher priority tasks always come first. Tasks of the same priority
+    are shared out between flows, each client's tasks for one
+    configuration, in proportion to the flows' weights however many tasks
+    each has waiting. This is start time fair queuing: a task is stamped
+    with the virtual time its flow gets to it, which moves on by one over
+    the weight for every task the flow submits, and the tasks go out in
+    order of their stamps.
+    """
+    def __init__(self):
+        # (key, record) sorted by key, which is the priority, whether the
+        # task was requeued, its stamp and a counter to break ties
+        self._entries = []
+        self._counter = itertools.count()
+        # the stamp of the task handed out most recently
+        self._virtual_time = 0.0
+        # for each flow with tasks waiting, how many and the next stamp
+        self._waiting = {}
+        self._finish = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return (record for key, record in self._entries)
+
+    def __contains__(self, record):
+        return record.queued is not None
+
+    def _insert(self, record, requeued, stamp):
+        record.queued = (-record.priority, requeued, stamp, next(self._counter))
+        bisect.insort(self._entries, (record.queued, record))
+        self._waiting[record.flow] = self._waiting.get(record.flow, 0) + 1
+
+    def push(self, record):
+        """
+        Add a new task behind the others from its flow
+        """
+        stamp = max(self._virtual_time, self._finish.get(record.flow, 0.0))
+        self._finish[record.flow] = stamp + 1.0 / record.weight
+        self._insert(record, 1, stamp)
+
+    def requeue(self, record):
+        """
+        Put back a task which was handed out but did not get done,
+        it has already waited once so it goes to the front of its priority
+        """
+        self._insert(record, 0, self._virtual_time)
+
+    def remove(self, record):
+        key = record.queued
+        del self._entries[ bisect.bisect_left(self._entries, (key,)) ]
+        record.queued = None
+        self._waiting[record.flow] -= 1
+        if not self._waiting[record.flow]:
+            # a flow which comes back later starts afresh
+            del self._waiting[record.flow]
+            self._finish.pop(record.flow, None)
+
+    def take(self, record):
+        """
+        Remove a task which is being handed out
+        """
+        priority, requeued, stamp, count = record.queued
+        self.remove(record)
+        self._virtual_time = max(self._virtual_time, stamp)
 
 class Dispatcher(object):
     """
     The Dispatcher object keeps track of both workers and tasks
+
+    Tasks are queued by priority, and shared fairly between clients, see
+    TaskQueue. They are preferably given to workers which already have their
+    configuration loaded. A task will only be passed over patience times
+    in favor of later tasks before it is handed to any free worker,
+    so nothing waits forever.
+
+    When there are no tasks waiting, speculative tasks which have run for
+    more than speculation times the usual duration for their configuration
+    get a second copy started on another free worker. The first copy to
+    finish provides the result.
+
+    Workers added with prefetch take that many tasks more than they can
+    run at once, to have the next ones ready. When a worker is idle and
+    there is nothing waiting, it steals one of those from the worker with
+    the most of them.
+
+    Tasks whose worker goes away are put back on the queue right away,
+    remote workers get a chance to reconnect before theirs are given up on.
+    Tasks which crash the slave running them are retried up to max_retries
+    times, waiting retry_delay seconds before the first retry and twice as
+    long before each one after that. A task which crashes slaves on
+    poison_workers different workers, or runs out of retries, fails with
+    a PoisonTaskError.
     """
-    def __init__(self):
-        self._workers = eventlet.queue.LightQueue()
-        self._tasks = eventlet.queue.LightQueue()
-        self._thread = eventlet.spawn(self._process)
+    def __init__(self, window = 32, patience = 8, speculation = 2.0,
+            max_retries = 3, retry_delay = 0.5, poison_workers = 3):
+        """
+        window is how many of the waiting tasks are considered when looking
+        for one matching a free worker
+        """
+        self._window = window
+        self._patience = patience
+        self._speculation = speculation
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._poison_workers = poison_workers
+        # how many tasks were retried after crashing, and given up on
+        self._retried = 0
+        self._poisoned = 0
+        self._durations = Durations()
+        # speculative tasks which are taking too long, oldest first
+        self._stragglers = collections.deque()
+        # how many second copies have been started
+        self._speculated = 0
+        # for each worker being asked to give back a task, who it's for
+        self._thieves = {}
+        # how many tasks were taken from one worker for another
+        self._stolen = 0
+        # for each worker, the tasks sent to wait in its prefetch queue
+        self._prefetched = {}
+        # how many free slots each worker has, in the order they came free
+        self._free = collections.OrderedDict()
+        self._tasks = TaskQueue()
         self._cpus = {}
+        # how many tasks each worker can be given at once, prefetching included
+        self._slots = {}
         self._active = {}
+        # workers which are out of reach for now, they get no new tasks
+        self._paused = set()
         self._waiting_tasks = 0
+        # configuration ids from the least to most recently requested
+        self._recent = collections.OrderedDict()
 
     def data(self):
         workers = []
@@ -29,63 +243,406 @@ class Dispatcher(object):
             workers.append(data)
         data = {
             'workers' : workers,
-            'waiting_tasks' : self._waiting_tasks
+            'waiting_tasks' : self._waiting_tasks,
+            'speculated' : self._speculated,
+            'retried' : self._retried,
+            'poisoned' : self._poisoned,
+            'stolen' : self._stolen
         }
         return data
 
-    def _process(self):
+    def _schedule(self):
         """
-        This internal function fires off a task whenever
-        there is a task and a worker waiting
+        This internal function fires off tasks as long as there are both
+        tasks and workers waiting
         """
-        while True:
-            # the queue will block when we are out of workers
-            worker = self._workers.get()
-            configuration_id, task, event = self._tasks.get()
-            self._active[worker] += 1
-            self._waiting_tasks -= 1
-            thread = eventlet.spawn(worker.do_task, configuration_id, task)
-            thread.link(self._task_finished, worker, configuration_id, task, event)
-    
-    def _task_finished(self, thread, worker, configuration_id, task, event):
+        while self._free and self._tasks:
+            worker, record = self._pick()
+            self._take_slot(worker)
+            self._tasks.take(record)
+            self._start(worker, record)
+
+        if self._free and self._stragglers:
+            self._speculate()
+
+        if self._free and not self._tasks:
+            self._steal_work()
+
+    def _pick(self):
+        """
+        Choose which waiting task to give to which free worker
+        """
+        candidates = list(itertools.islice(self._tasks, self._window))
+        head = candidates[0]
+        # lower priority tasks don't get ahead for being warm
+        candidates = [record for record in candidates if record.priority == head.priority]
+        if head.skipped >= self._patience:
+            # the task has waited long enough, it goes to anybody
+            candidates = [head]
+
+        # the free workers which have each configuration loaded
+        warm = collections.defaultdict(list)
+        for worker in self._free:
+            for configuration_id in worker.warm_configurations():
+                warm[configuration_id].append(worker)
+
+        for index, record in enumerate(candidates):
+            for worker in warm.get(record.configuration_id, ()):
+                if worker not in record.crashed_on:
+                    for passed in candidates[:index]:
+                        passed.skipped += 1
+                    return worker, record
+
+        # nobody has anything useful loaded, so just go in order
+        # but keep tasks away from workers they crashed on if we can
+        for worker in self._free:
+            if worker not in head.crashed_on:
+                return worker, head
+        return next(iter(self._free)), head
+
+    def _take_slot(self, worker):
+        """
+        Use up one of the worker's free slots
+        """
+        self._free[worker] -= 1
+        if not self._free[worker]:
+            del self._free[worker]
+
+    def _free_slot(self, worker):
+        if worker not in self._paused:
+            self._free[worker] = self._free.get(worker, 0) + 1
+
+    def _start(self, worker, record):
+        self._waiting_tasks -= 1
+        self._run(worker, record)
+
+    def _run(self, worker, record):
+        """
+        Have the worker run a copy of the task
+        """
+        self._active[worker] += 1
+        thread = eventlet.spawn(worker.do_task, record.configuration_id, record.task,
+                timeout = record.timeout)
+        record.running[worker] = thread
+        thread.link(self._task_finished, worker, record)
+        if self._active[worker] > self._cpus[worker]:
+            # it waits in the worker's queue until another task finishes
+            self._prefetched[worker].append(record)
+        else:
+            self._began(worker, record)
+
+    def _began(self, worker, record):
+        """
+        Note that a copy of the task has started running on the worker,
+        and time it if it is speculative
+        """
+        record.started[worker] = time.time()
+        if (record.speculative and record.timer is None
+                and len(record.running) == 1 and record not in self._stragglers):
+            expected = self._durations.expected(record.configuration_id, record.count)
+            if expected is not None:
+                record.timer = eventlet.spawn_after(self._speculation * expected,
+                        self._straggling, record)
+
+    def _begin_prefetched(self, worker):
+        """
+        Called when a task running on the worker is done, the next one it
+        had prefetched starts in its place
+        """
+        prefetched = self._prefetched[worker]
+        while prefetched:
+            record = prefetched.popleft()
+            # skip tasks which were stolen, cancelled or already finished
+            if worker in record.running and worker not in record.started:
+                self._began(worker, record)
+                return
+
+    def _straggling(self, record):
+        """
+        Called when a speculative task has been running for longer than it
+        should, it gets a second copy once a worker is free
+        """
+        record.timer = None
+        if not record.event.done() and len(record.running) == 1:
+            self._stragglers.append(record)
+            self._schedule()
+
+    def _speculate(self):
+        """
+        Start second copies of straggling tasks on free workers other than
+        the ones already running them
+        """
+        for record in list(self._stragglers):
+            if record.event.done() or not record.running:
+                self._stragglers.remove(record)
+                continue
+            for worker in self._free:
+                if worker not in record.running:
+                    self._stragglers.remove(record)
+                    self._take_slot(worker)
+                    self._speculated += 1
+                    self._run(worker, record)
+                    break
+            if not self._free:
+                break
+
+    def _steal_work(self):
+        """
+        Have idle workers take over tasks which other workers prefetched
+        but haven't started yet
+        """
+        for thief in list(self._free):
+            if self._active[thief] >= self._cpus[thief]:
+                # the free slot is only for prefetching
+                continue
+            victims = [worker for worker, active in self._active.items()
+                    if active > self._cpus[worker] and worker is not thief
+                    and worker not in self._thieves and worker not in self._paused]
+            if not victims:
+                return
+            victim = max(victims, key = lambda worker: self._active[worker] - self._cpus[worker])
+            # hold on to the slot until we know whether we got anything
+            self._take_slot(thief)
+            self._active[thief] += 1
+            self._thieves[victim] = thief
+            eventlet.spawn_n(self._steal, thief, victim)
+
+    def _steal(self, thief, victim):
+        """
+        Ask the victim to give back a task for the thief, when it does the
+        task finishes with TaskStolen and _hand_over passes it on
+        """
+        try:
+            stolen = victim.steal()
+        except ConnectionLost:
+            stolen = False
+        if not stolen:
+            self._thieves.pop(victim, None)
+            self._release(thief)
+            # tasks may have come in while the slot was held
+            self._schedule()
+
+    def _hand_over(self, victim, record):
+        """
+        Start a task which the victim gave back on the worker waiting for it
+        """
+        thief = self._thieves.pop(victim, None)
+        if thief is not None and thief in self._active:
+            self._active[thief] -= 1
+        else:
+            thief = None
+
+        if record.event.done() or record.running:
+            if thief is not None:
+                self._free_slot(thief)
+        elif thief is None:
+            self._tasks.requeue(record)
+            self._waiting_tasks += 1
+        else:
+            self._stolen += 1
+            self._run(thief, record)
+
+    def _task_finished(self, thread, worker, record):
         """
         This internal function is called when a worker indicates the task is complete
+
+        If there was more than one copy of the task, only the first result
+        counts and the others are stopped
         """
+        del record.running[worker]
+        started = record.started.pop(worker, None)
+        if started is not None and worker in self._prefetched:
+            # this copy was running, so one the worker queued starts
+            self._begin_prefetched(worker)
         try:
             # this obtains the actual result of the thread
             result = thread.wait()
-            self._active[worker] -= 1
+        except GreenletExit:
+            # this copy was stopped because the task was cancelled
+            # or another copy finished first
+            self._release(worker)
+        except TaskStolen:
+            # it was handed back without being started
+            self._release(worker)
+            self._hand_over(worker, record)
         except ConnectionLost:
             # The worker has given up, we reschedule the task
-            self._tasks.put( (configuration_id, task, event) )
-            self._cpus[worker] -= 1
-            if self._cpus[worker] == 0:
-                del self._cpus[worker]
-                del self._active[worker]
+            # unless another copy is still going
+            if not record.running and not record.event.done():
+                self._tasks.requeue(record)
+                self._waiting_tasks += 1
+            self.remove_worker(worker)
+        except SlaveCrashed as error:
+            # the worker itself is fine, the task may be to blame
+            self._release(worker)
+            self._crashed(record, worker, error)
+        except Exception as error:
+            # another copy still going may yet succeed, it gets the last word
+            if not record.running:
+                record.event.send_exception(error)
+            self._release(worker)
         else:
             # it worked, tell the event we did it
-            event.send(result)
-            # put the worker back on the queue for future use
-            self._workers.put(worker)
+            if not record.event.done() and started is not None:
+                self._durations.record(record.configuration_id, time.time() - started,
+                        record.count)
+            record.event.send(result)
+            self._release(worker)
+        self._schedule()
+
+    def _crashed(self, record, worker, error):
+        """
+        Deal with a task which crashed the slave running it, either retrying
+        it later or giving up on it
+        """
+        record.crashes += 1
+        record.crashed_on.add(worker)
+        if record.event.done() or record.running:
+            # a copy is still going, it can have its turn first
+            return
+
+        if len(record.crashed_on) >= self._poison_workers or record.crashes > self._max_retries:
+            self._poisoned += 1
+            record.event.send_exception( PoisonTaskError(
+                    'task crashed %d slaves on %d workers, last with: %s' % (
+                    record.crashes, len(record.crashed_on), error)) )
+            return
+
+        self._retried += 1
+        delay = self._retry_delay * 2 ** (record.crashes - 1)
+        eventlet.spawn_after(delay, self._retry, record)
+
+    def _retry(self, record):
+        """
+        Put a task which crashed back on the queue, unless it was cancelled
+        while waiting
+        """
+        if not record.event.done():
+            self._tasks.requeue(record)
+            self._waiting_tasks += 1
+            self._schedule()
+
+    def _release(self, worker):
+        """
+        Put the worker back on the queue for future use, unless it has gone
+        away in the meantime
+        """
+        if worker in self._active:
+            self._active[worker] -= 1
+            self._free_slot(worker)
+
+    def remove_worker(self, worker):
+        """
+        Forget about a worker which can no longer do tasks. Any tasks it is
+        still running will fail and be rescheduled on their own.
+        """
+        if worker in self._active:
+            del self._cpus[worker]
+            del self._slots[worker]
+            del self._active[worker]
+            self._paused.discard(worker)
+            del self._prefetched[worker]
+            self._thieves.pop(worker, None)
+            self._free.pop(worker, None)
+
+    def pause_worker(self, worker):
+        """
+        Stop giving a worker new tasks while it is out of reach, the tasks
+        it already has wait for it to come back
+        """
+        if worker in self._active:
+            self._paused.add(worker)
+            self._free.pop(worker, None)
 
-    def add_worker(self, worker, count):
+    def resume_worker(self, worker):
+        """
+        Start giving a paused worker tasks again
+        """
+        if worker in self._paused:
+            self._paused.remove(worker)
+            free = self._slots[worker] - self._active[worker]
+            if free > 0:
+                self._free[worker] = free
+            self._schedule()
+
+    def _task_done(self, record):
+        """
+        Called when a task's future finishes. If it was cancelled before
+        being handed out it is taken off the queue, and any copies still
+        running are stopped.
+        """
+        if record.event.cancelled() and record in self._tasks:
+            self._tasks.remove(record)
+            self._waiting_tasks -= 1
+        if record.timer is not None:
+            record.timer.cancel()
+            record.timer = None
+        for thread in record.running.values():
+            # not right away, we may be in the middle of handling the result
+            eventlet.spawn_n(thread.kill)
+
+    def add_worker(self, worker, count, prefetch = 0):
         """
         Add the given worker, indicate that it can be given count tasks at once
+
+        The worker's warm_configurations method says which configurations
+        it has loaded, its tasks for those are picked first.
+
+        With prefetch, the worker is given that many more tasks to queue up
+        for when it is done with the others. It must have a steal method to
+        give back one of those, returning whether there was one.
         """
 
-        # We record the multiple counts as different workers
-        for idx in xrange(count):
-            self._workers.put(worker)
+        # all its slots start out free
+        self._free[worker] = count + prefetch
         self._cpus[worker] = count
+        self._slots[worker] = count + prefetch
         self._active[worker] = 0
+        self._prefetched[worker] = collections.deque()
+
+        # get the new worker warmed up for whatever is currently being run
+        if self._recent:
+            configuration_id = next(reversed(self._recent))
+            worker.prespawn(configuration_id, count)
 
-    def do_task(self, configuration_id, task):
+        self._schedule()
+
+    def do_task(self, configuration_id, task, timeout = None, speculative = False,
+            priority = 0, weight = 1.0, client = None, count = 1):
         """
         Request that the given task be performed
+
+        Returns a Future which will hold the result. Cancelling it before
+        the task is handed to a worker means the task is never run, and
+        afterwards stops the worker running it.
+
+        A task running for more than timeout seconds is killed by the
+        worker and fails with a TimeoutError. Speculative tasks may be run
+        more than once, see Dispatcher.
+
+        Tasks with a higher priority are handed out before any waiting
+        tasks with a lower one. Otherwise each client gets turns for each
+        configuration in proportion to weight, see TaskQueue. client
+        identifies who submitted the task, like the connection it came in on.
+
+        count is how many elements of an iteration the task covers, so its
+        duration can be compared with those of other sized chunks.
         """
-        # we create an event for the task and avoid actually 
+        if weight <= 0:
+            raise ValueError('weight must be positive, not %r' % (weight,))
+        # we create a future for the task and avoid actually
         # creating a greenthread for it
-        event = eventlet.event.Event()
-        self._tasks.put( (configuration_id, task, event)  )
+        event = Future()
+        self._recent.pop(configuration_id, None)
+        self._recent[configuration_id] = True
+        if len(self._recent) > RECENT_CONFIGURATIONS:
+            forgotten, recent = self._recent.popitem(last = False)
+            self._durations.forget(forgotten)
+
+        record = TaskRecord(configuration_id, task, event, timeout, speculative,
+                priority, weight, client, count)
+        event.add_done_callback(lambda event: self._task_done(record))
+        self._tasks.push(record)
         self._waiting_tasks += 1
+        self._schedule()
         return event
@@ -0,0 +1,191 @@
+"""
+pymultinode.future
+
+Futures keep track of results which are not available yet. They follow the
+interface of concurrent.futures, but are built on eventlet so waiting on
+them only blocks the current green thread.
+
+They also support the send/send_exception/wait/ready methods of eventlet
+events so that they can be used anywhere an event was used before.
+"""
+import sys
+import time
+import traceback
+import eventlet
+
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+FIRST_EXCEPTION = 'FIRST_EXCEPTION'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
+class CancelledError(Exception):
+    pass
+
+class TimeoutError(Exception):
+    pass
+
+class Future(object):
+    """
+    Holds the result of an operation which will finish at some point
+    """
+    def __init__(self):
+        self._event = eventlet.event.Event()
+        self._callbacks = []
+        self._cancelled = False
+
+    def done(self):
+        """
+        Return True if the future has a result or exception
+        """
+        return self._event.ready()
+
+    def cancelled(self):
+        """
+        Return True if the future was cancelled
+        """
+        return self._cancelled
+
+    def cancel(self):
+        """
+        Cancel the future. Returns False if it had already finished.
+        """
+        if self.done():
+            return False
+        self._cancelled = True
+        self._finish(None, CancelledError())
+        return True
+
+    def send(self, result = None):
+        """
+        Provide the result. Results arriving after the future was cancelled
+        are dropped.
+        """
+        if not self.done():
+            self._finish(result, None)
+
+    def send_exception(self, exception):
+        """
+        Provide an exception to be raised instead of a result
+        """
+        if not self.done():
+            self._finish(None, exception)
+
+    set_result = send
+    set_exception = send_exception
+
+    def _finish(self, result, exception):
+        if exception is None:
+            self._event.send(result)
+        else:
+            self._event.send_exception(exception)
+
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        """
+        Run a done callback, one which fails doesn't stop the others or
+        trouble whoever finished the future
+        """
+        try:
+            callback(self)
+        except Exception:
+            print >> sys.stderr, "Exception in future callback"
+            traceback.print_exc()
+
+    def ready(self):
+        return self.done()
+
+    def wait(self):
+        """
+        Wait for the future, returning the result or raising the exception
+        """
+        return self._event.wait()
+
+    def result(self, timeout = None):
+        """
+        Wait at most timeout seconds for the result.
+        Raises TimeoutError if it isn't ready by then
+        """
+        with eventlet.Timeout(timeout, TimeoutError()):
+            return self._event.wait()
+
+    def exception(self, timeout = None):
+        """
+        Wait at most timeout seconds and return the exception raised, or None
+        if there wasn't one
+        """
+        try:
+            self.result(timeout)
+        except (CancelledError, TimeoutError):
+            raise
+        except Exception as error:
+            return error
+        else:
+            return None
+
+    def add_done_callback(self, callback):
+        """
+        callback will be called with the future once it finishes. If it has
+        already finished, the callback is called right away.
+        """
+        if self.done():
+            self._call(callback)
+        else:
+            self._callbacks.append(callback)
+
+def as_completed(futures, timeout = None):
+    """
+    Produce the futures as they finish
+
+    Raises TimeoutError if they have not all finished within timeout seconds
+    """
+    futures = set(futures)
+    finished = eventlet.queue.LightQueue()
+    for future in futures:
+        future.add_done_callback(finished.put)
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    for count in xrange(len(futures)):
+        if timeout is None:
+            yield finished.get()
+        else:
+            try:
+                yield finished.get(timeout = max(0, deadline - time.time()))
+            except eventlet.queue.Empty:
+                raise TimeoutError()
+
+def wait(futures, timeout = None, return_when = ALL_COMPLETED):
+    """
+    Wait for the futures to finish. Returns a tuple of two sets, those which
+    are done and those which are not done.
+
+    return_when can be FIRST_COMPLETED, FIRST_EXCEPTION, or ALL_COMPLETED
+    """
+    futures = set(futures)
+    woken = eventlet.event.Event()
+
+    def finished_enough():
+        done = set(future for future in futures if future.done())
+        if return_when == FIRST_COMPLETED:
+            return bool(done)
+        elif return_when == FIRST_EXCEPTION:
+            for future in done:
+                if future.cancelled() or future.exception() is not None:
+                    return True
+        return len(done) == len(futures)
+
+    def check(future):
+        if not woken.ready() and finished_enough():
+            woken.send()
+
+    if not finished_enough():
+        for future in futures:
+            future.add_done_callback(check)
+        with eventlet.Timeout(timeout, False):
+            woken.wait()
+
+    done = set(future for future in futures if future.done())
+    return done, futures - done
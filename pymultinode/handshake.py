@@ -5,50 +5,79 @@ This module is responsible for the handshake in the protocols.
 It allows the connection between the server and client to start
 """
 import hashlib
-from .protocol import request_protocol_from_file, ConnectionLost
+from .protocol import request_protocol_from_file, ConnectionLost, PROTOCOL_VERSION
 from .proxy import DispatcherClient, ConfigurationLibraryClient
-from .proxy import DispatcherServer, ConfigurationLibraryServer
+from .proxy import DispatcherServer, ConfigurationLibraryServer, WorkerSessions
 import random
+import socket
 import eventlet.wsgi
 
 CODE_LENGTH = 32
 DIGEST_LENGTH = hashlib.sha256().digest_size
+# how long to wait before trying to reconnect, this doubles after every
+# failed attempt up to the maximum
+RECONNECT_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
 
 class ConnectionHandler(object):
     """
     The ConnectionHandler is setup by the server and is responsible for making
     the connections between the incoming sockets and the accesible interfaces
     """
-    def __init__(self, dispatcher, library, secret):
+    def __init__(self, dispatcher, library, secret, sources = None, **options):
+        """
+        sources should be a pymultinode.peer.SourceTracker if workers are to
+        get configurations from each other
+
+        options are passed along to request_protocol_from_file for every
+        connection, heartbeat_interval for example
+        """
         self._dispatcher = dispatcher
         self._library = library
         self._secret = secret
+        self._sources = sources
+        self._options = options
+        # lets workers which reconnect carry on with their tasks
+        self._sessions = WorkerSessions()
 
     def new_connection(self, client):
         """
         Implements the connection handshake
         """
-        # we send CODE_LENGTH random challenge
-        challenge = ''.join( chr(random.randrange(256)) for x in xrange(CODE_LENGTH) )
-        client.write(challenge)
-        client.flush()
-
-        # the client will use those challenge and its password to come up with a response
-        response = client.read(DIGEST_LENGTH)
-        correct = calculate_response(challenge, self._secret)
-
-        if correct == response:
-            # tell the cilent we are happy
-            client.write('OK')
-            client.flush()
+        if server_handshake(client, self._secret):
             # hook up the objects
-            protocol = request_protocol_from_file(client)
-            DispatcherServer(self._dispatcher, protocol)
-            ConfigurationLibraryServer(self._library, protocol)
+            protocol = request_protocol_from_file(client, **self._options)
+            DispatcherServer(self._dispatcher, protocol, self._sessions)
+            ConfigurationLibraryServer(self._library, protocol, self._sources)
             protocol.wait_shutdown()
-        else:
-            # just dump the client connection
-            client.close()
+
+def server_handshake(client, secret):
+    """
+    Check that the client knows the secret and speaks our protocol,
+    client should be a file like object
+
+    Returns True if it does, otherwise the connection is closed
+    """
+    # we send CODE_LENGTH random challenge
+    challenge = ''.join( chr(random.randrange(256)) for x in xrange(CODE_LENGTH) )
+    client.write(challenge)
+    client.flush()
+
+    # the client will use those challenge and its password to come up with a response
+    # followed by the version of the protocol it speaks
+    response = client.read(DIGEST_LENGTH)
+    version = client.read(1)
+    correct = calculate_response(challenge, secret)
+
+    if correct == response and version == chr(PROTOCOL_VERSION):
+        # tell the cilent we are happy
+        client.write('OK')
+        client.flush()
+        return True
+    else:
+        # just dump the client connection
+        client.close()
+        return False
 
 
 def calculate_response(challenge, secret):
@@ -60,23 +89,37 @@ def calculate_response(challenge, secret):
     hasher.update(secret)
     return hasher.digest()
 
-def client_handshake(server, secret):
+def client_handshake(server, secret, **options):
     """
     Connect to the server given the secret
 
     server should be a file like object
     """
+    protocol = client_protocol(server, secret, **options)
+    return DispatcherClient(protocol), ConfigurationLibraryClient(protocol)
+
+def client_protocol(server, secret, heartbeat_interval = None, **options):
+    """
+    Answer the server's challenge, returning the RequestProtocol to talk to it
+
+    server should be a file like object, options are passed along to
+    request_protocol_from_file
+
+    Heartbeats are only sent when heartbeat_interval is given. Workers turn
+    them on, client scripts leave them off so the server doesn't drop them
+    while they are busy with something other than the connection.
+    """
 
     # read the challenge (random bytes)
     challenge = server.read(CODE_LENGTH)
     # send the correct response
     server.write( calculate_response(challenge, secret) )
+    server.write( chr(PROTOCOL_VERSION) )
     server.flush()
     # did the server approve
     response = server.read(2)
     if response == 'OK':
-        protocol = request_protocol_from_file(server)
-        return DispatcherClient(protocol), ConfigurationLibraryClient(protocol)
+        return request_protocol_from_file(server, heartbeat_interval, **options)
     else:
         raise ConnectionLost()
 
@@ -112,13 +155,33 @@ def client_web_connect(address):
     """
     Connect to the given addres which should have a WebServer listening on it
     """
-    print "L"
     socket = eventlet.connect(address).makefile('rw')
     socket.write('GET /pymultinode-client HTTP/1.0\r\n')
     socket.write('\r\n')
     socket.flush()
     return socket
 
-def standard_connect(address, secret):
+def standard_connect(address, secret, **options):
     socket = client_web_connect(address)
-    return client_handshake(socket, secret)
+    return client_handshake(socket, secret, **options)
+
+def reconnect(clients, address, secret, delay = RECONNECT_DELAY,
+        max_delay = RECONNECT_MAX_DELAY, **options):
+    """
+    Keep trying to connect to the server at address until it works, then
+    switch the clients returned by standard_connect over to the new
+    connection
+
+    Each wait is a random part of the delay, so workers which lost the
+    server together don't all come back at the same moment
+    """
+    while True:
+        try:
+            protocol = client_protocol(client_web_connect(address), secret, **options)
+            break
+        except (socket.error, IOError, ConnectionLost):
+            eventlet.sleep( random.uniform(delay / 2, delay) )
+            delay = min(2 * delay, max_delay)
+
+    for client in clients:
+        client._protocol = protocol
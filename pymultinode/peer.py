@@ -0,0 +1,214 @@
+"""
+pymultinode.peer
+
+Workers hand the configurations they have to each other, so that the
+dispatcher does not have to send every configuration to every worker itself.
+
+The dispatcher only keeps track of who has which configuration, and points
+workers at sources which are not already busy serving a few others. The
+configuration spreads out like a tree, so the time to get it to every worker
+grows with the logarithm of their number.
+"""
+from .configuration import Configuration, CachedConfiguration
+from .handshake import server_handshake, client_protocol
+from .protocol import request_protocol_from_file, ConnectionLost, HEARTBEAT_INTERVAL
+from .proxy import ConfigurationLibraryServer, ConfigurationLibraryClient
+import eventlet
+import hashlib
+import socket
+import time
+
+# how long to give a peer to hand over a configuration
+FETCH_TIMEOUT = 60.0
+
+class SourceTracker(object):
+    """
+    The SourceTracker lives alongside the dispatcher and decides where
+    each worker should fetch a configuration from.
+
+    The dispatcher itself is always a source, under the address None.
+    """
+    def __init__(self, fanout = 2, patience = 5.0):
+        """
+        fanout is how many fetches each source serves at once
+
+        patience is how many seconds to wait for a source to be free, after
+        that the configuration is fetched from the dispatcher regardless
+        """
+        self._fanout = fanout
+        self._patience = patience
+        # for each configuration id, how many fetches each source is serving
+        self._sources = {}
+        # sent whenever a source may have become free
+        self._available = eventlet.event.Event()
+
+    def _counts(self, configuration_id):
+        return self._sources.setdefault(configuration_id, {None : 0})
+
+    def locate(self, configuration_id):
+        """
+        Return the address to fetch the configuration from, or None
+        for the dispatcher. Waits for a source to be free.
+        """
+        deadline = time.time() + self._patience
+        while True:
+            counts = self._counts(configuration_id)
+            # prefer the least busy, and workers over the dispatcher
+            source = min(counts, key = lambda address: (counts[address], address is None))
+            if counts[source] < self._fanout:
+                break
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # nobody freed up, the dispatcher will have to do it
+                source = None
+                break
+            with eventlet.Timeout(remaining, False):
+                self._available.wait()
+
+        counts[source] += 1
+        return source
+
+    def fetched(self, configuration_id, source, address, failed = False):
+        """
+        Record that a fetch from source, as returned by locate, has finished
+
+        address is where the worker which fetched it will serve it from,
+        or None if it won't. failed means the source could not be reached
+        """
+        counts = self._counts(configuration_id)
+        if failed and source is not None:
+            # whatever was at that address is gone
+            for others in self._sources.values():
+                others.pop(source, None)
+        elif counts.get(source, 0) > 0:
+            counts[source] -= 1
+
+        if address is not None:
+            counts.setdefault(address, 0)
+
+        available, self._available = self._available, eventlet.event.Event()
+        available.send()
+
+class PeerConfigurations(object):
+    """
+    Hands out the configurations from a worker's ConfigurationCache to other
+    workers, with their contents read back in from the disk
+    """
+    def __init__(self, cache):
+        self._cache = cache
+
+    def get(self, hash):
+        configuration = self._cache.get(hash)
+        if isinstance(configuration, CachedConfiguration):
+            with open(configuration.path, 'rb') as contents:
+                return Configuration(contents.read(), configuration.name)
+        return configuration
+
+class PeerServer(object):
+    """
+    Lets other workers which know the secret fetch configurations from a
+    ConfigurationCache
+    """
+    def __init__(self, cache, secret):
+        self._configurations = PeerConfigurations(cache)
+        self._secret = secret
+
+    def listen(self, host):
+        """
+        Start serving on a free port, returning the address to reach it at
+
+        host is the name other workers should use for this one
+        """
+        listener = eventlet.listen( ('', 0) )
+        eventlet.spawn_n(eventlet.serve, listener, self._connection)
+        return (host, listener.getsockname()[1])
+
+    def _connection(self, client, address):
+        client = client.makefile('rw')
+        if server_handshake(client, self._secret):
+            protocol = request_protocol_from_file(client)
+            ConfigurationLibraryServer(self._configurations, protocol)
+            protocol.wait_shutdown()
+
+def fetch(address, secret, configuration_id, timeout = FETCH_TIMEOUT):
+    """
+    Fetch the configuration from the PeerServer at address
+
+    Raises ConnectionLost if it takes longer than timeout seconds
+    """
+    with eventlet.Timeout(timeout, ConnectionLost('timed out fetching from %r' % (address,))):
+        connection = eventlet.connect(address).makefile('rw')
+        try:
+            protocol = client_protocol(connection, secret,
+                    heartbeat_interval = HEARTBEAT_INTERVAL)
+        except:
+            connection.close()
+            raise
+        try:
+            return ConfigurationLibraryClient(protocol).get(configuration_id)
+        finally:
+            protocol.close()
+
+def genuine(configuration, hash):
+    """
+    Check that what a peer handed us really is the configuration with hash
+    """
+    contents = getattr(configuration, 'contents', None)
+    return contents is not None and hashlib.sha256(contents).digest() == hash
+
+class PeerLibrary(object):
+    """
+    Sits in front of the ConfigurationLibraryClient talking to the dispatcher
+    and fetches configurations from whichever worker the dispatcher says to
+
+    address is where this worker's PeerServer can be reached, if it has one
+    """
+    def __init__(self, library, secret, address = None):
+        self._library = library
+        self._secret = secret
+        self.address = address
+
+    def add(self, configuration):
+        self._library.add(configuration)
+
+    def remove(self, hash):
+        self._library.remove(hash)
+
+    def get(self, hash):
+        source = self._library.locate(hash)
+        configuration = None
+        failed = False
+        # we only hand it out to others if we end up with it
+        address = None
+        try:
+            if source is not None:
+                try:
+                    configuration = fetch(source, self._secret, hash)
+                except (socket.error, ConnectionLost):
+                    # fall back to asking the dispatcher
+                    failed = True
+                else:
+                    if not genuine(configuration, hash):
+                        configuration = None
+                        failed = True
+
+            if configuration is None:
+                configuration = self._library.get(hash)
+            address = self.address
+            return configuration
+        finally:
+            # the source is free again whatever happened
+            self._library.fetched(hash, source, address, failed)
+
+def local_address(address):
+    """
+    Return the address of this host on the network used to reach address
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # nothing is actually sent, this just picks the route
+        probe.connect(address)
+        return probe.getsockname()[0]
+    finally:
+        probe.close()
@@ -3,36 +3,75 @@ pymultinode.process
 
 functions to start different types of processes
 """
-from .configuration import ConfigurationLibrary
+from .configuration import ConfigurationLibrary, ConfigurationCache
 from .dispatcher import Dispatcher
-from .handshake import ConnectionHandler, WebServer, standard_connect
+from .handshake import ConnectionHandler, WebServer, standard_connect, reconnect
 from .web import WebRequestHandler
-from .worker import Worker
+from .worker import Worker, SHARED_MEMORY_THRESHOLD, MAX_SLAVE_MEMORY
+from .protocol import ConnectionLost, HEARTBEAT_INTERVAL
+from .peer import SourceTracker, PeerLibrary, PeerServer, local_address
 from multiprocessing import cpu_count, Process
 import sys
 import os
+import uuid
+
+# how many tasks a remote worker fetches beyond the ones it is running
+PREFETCH_TASKS = 2
+# how many configurations the server keeps before dropping the least
+# recently used
+MAX_CONFIGURATIONS = 64
 
 def server_process(address, secret):
     dispatcher = Dispatcher()
-    library = ConfigurationLibrary()
-    worker = Worker(library)
+    library = ConfigurationLibrary(max_configurations = MAX_CONFIGURATIONS)
+    worker = Worker(library, max_processes = 2 * cpu_count(),
+            shared_memory_threshold = SHARED_MEMORY_THRESHOLD, fork_server = True,
+            max_memory = MAX_SLAVE_MEMORY)
     dispatcher.add_worker(worker, cpu_count() )
-    connection_handler = ConnectionHandler(dispatcher, library, secret)
+    connection_handler = ConnectionHandler(dispatcher, library, secret, SourceTracker())
     web_request_handler = WebRequestHandler(dispatcher)
     web_server = WebServer(web_request_handler.handle_web_request, connection_handler)
     web_server.listen(address)
 
-def unix_worker_process(address, secret):
-    dispatcher, library = standard_connect(address, secret)
-    worker = Worker(library)
-    dispatcher.add_worker(worker, cpu_count())
-    dispatcher._protocol.wait_shutdown()
+def serve_worker(address, secret, dispatcher, library, worker, count, prefetch = 0):
+    """
+    Offer the worker to the dispatcher, reconnecting whenever the connection
+    drops. Tasks which were running carry on as long as we get back before
+    the dispatcher gives up on them.
+
+    prefetch is how many tasks to keep queued up beyond the count running
+    """
+    session = uuid.uuid4().hex
+    while True:
+        try:
+            worker = dispatcher.add_worker(worker, count, session, prefetch)
+            dispatcher._protocol.wait_shutdown()
+        except ConnectionLost:
+            pass
+        print >> sys.stderr, "Lost the connection to the dispatcher"
+        reconnect([dispatcher, library], address, secret,
+                heartbeat_interval = HEARTBEAT_INTERVAL)
+
+def unix_worker_process(address, secret, prefetch = PREFETCH_TASKS):
+    dispatcher, library_client = standard_connect(address, secret,
+            heartbeat_interval = HEARTBEAT_INTERVAL)
+    # other workers can get configurations from us rather than the dispatcher
+    peers = PeerLibrary(library_client, secret)
+    library = ConfigurationCache(peers)
+    peers.address = PeerServer(library, secret).listen( local_address(address) )
+    worker = Worker(library, max_processes = 2 * cpu_count(),
+            shared_memory_threshold = SHARED_MEMORY_THRESHOLD, fork_server = True,
+            max_memory = MAX_SLAVE_MEMORY)
+    library.in_use = worker.configurations_in_use
+    serve_worker(address, secret, dispatcher, library_client, worker, cpu_count(), prefetch)
 
 def single_worker_process(address, secret):
-    dispatcher, library = standard_connect(address, secret)
-    worker = Worker(library)
-    dispatcher.add_worker(worker, 1)
-    dispatcher._protocol.wait_shutdown()
+    dispatcher, library_client = standard_connect(address, secret,
+            heartbeat_interval = HEARTBEAT_INTERVAL)
+    library = ConfigurationCache(library_client)
+    worker = Worker(library, max_processes = 2)
+    library.in_use = worker.configurations_in_use
+    serve_worker(address, secret, dispatcher, library_client, worker, 1)
 
 
 def win32_worker_process(address, secret):
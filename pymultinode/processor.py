@@ -2,30 +2,255 @@
 The Processor is the part of the system which the user will directly interact
 with. It provides an interface to make requests which will be sent off
 """
-from serialization import dumps
+from serialization import dumps_out_of_band
 import functools
+import itertools
+import collections
 import eventlet
-from .worker import evaluate_result
+from .worker import evaluate_result, TaskChunk
+from .future import CancelledError, TimeoutError
 
 def decode_response(event):
     description = event.wait()
     return evaluate_result(description)
 
+class TaskFuture(object):
+    """
+    A Future for the result of a task submitted through a Processor
+
+    It wraps the Future holding the raw response from the dispatcher, and
+    only decodes the response the first time somebody asks for it.
+    """
+    def __init__(self, response):
+        self._response = response
+        self._outcome = None
+
+    def done(self):
+        return self._response.done()
+
+    def cancelled(self):
+        return self._response.cancelled()
+
+    def cancel(self):
+        """
+        Cancel the task, returns False if it has already finished
+        """
+        return self._response.cancel()
+
+    def _decode(self, timeout):
+        if self._outcome is None:
+            description = self._response.result(timeout)
+            try:
+                self._outcome = True, evaluate_result(description)
+            except Exception as error:
+                self._outcome = False, error
+        return self._outcome
+
+    def result(self, timeout = None):
+        """
+        Return the value returned by the task, or raise what it raised
+        """
+        success, value = self._decode(timeout)
+        if success:
+            return value
+        else:
+            raise value
+
+    def exception(self, timeout = None):
+        """
+        Return the exception raised by the task, or None
+        """
+        try:
+            success, value = self._decode(timeout)
+        except (CancelledError, TimeoutError):
+            raise
+        except Exception as error:
+            # the task never made it back, ConnectionLost for example
+            return error
+        if success:
+            return None
+        else:
+            return value
+
+    def wait(self):
+        return self.result()
+
+    def add_done_callback(self, callback):
+        """
+        callback will be called with this future once the task finishes
+        """
+        self._response.add_done_callback(lambda response: callback(self))
+
+class FixedChunkSize(object):
+    """
+    Always chunk tasks into the same size
+    """
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('chunksize must be at least 1')
+        self.size = size
+
+    def record(self, count, elapsed):
+        pass
+
+class AdaptiveChunkSize(object):
+    """
+    Picks the chunk size based on how long the chunks actually took to run
+    in the slaves. The size is chosen so that each chunk takes about target
+    seconds of work, which keeps the per task overhead small in comparison
+    while still leaving enough chunks to spread around the workers.
+    """
+    def __init__(self, target = 0.1, maximum = 4096):
+        self.target = target
+        self.maximum = maximum
+        self.size = 1
+
+    def record(self, count, elapsed):
+        """
+        Note that count tasks took elapsed seconds of work
+        """
+        if elapsed * 2 < self.target:
+            # we have no good estimate for very short chunks
+            # so just grow until we get one
+            size = self.size * 2
+        else:
+            size = int(self.target * count / elapsed)
+            # don't let a single measurement swing things too far
+            size = min(size, self.size * 2)
+        self.size = max(1, min(size, self.maximum))
+
+def chunk_sizer(chunksize):
+    """
+    Return the object responsible for picking the chunk sizes
+    chunksize should either be a number or 'auto'
+    """
+    if chunksize == 'auto':
+        return AdaptiveChunkSize()
+    else:
+        return FixedChunkSize(chunksize)
+
+def iterate_chunks(arguments, sizer):
+    """
+    Split the arguments iterator into lists whose sizes are given by sizer
+
+    The size is picked when each chunk is actually needed so adjustments
+    made by the sizer take effect right away
+    """
+    while True:
+        chunk = list(itertools.islice(arguments, sizer.size))
+        if not chunk:
+            return
+        yield chunk
+
+def chunk_timeout(timeout, count):
+    """
+    The timeout for a chunk of count tasks which may each take timeout seconds
+    """
+    if timeout is None:
+        return None
+    return timeout * count
+
+# the options which control how individual tasks are run
+TASK_OPTIONS = ('timeout', 'speculative', 'priority', 'weight')
+
+def check_weight(weight):
+    if weight <= 0:
+        raise ValueError('weight must be positive, not %r' % (weight,))
+
+def task_options(defaults, options):
+    """
+    Take the task options out of the dictionary options, returning them
+    with anything not given taken from defaults
+    """
+    chosen = dict(defaults)
+    for name in TASK_OPTIONS:
+        if name in options:
+            chosen[name] = options.pop(name)
+    check_weight(chosen['weight'])
+    return chosen
+
+def unchunk(outcomes):
+    """
+    Take the outcomes of a TaskChunk and produce the values, raising the
+    first error at the point it occurred
+    """
+    for success, value in outcomes:
+        if success:
+            yield value
+        else:
+            raise value
+
 class Processor(object):
     """
     The processor connects to a dispatcher and uses it to perform tasks
     """
-    def __init__(self, configuration_id, dispatcher):
+    def __init__(self, configuration_id, dispatcher, max_in_flight = 1000, timeout = None,
+            speculative = False, priority = 0, weight = 1.0):
         """
         The configuration_id should be the hash of a configuration
         which is properly registered. The dispatcher should be a Dispatcher
         object
+
+        max_in_flight limits how many tasks each of the iterating methods will
+        have submitted and not yet returned at any one time
+
+        Tasks running for more than timeout seconds are killed and raise
+        a TimeoutError instead of returning
+
+        If speculative is True, the dispatcher may run a second copy of a
+        task which is taking much longer than usual, and use whichever
+        finishes first. Only use it for tasks which can safely run twice.
+
+        Waiting tasks with a higher priority are run before those with a
+        lower one. Among tasks of the same priority, each processor's share
+        of the workers is in proportion to its weight, so a small
+        interactive job isn't stuck behind a large batch of work.
         """
+        check_weight(weight)
         self._configuration_id = configuration_id
         self._dispatcher = dispatcher
+        self._max_in_flight = max_in_flight
+        self._options = {
+            'timeout' : timeout,
+            'speculative' : speculative,
+            'priority' : priority,
+            'weight' : weight
+        }
 
-        # we keep a pool of green threads around
-        self._pool = eventlet.GreenPool()
+    def _describe(self, task, args, kwargs):
+        """
+        Produce the string sent over to the worker for the task
+        """
+        # I can't partial without arguments, so I protect it here
+        if args or kwargs:
+            task = functools.partial(task, *args, **kwargs)
+
+        # everything is transfered as a string from here to worker
+        # except for large arrays which are sent from their own memory
+        return dumps_out_of_band(task)
+
+    def _send(self, task_description, options, count = 1):
+        """
+        Hand the task to the dispatcher, returning the Future for its response
+        options are the task options, and count is how many elements of
+        an iteration the task covers
+        """
+        return self._dispatcher.do_task(self._configuration_id, task_description,
+                timeout = chunk_timeout(options['timeout'], count),
+                speculative = options['speculative'],
+                priority = options['priority'], weight = options['weight'], count = count)
+
+    def with_options(self, **options):
+        """
+        Return a Processor like this one whose tasks have the given options,
+        the same ones as the constructor takes: timeout, speculative,
+        priority and weight
+        """
+        chosen = task_options(self._options, options)
+        if options:
+            raise TypeError('unexpected options: %s' % ', '.join(options))
+        return Processor(self._configuration_id, self._dispatcher,
+                self._max_in_flight, **chosen)
 
     def request(self, task, *args, **kwargs):
         """
@@ -35,28 +260,155 @@ class Processor(object):
         returns a eventlet event function, call .wait() on this to obtain
         the result or raise the exception
         """
-        # I can't partial without arguments, so I protect it here
-        if args or kwargs:
-            task = functools.partial(task, *args, **kwargs)
-
-        # everything is transfered as a string from here to worker
-        task_description = dumps(task)
+        task_description = self._describe(task, args, kwargs)
 
         # the dispatcher does the actual interesting work
-        dispatcher_event = self._dispatcher.do_task(self._configuration_id, task_description)
+        dispatcher_event = self._send(task_description, self._options)
         return eventlet.spawn(decode_response, dispatcher_event)
 
-    def imap(self, task, *iterables):
+    def submit(self, task, *args, **kwargs):
+        """
+        Like request, but returns a TaskFuture rather than starting
+        a green thread to wait for the result
+        """
+        task_description = self._describe(task, args, kwargs)
+        response = self._send(task_description, self._options)
+        return TaskFuture(response)
+
+    def _iteration_options(self, options):
+        """
+        Extract the options accepted by imap and imap_unordered
+        returns the chunksize, the max_in_flight and the task options
+        """
+        chunksize = options.pop('chunksize', 1)
+        max_in_flight = options.pop('max_in_flight', self._max_in_flight)
+        chosen = task_options(self._options, options)
+        if options:
+            raise TypeError('unexpected options: %s' % ', '.join(options))
+        return chunksize, max_in_flight, chosen
+
+    def imap(self, task, *iterables, **options):
         """
         Iterate in parallel (ala zip) over all the iterables
         dispatchting calling task on them
+
+        The chunksize option sends that many elements to a slave as a single
+        task, which helps a lot when the individual tasks are tiny. Passing
+        chunksize = 'auto' picks the size based on how long the tasks take.
+
+        The max_in_flight, timeout, speculative, priority and weight options
+        override the ones given to the constructor. With chunks, each chunk gets the timeout for
+        every element in it added together.
+
+        Closing the iterator, or dropping it, cancels the tasks which have
+        not finished yet, so stopping early does not waste the workers' time.
+        """
+        chunksize, max_in_flight, chosen = self._iteration_options(options)
+        arguments = itertools.izip(*iterables)
+
+        if chunksize == 1:
+            return self._ordered(self._launcher(task, chosen), arguments, max_in_flight)
+        else:
+            sizer = chunk_sizer(chunksize)
+            return self._chunked(self._ordered, task, arguments, sizer, max_in_flight, chosen)
+
+    def imap_unordered(self, task, *iterables, **options):
+        """
+        Like imap, but the results are produced as soon as they finish
+        rather than in the order of the iterables.
+
+        Takes the same options as imap. Only max_in_flight elements (or
+        chunks) are pulled from the iterables ahead of the results actually
+        being consumed.
+        """
+        chunksize, max_in_flight, chosen = self._iteration_options(options)
+        arguments = itertools.izip(*iterables)
+
+        if chunksize == 1:
+            return self._unordered(self._launcher(task, chosen), arguments, max_in_flight)
+        else:
+            sizer = chunk_sizer(chunksize)
+            return self._chunked(self._unordered, task, arguments, sizer, max_in_flight, chosen)
+
+    def _launcher(self, task, chosen):
+        """
+        Return a function submitting task with the given arguments
+        """
+        return lambda args: TaskFuture( self._send(self._describe(task, args, {}), chosen) )
+
+    def _chunked(self, window, task, arguments, sizer, max_in_flight, chosen):
+        """
+        Implements imap and imap_unordered by sending the arguments over in
+        chunks, window is either _ordered or _unordered
         """
-        def spawner(*args):
-            k = self.request(task, *args)
-            r = k.wait()
-            return r
+        def launch(chunk):
+            description = self._describe(TaskChunk(task, chunk), (), {})
+            return TaskFuture( self._send(description, chosen, len(chunk)) )
 
-        return self._pool.imap(spawner, *iterables)
+        results = window(launch, iterate_chunks(arguments, sizer), max_in_flight)
+        try:
+            for elapsed, outcomes in results:
+                sizer.record(len(outcomes), elapsed)
+                for value in unchunk(outcomes):
+                    yield value
+        finally:
+            results.close()
+
+    def _ordered(self, launch, arguments, max_in_flight):
+        """
+        Call launch on each element of arguments, keeping at most
+        max_in_flight of the resulting futures outstanding. Produces their
+        results in the order of the arguments.
+
+        Closing the generator, or dropping it, cancels the tasks which
+        have not finished yet.
+        """
+        in_flight = collections.deque()
+        try:
+            for args in itertools.islice(arguments, max_in_flight):
+                in_flight.append( launch(args) )
+
+            while in_flight:
+                result = in_flight[0].result()
+                in_flight.popleft()
+                for args in itertools.islice(arguments, 1):
+                    in_flight.append( launch(args) )
+                yield result
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def _unordered(self, launch, arguments, max_in_flight):
+        """
+        Call launch on each element of arguments, keeping at most
+        max_in_flight of the resulting futures unfinished. Produces their
+        results in the order they finish.
+
+        Closing the generator, or dropping it, cancels the tasks which
+        have not finished yet.
+        """
+        finished = eventlet.queue.LightQueue()
+        in_flight = set()
+
+        def launched(args):
+            future = launch(args)
+            in_flight.add(future)
+            future.add_done_callback(finished.put)
+
+        try:
+            for args in itertools.islice(arguments, max_in_flight):
+                launched(args)
+
+            while in_flight:
+                future = finished.get()
+                in_flight.discard(future)
+                # top up the window before handing the result over
+                for args in itertools.islice(arguments, 1):
+                    launched(args)
+                yield future.result()
+        finally:
+            for future in in_flight:
+                future.cancel()
 
     def repeat(self, times, *args, **kwargs):
         """
@@ -64,8 +416,6 @@ class Processor(object):
 
         Intended to be used for monte carlo
         """
-        def spawner(idx):
-            return self.request(*args, **kwargs).wait()
-
-        return self._pool.imap(spawner, xrange(times))
+        launch = lambda idx: self.submit(*args, **kwargs)
+        return self._ordered(launch, iter(xrange(times)), self._max_in_flight)
 
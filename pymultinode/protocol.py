@@ -4,8 +4,11 @@ pymultinode.protocol
 This code provides the basic protocol which is used to communicate
 """
 import struct
+import pickle
+import time
 import eventlet
 import socket
+from .future import Future
 
 class CommandCodes:
     Response = 'R'
@@ -15,69 +18,344 @@ class CommandCodes:
     WorkerTask = 'W'
     AddWorker = 'C'
     DispatchTask = 'T'
+    PrespawnWorker = 'P'
+    MissingFiles = 'M'
+    AddFiles = 'F'
+    AddManifest = 'N'
+    LocateConfiguration = 'L'
+    ConfigurationFetched = 'O'
+    CancelTask = 'X'
+    CancelWorkerTask = 'K'
+    ErrorResponse = 'E'
+    Heartbeat = 'H'
+    StealWorkerTask = 'S'
+    WorkerWarm = 'Y'
 
 class ConnectionLost(Exception):
     pass
 
-MESSAGE_HEADER = struct.Struct('!cLL')
+# bumped whenever the format of the messages changes
+PROTOCOL_VERSION = 13
+
+MESSAGE_HEADER = struct.Struct('!cBLQ')
+TOTAL_LENGTH = struct.Struct('!Q')
+
+class FrameFlags:
+    # more frames of the same message follow this one
+    More = 1
+    # the data of this frame starts with the total length of the message
+    Sized = 2
+
+# messages larger than this are split up into several frames
+FRAME_SIZE = 256 * 1024
+# how much of a large frame is read in one go
+READ_SIZE = 64 * 1024
+# messages no larger than this never wait for room in the send queue, so
+# cancels, small responses and heartbeats aren't stuck behind large ones
+SMALL_MESSAGE = 4 * 1024
+
+# connections made by request_protocol_from_file send a heartbeat this often
+# and, once the other side has sent one too, are dropped after hearing
+# nothing for this many heartbeats
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_MISSES = 3
+
+def as_string(data):
+    """
+    Return the contents of anything supporting the buffer interface as a string
+    """
+    if isinstance(data, str):
+        return data
+    else:
+        return buffer(data)[:]
+
 class Protocol(object):
     """
     The Protocol used to communicate
 
-    Each message consists of:
+    Each frame consists of:
         command code - 1 byte
+        flags - 1 byte
         sequence number - 4 bytes
-        length - 4 bytes
+        length - 8 bytes
 
         data - n bytes
 
+    Messages larger than FRAME_SIZE are split across several frames with the
+    same command code and sequence number, all but the last of which have
+    the More flag set. The first of those frames has the Sized flag and its
+    data starts with the 8 byte total length, so the reader can allocate the
+    whole buffer up front and fill it in as the frames come in. Frames from
+    other messages may be sent in between so a large message doesn't hold
+    up everything else. Sending only waits for room in the queue for
+    messages larger than SMALL_MESSAGE, so small ones still get through
+    while a large one is being written out.
+
+    Messages are not written out right away. They are queued up and a
+    separate green thread writes everything that has been queued in a single
+    write, so that bursts of small messages don't turn into a burst of
+    system calls.
     """
-    def __init__(self, file):
+    def __init__(self, file, max_delay = 0, max_buffer = 64 * 1024,
+            max_pending = 4 * 1024 * 1024):
+        """
+        max_delay is how long in seconds a message may be held back waiting
+        for more messages to write along with it, unless max_buffer bytes
+        are already waiting. Once max_pending bytes are waiting, send will
+        block until they have been written out, unless the message is no
+        larger than SMALL_MESSAGE.
+        """
         self._file = file
         self._lock = eventlet.semaphore.Semaphore()
+        self._max_delay = max_delay
+        self._max_buffer = max_buffer
+        self._max_pending = max_pending
+
+        self._pending = []
+        # large messages still being split up into frames
+        # each is a list of command, sequence, data, offset
+        self._streams = []
+        self._pending_size = 0
+        self._writer = None
+        self._full = eventlet.event.Event()
+        self._drained = eventlet.event.Event()
+        # the error which stopped the writer, if any
+        self._error = None
+
+        # messages which have been partially read, by command and sequence
+        self._partial = {}
+        # when the last frame started coming in
+        self.last_heard = time.time()
 
     def close(self):
         """
         Close the connection
         """
+        self.flush()
         self._file.close()
 
+    def abort(self):
+        """
+        Give up on the connection without writing out what is still queued,
+        which might never go through
+        """
+        self._error = socket.error('connection aborted')
+        self._pending = []
+        self._streams = []
+        # shutting down the socket wakes up anybody still reading or writing
+        sock = getattr(self._file, '_sock', None)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
+            pass
+
     def send(self, command, sequence, data):
         """
-        Transmit the message over the wire
+        Queue the message to be transmitted over the wire
+
+        data may be a string or anything else supporting the buffer
+        interface. It can also be a list of those, which will be sent one
+        after the other as a single message without being joined first.
+        """
+        if self._error is not None:
+            raise self._error
+
+        if isinstance(data, (list, tuple)):
+            pieces = list(data)
+        else:
+            pieces = [data]
+        length = sum(len(piece) for piece in pieces)
+
+        while self._pending_size >= self._max_pending and length > SMALL_MESSAGE:
+            self._drained.wait()
+            if self._error is not None:
+                raise self._error
+
+        if command == CommandCodes.Heartbeat:
+            # heartbeats go ahead of everything queued, so they still get
+            # through while a large message is being written out
+            self._pending[:0] = [MESSAGE_HEADER.pack(command, 0, sequence, length)] + pieces
+            self._pending_size += MESSAGE_HEADER.size + length
+        elif length <= FRAME_SIZE:
+            self._pending.append( MESSAGE_HEADER.pack(command, 0, sequence, length) )
+            self._pending.extend(pieces)
+            self._pending_size += MESSAGE_HEADER.size + length
+        else:
+            self._streams.append( [command, sequence, pieces, length, 0] )
+            self._pending_size += length
+
+        if self._writer is None:
+            self._writer = eventlet.spawn(self._write_pending)
+        elif self._pending_size >= self._max_buffer and not self._full.ready():
+            self._full.send()
+
+    def _next_frames(self):
+        """
+        Move the next frame of each of the large messages onto the pending list
+        """
+        for stream in list(self._streams):
+            command, sequence, pieces, length, offset = stream
+
+            # gather up the next FRAME_SIZE bytes from the pieces
+            chunk = []
+            size = 0
+            while pieces and size < FRAME_SIZE:
+                piece = buffer(pieces[0], 0, FRAME_SIZE - size)
+                if len(piece) == len(pieces[0]):
+                    pieces.pop(0)
+                else:
+                    pieces[0] = buffer(pieces[0], len(piece))
+                chunk.append(piece)
+                size += len(piece)
+
+            flags = 0
+            if offset == 0:
+                flags |= FrameFlags.Sized
+                chunk.insert(0, TOTAL_LENGTH.pack(length) )
+                self._pending_size += TOTAL_LENGTH.size
+            stream[4] = offset = offset + size
+            if offset < length:
+                flags |= FrameFlags.More
+            else:
+                self._streams.remove(stream)
+
+            frame_length = sum(len(piece) for piece in chunk)
+            self._pending.append( MESSAGE_HEADER.pack(command, flags, sequence, frame_length) )
+            self._pending.extend(chunk)
+            self._pending_size += MESSAGE_HEADER.size
+
+    def _write_pending(self):
+        """
+        The writer thread, gives a chance for more messages to be queued
+        and then writes them all
+        """
+        try:
+            # just being scheduled gave the chance to queue more messages
+            # so only wait if asked to
+            if self._max_delay and self._pending_size < self._max_buffer:
+                self._full = eventlet.event.Event()
+                with eventlet.Timeout(self._max_delay, False):
+                    self._full.wait()
+            self.flush()
+        finally:
+            self._writer = None
+
+    def flush(self):
+        """
+        Write out all of the queued messages now
         """
-        encoded = MESSAGE_HEADER.pack(command, sequence, len(data) )
         with self._lock:
-            self._file.write( encoded )
-            self._file.write(data)
+            while (self._pending or self._streams) and self._error is None:
+                self._next_frames()
+                pending, self._pending = self._pending, []
+                self._pending_size -= sum(len(piece) for piece in pending)
+                try:
+                    self._write(pending)
+                    self._file.flush()
+                except (socket.error, IOError) as error:
+                    # the next send will report it
+                    self._error = error
+
+                # wake up anybody waiting for room
+                drained, self._drained = self._drained, eventlet.event.Event()
+                drained.send()
+
+    def _write(self, pieces):
+        """
+        Write out the pieces, joining up runs of small ones so that a burst
+        of small messages is still a single write. Larger pieces are written
+        by themselves rather than copied into a string with the rest.
+        """
+        small = []
+        for piece in pieces:
+            if len(piece) <= SMALL_MESSAGE:
+                small.append( as_string(piece) )
+                continue
+            if small:
+                self._file.write( ''.join(small) )
+                small = []
+            # a buffered socket file joins the piece with whatever it is
+            # still holding, so it has to be empty first
             self._file.flush()
+            if isinstance(piece, str):
+                self._file.write(piece)
+            else:
+                self._file.write( buffer(piece) )
+        if small:
+            self._file.write( ''.join(small) )
+
+    def _read_into(self, buffer, offset, length):
+        """
+        Read length bytes into the buffer at offset, a piece at a time so
+        that no copy of the whole thing is ever made.
+        Returns False if the connection closed first
+        """
+        end = offset + length
+        while offset < end:
+            data = self._file.read( min(READ_SIZE, end - offset) )
+            if not data:
+                return False
+            buffer[offset:offset + len(data)] = data
+            offset += len(data)
+        return True
 
     def wait(self):
         """
         Return a single message from the wire possibly waiting for it
 
+        Messages which came in several frames are returned as a bytearray
+        rather than a string.
+
         if this function returns None, the connection has been closed
         """
-        encoded = self._file.read( MESSAGE_HEADER.size )
-        # if we ever cannot read the full amount
-        # we have closed in the middle of the connection
-        # report it as a lost connection
-        if len(encoded) != MESSAGE_HEADER.size:
-            return None
+        while True:
+            encoded = self._file.read( MESSAGE_HEADER.size )
+            # if we ever cannot read the full amount
+            # we have closed in the middle of the connection
+            # report it as a lost connection
+            if len(encoded) != MESSAGE_HEADER.size:
+                return None
+            # a large message may take a while, but it is still coming
+            self.last_heard = time.time()
+
+            command, flags, sequence, length = MESSAGE_HEADER.unpack(encoded)
+            key = command, sequence
+
+            if key not in self._partial:
+                if not flags & FrameFlags.Sized:
+                    # a message in a single frame
+                    data = self._file.read(length)
+                    # only report success if all data is there
+                    if len(data) != length:
+                        return None
+                    return command, sequence, data
 
-        command, sequence, length = MESSAGE_HEADER.unpack(encoded)
-        data = self._file.read(length)
-        # only report success if all data is there
-        if len(data) != length:
-            return None
-        return command, sequence, data
+                encoded = self._file.read(TOTAL_LENGTH.size)
+                if len(encoded) != TOTAL_LENGTH.size:
+                    return None
+                length -= TOTAL_LENGTH.size
+                self._partial[key] = [bytearray(TOTAL_LENGTH.unpack(encoded)[0]), 0]
+
+            buffer, offset = self._partial[key]
+            if offset + length > len(buffer):
+                # the frames don't add up, nothing can be trusted anymore
+                return None
+            if not self._read_into(buffer, offset, length):
+                return None
+            self._partial[key][1] = offset + length
+
+            if not flags & FrameFlags.More:
+                del self._partial[key]
+                if offset + length != len(buffer):
+                    return None
+                return command, sequence, buffer
 
 class RequestProtocol(object):
     """
     The RequestProtocol builds on the Protocol to provide support for
     requests.
     """
-    def __init__(self, protocol):
+    def __init__(self, protocol, heartbeat_interval = None, heartbeat_misses = HEARTBEAT_MISSES):
         """
         Construcst a RequestProtocol
 
@@ -86,17 +364,34 @@ class RequestProtocol(object):
             command code, sequence, data
         these will indicate request that come over the wire.
         When the connection closes these will be called with all Nones
+
+        If heartbeat_interval is given, a heartbeat is sent that many seconds
+        apart. Once a heartbeat has come from the other side, the connection
+        is dropped if nothing at all comes from it for heartbeat_misses
+        intervals. A side which never sends heartbeats, like a client script
+        which may keep the hub busy for a long time, is never dropped.
         """
         self._protocol = protocol
         self._counter = 0
         self._events = {}
         self._alive = True
         self._handlers = {}
+        # whether the other side sends heartbeats, so it can be expected to
+        self._beating = False
         self._thread= eventlet.spawn(self._process)
+        self._heartbeat = None
+        if heartbeat_interval is not None:
+            self._heartbeat = eventlet.spawn(self._beat, heartbeat_interval, heartbeat_misses)
 
     def register_handler(self, command, callback):
         self._handlers[command] = callback
 
+    def connected(self):
+        """
+        Return False once the connection has been lost
+        """
+        return self._alive
+
     def _cleanup(self):
         self._alive = False
         for event in self._events.values():
@@ -107,50 +402,92 @@ class RequestProtocol(object):
         This thread takes care of reading the message and dealing
         with them
         """
+        try:
+            self._read_messages()
+        except ConnectionLost:
+            # the connection was dropped, by the heartbeat for example
+            pass
+        finally:
+            self._cleanup()
+
+    def _read_messages(self):
+        """
+        Deal with messages until the connection is closed
+        """
         while True:
             result = self._protocol.wait()
             # result = None indicates that the connection is
             # closed
             if result is None:
-                self._cleanup()
                 break
 
             command, sequence, data  = result
             # for responses we signal the events
             # otherwise we allow the callback to worry about it
-            if command == CommandCodes.Response:
-                event = self._events.pop(sequence)
-                event.send(data)
+            if command == CommandCodes.Heartbeat:
+                self._beating = True
+            elif command == CommandCodes.Response:
+                # there is nobody waiting for responses to cancelled requests
+                event = self._events.pop(sequence, None)
+                if event is not None:
+                    event.send(data)
+            elif command == CommandCodes.ErrorResponse:
+                event = self._events.pop(sequence, None)
+                if event is not None:
+                    event.send_exception( pickle.loads(as_string(data)) )
             else:
-                try:
-                    self._handlers[command](command, sequence, data)
-                except KeyError:
+                handler = self._handlers.get(command)
+                if handler is None:
                     # drop anybody who tries bad commands
                     self.close()
+                else:
+                    handler(command, sequence, data)
 
-
-    def request(self, command, data):
+    def request(self, command, data, cancel = None):
         """
         Make a request of type command with data
+
+        Returns a Future which will hold the response. If cancel is given,
+        cancelling the Future sends the command cancel with the same
+        sequence number so the other side can stop working on it.
         """
         if not self._alive:
             raise ConnectionLost()
         request_id = self._counter
         self._counter += 1
 
-        event = eventlet.event.Event()
+        event = Future()
         self._events[request_id] = event
 
         self._send(command, request_id, data)
 
+        if cancel is not None:
+            event.add_done_callback(lambda event: self._cancelled(event, request_id, cancel))
         return event
 
+    def _cancelled(self, event, sequence, command):
+        """
+        Called when a request which can be cancelled finishes
+        """
+        if event.cancelled() and self._events.pop(sequence, None) is not None:
+            try:
+                self._send(command, sequence, '')
+            except ConnectionLost:
+                pass
+
     def respond(self, sequence, data):
         """
         Send a response to a previous request
         """
         self._send(CommandCodes.Response, sequence, data)
 
+    def respond_exception(self, sequence, exception):
+        """
+        Respond to a previous request with an exception, which is raised
+        for whoever is waiting on the response
+        """
+        self._send(CommandCodes.ErrorResponse, sequence, pickle.dumps(exception, 2))
+
     def command(self, command, data):
         """
         Submit a command
@@ -166,25 +503,58 @@ class RequestProtocol(object):
             raise ConnectionLost()
 
 
+    def _beat(self, interval, misses):
+        """
+        The heartbeat thread, keeps telling the other side we are here and
+        checks that it is doing the same
+        """
+        while self._alive:
+            eventlet.sleep(interval)
+            if not self._alive:
+                break
+            if self._beating and time.time() - self._protocol.last_heard > interval * misses:
+                self._abort()
+                break
+            # don't get stuck behind a connection which isn't going anywhere
+            with eventlet.Timeout(interval, False):
+                try:
+                    self._send(CommandCodes.Heartbeat, 0, '')
+                except ConnectionLost:
+                    pass
+
+    def _abort(self):
+        """
+        Drop the connection right away, everybody waiting on a response
+        gets a ConnectionLost
+        """
+        self._protocol.abort()
+        self._thread.kill( ConnectionLost() )
+
     def close(self):
         """
         Close the connection
         """
+        if self._heartbeat is not None:
+            self._heartbeat.kill()
         self._protocol.close()
 
     def wait_shutdown(self):
         self._thread.wait()
 
 
-def request_protocol_from_file(file):
+def request_protocol_from_file(file, heartbeat_interval = HEARTBEAT_INTERVAL,
+        heartbeat_misses = HEARTBEAT_MISSES, **options):
     """
-    Construct a protocol talking to a file
+    Construct a protocol talking to a file, with heartbeats unless
+    heartbeat_interval is None
+
+    other options are passed along to the Protocol
     """
-    protocol = Protocol(file)
-    return RequestProtocol(protocol)
+    protocol = Protocol(file, **options)
+    return RequestProtocol(protocol, heartbeat_interval, heartbeat_misses)
 
-def request_protocol_from_socket(socket):
+def request_protocol_from_socket(socket, **options):
     """
     Construct a protocol talking to a socket
     """
-    return request_protocol_from_file( socket.makefile('rw') )
+    return request_protocol_from_file( socket.makefile('rw'), **options )
@@ -1,32 +1,128 @@
-from .protocol import CommandCodes
-from .serialization import dumps
+from .protocol import CommandCodes, ConnectionLost
+from .serialization import dumps, as_pieces
+from .future import CancelledError
+from .worker import SlaveCrashed
+from .dispatcher import TaskStolen
 from pickle import loads
+from greenlet import GreenletExit
 import eventlet
+import eventlet.semaphore
+import itertools
+import struct
+import uuid
+
+TASK_HEADER = struct.Struct('!H')
+# tells apart the clients submitting tasks, so they get a fair share each
+CLIENT_IDS = itertools.count()
+# how long a worker which lost its connection has to come back before the
+# tasks it was running are given to somebody else
+RESUME_TIMEOUT = 30.0
+
+def encode_task(configuration_id, task, options = None):
+    """
+    Produce the message describing a task as a list of pieces
+
+    The message is a small header giving the length of the pickled
+    configuration id and options, those, and then the task itself
+    which is never touched, so it can be passed along without copying it.
+    The task may itself be a list of pieces.
+
+    options is a dictionary of keyword arguments for do_task, like timeout
+    """
+    encoded_id = dumps( (configuration_id, options or {}) )
+    return [TASK_HEADER.pack(len(encoded_id)), encoded_id] + as_pieces(task)
+
+def decode_task(data):
+    """
+    Split a message produced by encode_task back into the configuration id,
+    the task and the options. Large tasks come back as a buffer looking into
+    the message rather than a copy of it.
+    """
+    length, = TASK_HEADER.unpack_from(data)
+    start = TASK_HEADER.size + length
+    configuration_id, options = loads( str(buffer(data, TASK_HEADER.size, length)) )
+    if isinstance(data, str):
+        # small messages come in as strings, and copying those is cheap
+        task = data[start:]
+    else:
+        task = buffer(data, start)
+    return configuration_id, task, options
 
 class ConfigurationLibraryServer(object):
     """
     Connect an instance of Configuration library to a protocol
     so that it can be controlled by client
     """
-    def __init__(self, library, protocol):
+    def __init__(self, library, protocol, sources = None):
+        """
+        sources is the SourceTracker used to tell workers where to get
+        configurations from, without one they always get them from here
+        """
         self._library = library
         self._protocol = protocol
+        self._sources = sources
         
         protocol.register_handler( CommandCodes.AddConfiguration, self.add )
         protocol.register_handler( CommandCodes.GetConfiguration, self.get )
         protocol.register_handler( CommandCodes.RemoveConfiguration, self.remove )
+        protocol.register_handler( CommandCodes.MissingFiles, self.missing_files )
+        protocol.register_handler( CommandCodes.AddFiles, self.add_files )
+        protocol.register_handler( CommandCodes.AddManifest, self.add_manifest )
+        protocol.register_handler( CommandCodes.LocateConfiguration, self.locate )
+        protocol.register_handler( CommandCodes.ConfigurationFetched, self.fetched )
 
     def add(self, command, sequence, data):
         self._library.add( loads(data) )
 
+    def missing_files(self, command, sequence, data):
+        missing = self._library.missing_files( loads(data) )
+        self._protocol.respond(sequence, dumps(missing))
+
+    def add_files(self, command, sequence, data):
+        try:
+            self._library.add_files( loads(data) )
+        except ValueError as error:
+            self._protocol.respond_exception(sequence, error)
+        else:
+            self._protocol.respond(sequence, dumps(None))
+
+    def add_manifest(self, command, sequence, data):
+        name, manifest, hash = loads(data)
+        try:
+            self._library.add_manifest(name, manifest, hash)
+        except (KeyError, ValueError) as error:
+            # a file we were never given, or something which didn't match
+            self._protocol.respond_exception(sequence, error)
+        else:
+            self._protocol.respond(sequence, dumps(None))
+
     def get(self, command, sequence, data):
-        result = self._library.get(data)
+        try:
+            result = self._library.get(data)
+        except KeyError as error:
+            self._protocol.respond_exception(sequence, error)
+            return
         encoded_result = dumps(result)
         self._protocol.respond(sequence, encoded_result)
 
     def remove(self, command, sequence, data):
         self._library.remove(data)
 
+    def locate(self, command, sequence, data):
+        if self._sources is None:
+            self._protocol.respond(sequence, dumps(None))
+            return
+
+        # finding a source may mean waiting for one to be free
+        def inner():
+            source = self._sources.locate( loads(data) )
+            self._protocol.respond(sequence, dumps(source))
+        eventlet.spawn_n(inner)
+
+    def fetched(self, command, sequence, data):
+        if self._sources is not None:
+            self._sources.fetched( *loads(data) )
+
 
 
 
@@ -39,7 +135,25 @@ class ConfigurationLibraryClient(object):
         self._protocol = protocol
 
     def add(self, configuration):
-        self._protocol.command( CommandCodes.AddConfiguration, dumps(configuration) )
+        """
+        Add the configuration. If it has a manifest, only the files the
+        other side does not have already are sent over and it puts the
+        configuration back together.
+        """
+        manifest = getattr(configuration, 'manifest', None)
+        if manifest is None:
+            self._protocol.command( CommandCodes.AddConfiguration, dumps(configuration) )
+            return
+
+        hashes = list( set(hash for filename, hash in manifest) )
+        event = self._protocol.request( CommandCodes.MissingFiles, dumps(hashes) )
+        missing = loads( event.wait() )
+        if missing:
+            contents = configuration.file_contents()
+            files = [(hash, contents[hash]) for hash in missing]
+            self._protocol.request( CommandCodes.AddFiles, dumps(files) ).wait()
+        self._protocol.request( CommandCodes.AddManifest,
+                dumps( (configuration.name, manifest, configuration.hash) ) ).wait()
 
     def get(self, configuration_id):
         event = self._protocol.request( CommandCodes.GetConfiguration, configuration_id)
@@ -49,41 +163,323 @@ class ConfigurationLibraryClient(object):
     def remove(self, configuration_id):
         self._protocol.command( CommandCodes.RemoveConfiguration, configuration_id )
 
+    def locate(self, configuration_id):
+        """
+        Ask where to fetch the configuration from, returns the address of a
+        worker or None to fetch it from here
+        """
+        event = self._protocol.request( CommandCodes.LocateConfiguration, dumps(configuration_id) )
+        return loads( event.wait() )
+
+    def fetched(self, configuration_id, source, address, failed = False):
+        """
+        Report having fetched the configuration from source, which is the
+        address returned by locate. address is where we will hand it out to
+        other workers, or None if we won't.
+        """
+        self._protocol.command( CommandCodes.ConfigurationFetched,
+                dumps( (configuration_id, source, address, failed) ) )
+
 class WorkerServer(object):
     """
     Proxy that gives commands to a worker
+
+    It can outlive the connection: after attaching it to a new protocol,
+    the dispatcher can ask again for the tasks it was waiting on and gets
+    the results of those which finished in the meantime without running
+    them again.
+
+    With running given, only that many tasks are run at once and the rest
+    wait their turn, where the dispatcher can steal them back.
     """
-    def __init__(self, worker, protocol):
+    def __init__(self, worker, protocol = None, running = None):
         self._worker = worker
-        self._protocol = protocol
+        self._protocol = None
+        self._slots = None
+        if running is not None:
+            self._slots = eventlet.semaphore.Semaphore(running)
+        # the ids of the tasks waiting for a slot, oldest first
+        self._queued = []
+        # the green threads running tasks, the sequence numbers to answer
+        # them with, and the results which couldn't be sent, by task id
+        self._tasks = {}
+        self._sequences = {}
+        self._unsent = {}
+        # the warm configurations the dispatcher was last told about
+        self._warm = None
+        if protocol is not None:
+            self.attach(protocol)
 
+    def attach(self, protocol):
+        """
+        Start taking commands from protocol, returns the ids of the tasks
+        left over from before
+        """
+        self._protocol = protocol
+        self._sequences.clear()
         protocol.register_handler( CommandCodes.WorkerTask, self.do_task)
+        protocol.register_handler( CommandCodes.PrespawnWorker, self.prespawn)
+        protocol.register_handler( CommandCodes.CancelWorkerTask, self.cancel)
+        protocol.register_handler( CommandCodes.StealWorkerTask, self.steal)
+        # the new connection may be to a dispatcher which hasn't heard yet
+        self._warm = None
+        return set(self._tasks) | set(self._unsent)
+
+    def _report_warm(self):
+        """
+        Tell the dispatcher which configurations the worker has loaded,
+        if that changed since it was last told
+        """
+        warm = sorted(self._worker.warm_configurations())
+        if warm == self._warm or not self._protocol.connected():
+            return
+        try:
+            self._protocol.command( CommandCodes.WorkerWarm, dumps(warm) )
+        except ConnectionLost:
+            return
+        self._warm = warm
+
+    def forget(self, task_ids):
+        """
+        Drop tasks the dispatcher is no longer waiting on
+        """
+        for task_id in task_ids:
+            self._unsent.pop(task_id, None)
+            thread = self._tasks.pop(task_id, None)
+            if thread is not None:
+                thread.kill()
+
+    def prespawn(self, command, sequence, data):
+        configuration_id, count = loads(data)
+        self._worker.prespawn(configuration_id, count)
 
     def do_task(self, command, sequence, data):
-        configuration_id, task = loads(data)
-        def inner():
+        configuration_id, task, options = decode_task(data)
+        task_id = options.pop('task_id', sequence)
+        self._sequences[task_id] = sequence
+        if task_id in self._unsent:
+            # it finished while we were disconnected
+            self._respond(task_id, *self._unsent.pop(task_id))
+        elif task_id not in self._tasks:
+            self._tasks[task_id] = eventlet.spawn(self._run, task_id,
+                    configuration_id, task, options)
+
+    def _take_turn(self, task_id):
+        """
+        Wait for one of the slots to be free
+        """
+        self._queued.append(task_id)
+        try:
+            self._slots.acquire()
+        finally:
+            self._queued.remove(task_id)
+
+    def _run(self, task_id, configuration_id, task, options):
+        try:
+            if self._slots is not None:
+                self._take_turn(task_id)
             try:
-                print "START TASK"
-                result = self._worker.do_task(configuration_id, task)
-                print "FINISH TASK"
-                self._protocol.respond(sequence, result)
-            except:
-                print "OK?"
-                self._protocol.close()
-                raise
+                result = self._worker.do_task(configuration_id, task, **options)
+            finally:
+                if self._slots is not None:
+                    self._slots.release()
+        except GreenletExit:
+            # the task was cancelled, nobody wants the result
+            return
+        except SlaveCrashed as error:
+            # only the slave went down, we can carry on
+            self._respond(task_id, error, True)
+            return
+        except:
+            self._protocol.close()
+            raise
+        finally:
+            self._tasks.pop(task_id, None)
+        # before the result, so the dispatcher knows when picking the next task
+        self._report_warm()
+        self._respond(task_id, result)
 
-        eventlet.spawn_n(inner)
+    def _respond(self, task_id, result, failed = False):
+        """
+        Send the result of a task, or keep it until the dispatcher asks
+        again if the connection is down
+        """
+        sequence = self._sequences.pop(task_id, None)
+        if sequence is not None and self._protocol.connected():
+            try:
+                if failed:
+                    self._protocol.respond_exception(sequence, result)
+                else:
+                    self._protocol.respond(sequence, result)
+                return
+            except ConnectionLost:
+                pass
+        self._unsent[task_id] = (result, failed)
+
+    def steal(self, command, sequence, data):
+        """
+        Give back the most recently queued task which hasn't started yet,
+        responding with whether there was one
+        """
+        for task_id in reversed(self._queued):
+            if task_id in self._sequences:
+                self._protocol.respond_exception(self._sequences.pop(task_id), TaskStolen())
+                self.forget([task_id])
+                self._protocol.respond(sequence, dumps(True))
+                return
+        self._protocol.respond(sequence, dumps(False))
+
+    def cancel(self, command, sequence, data):
+        for task_id, waiting in self._sequences.items():
+            if waiting == sequence:
+                del self._sequences[task_id]
+                self.forget([task_id])
+                break
+
+class WorkerSessions(object):
+    """
+    Keeps the WorkerClients for workers which said who they are, so that
+    one which reconnects within resume_timeout seconds picks up where it
+    left off rather than having its tasks run again elsewhere
+    """
+    def __init__(self, resume_timeout = RESUME_TIMEOUT):
+        self.resume_timeout = resume_timeout
+        self._clients = {}
+
+    def start(self, session, protocol):
+        """
+        Return a new WorkerClient for the session
+        """
+        client = WorkerClient(protocol, session, self)
+        self._clients[session] = client
+        return client
+
+    def resume(self, session, protocol):
+        """
+        Return the WorkerClient for the session, now talking over protocol,
+        or None if the session is unknown or was given up on
+        """
+        client = self._clients.get(session)
+        if client is not None and client.attach(protocol):
+            return client
+        return None
+
+    def expired(self, client):
+        if self._clients.get(client.session) is client:
+            del self._clients[client.session]
 
 class WorkerClient(object):
     """
     Proxy to send worker commands across the protocol
+
+    A worker with a session gets resume_timeout seconds to reconnect after
+    losing the connection before the tasks it was running fail
     """
-    def __init__(self, protocol):
+    def __init__(self, protocol, session = None, sessions = None):
+        self._protocol = protocol
+        self.session = session
+        self._sessions = sessions
+        self._expired = False
+        self._attached = eventlet.event.Event()
+        # tasks are named so that the worker recognises them when they are
+        # asked for again after reconnecting
+        self._token = uuid.uuid4().hex
+        self._counter = itertools.count()
+        # the configurations the worker last said it has loaded
+        self._warm = []
+        protocol.register_handler( CommandCodes.WorkerWarm, self._warmed )
+
+    def attach(self, protocol):
+        """
+        Carry on over a new connection, returns False if it is too late
+        """
+        if self._expired:
+            return False
         self._protocol = protocol
+        protocol.register_handler( CommandCodes.WorkerWarm, self._warmed )
+        attached, self._attached = self._attached, eventlet.event.Event()
+        attached.send()
+        return True
+
+    def attached(self, protocol):
+        """
+        Return whether the worker is still talking over protocol
+        """
+        return self._protocol is protocol and not self._expired
+
+    def _resumed(self, protocol):
+        """
+        Wait for the worker to come back after protocol was lost, returns
+        False if it doesn't in time
+        """
+        if self._sessions is None or self._expired:
+            return False
+        with eventlet.Timeout(self._sessions.resume_timeout, False):
+            while self._protocol is protocol and not self._expired:
+                self._attached.wait()
+        self.expire(protocol)
+        return self._protocol is not protocol
+
+    def expire(self, protocol):
+        """
+        Give up on the worker unless it came back after protocol was lost,
+        returns True if it was given up on
+        """
+        if self._expired or self._protocol is not protocol:
+            return False
+        self._expired = True
+        if self._sessions is not None:
+            self._sessions.expired(self)
+        # everybody waiting for it to come back gives up too
+        self._attached.send()
+        return True
 
-    def do_task(self, configuration_id, task):
-        event = self._protocol.request( CommandCodes.WorkerTask, dumps( (configuration_id, task)) )
-        return event.wait()
+    def do_task(self, configuration_id, task, timeout = None):
+        task_id = (self._token, next(self._counter))
+        message = encode_task(configuration_id, task, {'timeout' : timeout, 'task_id' : task_id})
+        while True:
+            protocol = self._protocol
+            try:
+                event = protocol.request( CommandCodes.WorkerTask, message,
+                        CommandCodes.CancelWorkerTask )
+            except ConnectionLost:
+                if self._resumed(protocol):
+                    continue
+                raise
+
+            try:
+                return event.wait()
+            except ConnectionLost:
+                # ask again once the worker is back
+                if not self._resumed(protocol):
+                    raise
+            finally:
+                # if we were killed before the response came, the worker
+                # should stop working on the task
+                event.cancel()
+
+    def _warmed(self, command, sequence, data):
+        self._warm = loads(data)
+
+    def warm_configurations(self):
+        """
+        Return the configuration ids the worker last reported having loaded
+        """
+        return self._warm
+
+    def steal(self):
+        """
+        Ask the worker to give back a task it has queued up but not started,
+        which fails with TaskStolen. Returns whether there was one.
+        """
+        return loads( self._protocol.request( CommandCodes.StealWorkerTask, '' ).wait() )
+
+    def prespawn(self, configuration_id, count):
+        try:
+            self._protocol.command( CommandCodes.PrespawnWorker, dumps( (configuration_id, count) ) )
+        except ConnectionLost:
+            # it's only a hint
+            pass
 
     def data(self):
         data = {
@@ -95,30 +491,92 @@ class DispatcherServer(object):
     """
     Proxy to send request to dispatcher
     """
-    def __init__(self, dispatcher, protocol):
+    def __init__(self, dispatcher, protocol, sessions = None):
+        """
+        sessions is the WorkerSessions shared by all the connections,
+        without one workers can't resume after reconnecting
+        """
         self._dispatcher = dispatcher
         self._protocol = protocol
+        self._sessions = sessions
+        self._client = next(CLIENT_IDS)
 
         self._protocol.register_handler( CommandCodes.AddWorker, self.add_worker )
         self._protocol.register_handler( CommandCodes.DispatchTask, self.do_task )
+        self._protocol.register_handler( CommandCodes.CancelTask, self.cancel )
+
+        # the futures for tasks which haven't finished, by sequence number
+        self._tasks = {}
+        # the workers which were added over this connection
+        self._workers = []
+        eventlet.spawn_n(self._watch)
+
+    def _watch(self):
+        """
+        Once the connection is gone, give its workers a while to come back
+        and then have the dispatcher forget them. Meanwhile they get no new
+        tasks.
+        """
+        self._protocol.wait_shutdown()
+        for worker in self._workers:
+            if worker.session is None:
+                self._expire(worker)
+            elif worker.attached(self._protocol):
+                self._dispatcher.pause_worker(worker)
+                eventlet.spawn_after(self._sessions.resume_timeout, self._expire, worker)
+
+    def _expire(self, worker):
+        if worker.expire(self._protocol):
+            self._dispatcher.remove_worker(worker)
 
     def add_worker(self, command, sequence, data):
-        times = loads(data)
-        worker = WorkerClient(self._protocol)
-        self._dispatcher.add_worker(worker, times)
+        times, session, prefetch = loads(data)
+        if session is None or self._sessions is None:
+            worker = WorkerClient(self._protocol)
+        else:
+            worker = self._sessions.resume(session, self._protocol)
+            if worker is not None:
+                # the dispatcher still has it, along with its tasks
+                self._workers.append(worker)
+                self._protocol.respond(sequence, dumps(True))
+                self._dispatcher.resume_worker(worker)
+                return
+            worker = self._sessions.start(session, self._protocol)
+        self._workers.append(worker)
+        self._protocol.respond(sequence, dumps(False))
+        self._dispatcher.add_worker(worker, times, prefetch = prefetch)
 
     def do_task(self, command, sequence, data):
-        configuration_id, task = loads(data)
+        configuration_id, task, options = decode_task(data)
 
         # create a green thread which waits for the response
         # and then sends it off
         def inner():
-            result = event.wait()
+            try:
+                result = event.wait()
+            except CancelledError:
+                return
+            except Exception as error:
+                self._protocol.respond_exception(sequence, error)
+                return
+            finally:
+                self._tasks.pop(sequence, None)
             self._protocol.respond(sequence, result)
 
-        event = self._dispatcher.do_task(configuration_id, task)
+        try:
+            event = self._dispatcher.do_task(configuration_id, task, client = self._client, **options)
+        except Exception as error:
+            # bad options for example, the client hears about it
+            self._protocol.respond_exception(sequence, error)
+            return
+        self._tasks[sequence] = event
         eventlet.spawn_n(inner)
 
+    def cancel(self, command, sequence, data):
+        event = self._tasks.pop(sequence, None)
+        if event is not None:
+            event.cancel()
+
 
 
 class DispatcherClient(object):
@@ -128,9 +586,38 @@ class DispatcherClient(object):
     def __init__(self, protocol):
         self._protocol = protocol
 
-    def add_worker(self, worker, times):
-        server_worker = WorkerServer(worker, self._protocol)
-        self._protocol.command( CommandCodes.AddWorker, dumps(times) )
+    def add_worker(self, worker, times, session = None, prefetch = 0):
+        """
+        Have the dispatcher give worker up to times tasks at once
+
+        With prefetch, that many more tasks are sent over to wait here so
+        the worker has the next one ready when it finishes one.
 
-    def do_task(self, configuration_id, task):
-        return self._protocol.request( CommandCodes.DispatchTask, dumps( (configuration_id, task) ) )
+        Returns the WorkerServer for the worker. After reconnecting, pass
+        that instead of the worker along with the same session, so the
+        dispatcher can collect the tasks it was running.
+        """
+        if isinstance(worker, WorkerServer):
+            server = worker
+        elif prefetch:
+            server = WorkerServer(worker, running = times)
+        else:
+            server = WorkerServer(worker)
+        previous = server.attach(self._protocol)
+        event = self._protocol.request( CommandCodes.AddWorker, dumps( (times, session, prefetch) ) )
+        if not loads( event.wait() ):
+            # the dispatcher has given up on what we were doing before
+            server.forget(previous)
+        return server
+
+    def do_task(self, configuration_id, task, timeout = None, speculative = False,
+            priority = 0, weight = 1.0, count = 1):
+        options = {
+            'timeout' : timeout,
+            'speculative' : speculative,
+            'priority' : priority,
+            'weight' : weight,
+            'count' : count
+        }
+        message = encode_task(configuration_id, task, options)
+        return self._protocol.request( CommandCodes.DispatchTask, message, CommandCodes.CancelTask )
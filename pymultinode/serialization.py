@@ -1,5 +1,22 @@
 from multiprocessing.forking import ForkingPickler
 from StringIO import StringIO
+from cStringIO import StringIO as InputStringIO
+import pickle
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the first byte of data pickled with out of band buffers
+# it is not a pickle opcode so it can't be confused with a plain pickle
+OUT_OF_BAND = '\x00'
+# pickle length, number of buffers
+OUT_OF_BAND_HEADER = struct.Struct('!QL')
+BUFFER_LENGTH = struct.Struct('!Q')
+# objects smaller than this are just pickled as usual
+OUT_OF_BAND_THRESHOLD = 64 * 1024
 
 def dump(obj, file, protocol = 2):
     """
@@ -14,3 +31,196 @@ def dumps(obj, protocol = 2):
     output = StringIO()
     ForkingPickler(output, protocol).dump(obj)
     return output.getvalue()
+
+class OutOfBandPickler(ForkingPickler):
+    """
+    Pickler which leaves large bytearrays and numpy arrays out of the pickle,
+    collecting buffers pointing at their memory instead
+    """
+    def __init__(self, file, protocol, threshold):
+        ForkingPickler.__init__(self, file, protocol)
+        self.threshold = threshold
+        self.buffers = []
+        # the persistent ids already given out, by the id of the object
+        # being pickled, not of any contiguous copy made of it
+        self._buffered = {}
+        # keeps those objects alive, so their ids can't be reused by
+        # other objects while pickling
+        self._keep = []
+
+    def persistent_id(self, obj):
+        if id(obj) in self._buffered:
+            return self._buffered[id(obj)]
+
+        original = obj
+        if isinstance(obj, bytearray) and len(obj) >= self.threshold:
+            pid = ('bytearray', len(self.buffers))
+            self.buffers.append( buffer(obj) )
+        elif (numpy is not None and type(obj) is numpy.ndarray
+                and obj.nbytes >= self.threshold and not obj.dtype.hasobject):
+            if obj.flags.f_contiguous and not obj.flags.c_contiguous:
+                order = 'F'
+            else:
+                order = 'C'
+                if not obj.flags.c_contiguous:
+                    # the buffer keeps the copy alive
+                    obj = numpy.ascontiguousarray(obj)
+            pid = ('ndarray', len(self.buffers), obj.dtype, obj.shape, order)
+            self.buffers.append( buffer(obj) )
+        else:
+            return None
+
+        self._buffered[id(original)] = pid
+        self._keep.append(original)
+        return pid
+
+def dumps_out_of_band(obj, protocol = 2, threshold = OUT_OF_BAND_THRESHOLD):
+    """
+    Serialize obj, keeping large arrays out of the pickle
+
+    Returns a list of pieces which together make up the serialized form,
+    the arrays are included as buffers looking at their memory so they are
+    not copied. If there are no such arrays, the result is just a pickle.
+    """
+    output = StringIO()
+    pickler = OutOfBandPickler(output, protocol, threshold)
+    pickler.dump(obj)
+    pickled = output.getvalue()
+
+    if not pickler.buffers:
+        return [pickled]
+
+    header = [OUT_OF_BAND, OUT_OF_BAND_HEADER.pack(len(pickled), len(pickler.buffers))]
+    header.extend( BUFFER_LENGTH.pack(len(data)) for data in pickler.buffers )
+    return [''.join(header), pickled] + pickler.buffers
+
+def as_pieces(data):
+    """
+    Return serialized data as a list of pieces whether or not it already was
+    """
+    if isinstance(data, (list, tuple)):
+        return list(data)
+    else:
+        return [data]
+
+def _unpickle(pickled, buffers):
+    """
+    Unpickle the string pickled, with buffers being a list of
+    (object, offset, length) giving the memory for the out of band objects
+    """
+    # objects referred to more than once should come back as one object
+    loaded = {}
+
+    def persistent_load(pid):
+        kind, index = pid[:2]
+        if index in loaded:
+            return loaded[index]
+
+        base, offset, length = buffers[index]
+        if kind == 'bytearray':
+            obj = bytearray( buffer(base, offset, length) )
+        elif kind == 'ndarray':
+            dtype, shape, order = pid[2:]
+            array = numpy.frombuffer(base, dtype, length // dtype.itemsize, offset)
+            if not array.flags.writeable:
+                # we got handed read only memory, but whoever gets
+                # the array will expect to be able to change it
+                array = array.copy()
+            obj = array.reshape(shape, order = order)
+        else:
+            raise pickle.UnpicklingError('unknown persistent id %r' % (kind,))
+        loaded[index] = obj
+        return obj
+
+    unpickler = pickle.Unpickler( InputStringIO(pickled) )
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+def loads(data):
+    """
+    Deserialize the output of either dumps or dumps_out_of_band
+    data may be a string, bytearray or anything supporting the buffer interface.
+    The out of band arrays are built on top of data rather than copied
+    """
+    if data[:1] != OUT_OF_BAND:
+        if not isinstance(data, str):
+            data = buffer(data)[:]
+        return pickle.loads(data)
+
+    offset = len(OUT_OF_BAND)
+    pickle_length, count = OUT_OF_BAND_HEADER.unpack_from(data, offset)
+    offset += OUT_OF_BAND_HEADER.size
+
+    lengths = []
+    for index in xrange(count):
+        lengths.append( BUFFER_LENGTH.unpack_from(data, offset)[0] )
+        offset += BUFFER_LENGTH.size
+
+    pickled = buffer(data, offset, pickle_length)
+    offset += pickle_length
+
+    buffers = []
+    for length in lengths:
+        buffers.append( (data, offset, length) )
+        offset += length
+
+    return _unpickle(pickled, buffers)
+
+class PrefixedFile(object):
+    """
+    A file which has had some bytes read from it already, which need to be
+    read again
+    """
+    def __init__(self, prefix, file):
+        self._prefix = prefix
+        self._file = file
+
+    def read(self, length = -1):
+        prefix, self._prefix = self._prefix, ''
+        if length < 0:
+            return prefix + self._file.read()
+        elif length <= len(prefix):
+            self._prefix = prefix[length:]
+            return prefix[:length]
+        else:
+            return prefix + self._file.read(length - len(prefix))
+
+    def readline(self):
+        if '\n' in self._prefix:
+            line, self._prefix = self._prefix.split('\n', 1)
+            return line + '\n'
+        prefix, self._prefix = self._prefix, ''
+        return prefix + self._file.readline()
+
+# how much of a large buffer is read in one go
+READ_SIZE = 64 * 1024
+
+def read_exactly(file, length):
+    """
+    Read length bytes into a new bytearray, a piece at a time so no other
+    copy of the whole thing is made. Raises EOFError if the file ends first
+    """
+    data = bytearray(length)
+    offset = 0
+    while offset < length:
+        piece = file.read( min(READ_SIZE, length - offset) )
+        if not piece:
+            raise EOFError()
+        data[offset:offset + len(piece)] = piece
+        offset += len(piece)
+    return data
+
+def load(file):
+    """
+    Deserialize the output of either dumps or dumps_out_of_band from a file
+    The out of band arrays are read straight into their own memory
+    """
+    first = file.read(1)
+    if first != OUT_OF_BAND:
+        return pickle.Unpickler( PrefixedFile(first, file) ).load()
+
+    pickle_length, count = OUT_OF_BAND_HEADER.unpack( file.read(OUT_OF_BAND_HEADER.size) )
+    lengths = [BUFFER_LENGTH.unpack( file.read(BUFFER_LENGTH.size) )[0] for index in xrange(count)]
+    pickled = file.read(pickle_length)
+    buffers = [(read_exactly(file, length), 0, length) for length in lengths]
+    return _unpickle(pickled, buffers)
@@ -9,12 +9,22 @@ that happens
 """
 from pymultinode.configuration import extract_configuration, Configuration
 from pymultinode.configuration import ConfigurationLibrary, get_python_files
+from pymultinode.configuration import ConfigurationCache, CachedConfiguration
+from pymultinode.configuration import assemble_zip, file_hash, ManifestCache
+from pymultinode.configuration import add_memory_zip
+import sys
+import pymultinode.configuration
+from mock import patch
 from nose.tools import assert_equal, assert_raises
 import zipfile
 from StringIO import StringIO
 import os.path
 import multiprocessing
 import contextlib
+import tempfile
+import shutil
+import eventlet
+import time
 
 def quick_config(compiled = False, parent = False):
     """
@@ -251,3 +261,370 @@ def test_empty_path():
     """
     list(get_python_files(''))
 
+
+class CountingLibrary(ConfigurationLibrary):
+    """
+    A ConfigurationLibrary which counts how often it has been asked for
+    configurations
+    """
+    def __init__(self):
+        ConfigurationLibrary.__init__(self)
+        self.fetched = 0
+
+    def get(self, hash):
+        self.fetched += 1
+        eventlet.sleep()
+        return ConfigurationLibrary.get(self, hash)
+
+@contextlib.contextmanager
+def cache_directory():
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+def test_cache():
+    """
+    Make sure that the cache stores configurations on disk
+    """
+    library = CountingLibrary()
+    library.add( configuration_a() )
+    with cache_directory() as directory:
+        cache = ConfigurationCache(library, directory)
+        config = cache.get( configuration_a().hash )
+        assert isinstance(config, CachedConfiguration)
+        assert_equal('A', config.name)
+        assert_equal('A', open(config.path, 'rb').read())
+        cache.get( configuration_a().hash )
+        assert_equal(1, library.fetched)
+
+def test_cache_survives_restart():
+    """
+    Make sure that a new cache in the same directory does not fetch again
+    """
+    library = CountingLibrary()
+    library.add( configuration_a() )
+    with cache_directory() as directory:
+        ConfigurationCache(library, directory).get( configuration_a().hash )
+        config = ConfigurationCache(CountingLibrary(), directory).get( configuration_a().hash )
+        assert_equal('A', config.name)
+        assert_equal(1, library.fetched)
+
+def test_cache_concurrent():
+    """
+    Make sure that asking for the same configuration at once only fetches it once
+    """
+    library = CountingLibrary()
+    library.add( configuration_a() )
+    with cache_directory() as directory:
+        cache = ConfigurationCache(library, directory)
+        threads = [eventlet.spawn(cache.get, configuration_a().hash) for idx in xrange(4)]
+        paths = set(thread.wait().path for thread in threads)
+        assert_equal(1, len(paths))
+        assert_equal(1, library.fetched)
+
+def test_cache_missing():
+    """
+    Make sure that missing configurations still raise KeyError
+    """
+    with cache_directory() as directory:
+        cache = ConfigurationCache(configuration_library(), directory)
+        assert_raises(KeyError, cache.get, configuration_c().hash)
+
+def test_cache_passes_through():
+    """
+    Make sure that objects other than Configurations are handed out unchanged
+    """
+    library = ConfigurationLibrary()
+    null_config = NullConfiguration('NULL-HASH')
+    library.add(null_config)
+    with cache_directory() as directory:
+        cache = ConfigurationCache(library, directory)
+        assert cache.get('NULL-HASH') is null_config
+
+def test_cache_trim():
+    """
+    Make sure that the least recently used configurations are removed to
+    keep the cache small
+    """
+    library = configuration_library()
+    with cache_directory() as directory:
+        cache = ConfigurationCache(library, directory, max_bytes = 1)
+        first = cache.get( configuration_a().hash )
+        second = cache.get( configuration_b().hash )
+        assert not os.path.exists(first.path)
+        assert os.path.exists(second.path)
+
+def test_cache_trim_in_use():
+    """
+    Configurations which are in use should be left alone
+    """
+    library = configuration_library()
+    with cache_directory() as directory:
+        cache = ConfigurationCache(library, directory, max_bytes = 1)
+        cache.in_use = lambda: [configuration_a().hash]
+        first = cache.get( configuration_a().hash )
+        second = cache.get( configuration_b().hash )
+        assert os.path.exists(first.path)
+        assert os.path.exists(second.path)
+
+def test_cache_damaged():
+    """
+    A cached zip which doesn't match its hash should be fetched again
+    """
+    library = configuration_library()
+    with cache_directory() as directory:
+        path = ConfigurationCache(library, directory).get( configuration_a().hash ).path
+        with open(path, 'wb') as damaged:
+            damaged.write('')
+        config = ConfigurationCache(library, directory).get( configuration_a().hash )
+        with open(config.path, 'rb') as contents:
+            assert_equal( configuration_a().contents, contents.read() )
+
+def test_apply_cached():
+    """
+    Make sure that a cached configuration can be applied
+    """
+    library = ConfigurationLibrary()
+    library.add( quick_config() )
+    with cache_directory() as directory:
+        config = ConfigurationCache(library, directory).get( quick_config().hash )
+        server, client = multiprocessing.Pipe()
+        process = multiprocessing.Process(target = do_within_applied,
+            args = (config, client, do_apply_configuration_import))
+        process.start()
+        process.join()
+        assert server.poll()
+        assert os.path.exists(config.path)
+
+def manifest_config(**sources):
+    """
+    Return a configuration with a manifest holding the given files
+    """
+    files = dict( (file_hash(contents), contents) for contents in sources.values() )
+    manifest = [(name + '.py', file_hash(contents)) for name, contents in sorted(sources.items())]
+    return Configuration( assemble_zip(manifest, files), 'main', manifest )
+
+def test_manifest():
+    """
+    Make sure that configurations list the files they are made of
+    """
+    config = quick_config()
+    names = [filename for filename, hash in config.manifest]
+    assert 'test_configuration.pyc' in names
+    contents = config.file_contents()
+    for filename, hash in config.manifest:
+        assert_equal(hash, file_hash(contents[hash]))
+
+def test_assemble_repeatable():
+    """
+    Make sure that assembling the same files twice gives the same zip
+    """
+    assert_equal( manifest_config(main = 'x = 1').hash, manifest_config(main = 'x = 1').hash )
+
+def test_assemble_any_platform():
+    """
+    Make sure that a zip assembled on windows is the same as on unix
+    """
+    unix = manifest_config(main = 'x = 1')
+    with patch('sys.platform', 'win32'):
+        windows = manifest_config(main = 'x = 1')
+    assert_equal( unix.hash, windows.hash )
+
+def test_library_manifest():
+    """
+    Make sure that the library puts together the same configuration
+    from its files
+    """
+    config = manifest_config(main = 'x = 1', other = 'y = 2')
+    library = ConfigurationLibrary()
+    hashes = [hash for filename, hash in config.manifest]
+    assert_equal( sorted(hashes), sorted(library.missing_files(hashes)) )
+
+    library.add_files( config.file_contents().items() )
+    assert_equal( [], library.missing_files(hashes) )
+    library.add_manifest(config.name, config.manifest)
+    assert_equal( config.contents, library.get(config.hash).contents )
+
+def test_library_bad_file():
+    """
+    Make sure that files not matching their hash are refused
+    """
+    library = ConfigurationLibrary()
+    assert_raises( ValueError, library.add_files, [(file_hash('good'), 'bad')] )
+
+def test_library_remove_files():
+    """
+    Make sure that files are only forgotten once nothing uses them
+    """
+    first = manifest_config(main = 'x = 1', other = 'y = 2')
+    second = manifest_config(main = 'x = 3', other = 'y = 2')
+    library = ConfigurationLibrary()
+    for config in [first, second]:
+        library.add_files( config.file_contents().items() )
+        library.add_manifest(config.name, config.manifest)
+
+    library.remove(first.hash)
+    assert_equal( [file_hash('x = 1')],
+            library.missing_files([file_hash('x = 1'), file_hash('y = 2')]) )
+
+def test_library_remove_during_upload():
+    """
+    Files an upload has been told it needn't send should not be forgotten
+    before its manifest arrives
+    """
+    first = manifest_config(main = 'x = 1', other = 'y = 2')
+    second = manifest_config(main = 'x = 3', other = 'y = 2')
+    library = ConfigurationLibrary()
+    library.add_files( first.file_contents().items() )
+    library.add_manifest(first.name, first.manifest)
+
+    hashes = [hash for filename, hash in second.manifest]
+    assert_equal( [file_hash('x = 3')], library.missing_files(hashes) )
+    library.remove(first.hash)
+    library.add_files( [(file_hash('x = 3'), 'x = 3')] )
+    library.add_manifest(second.name, second.manifest)
+    assert_equal( second.contents, library.get(second.hash).contents )
+
+def test_library_wrong_hash():
+    """
+    Make sure that a manifest which doesn't come out as expected is refused
+    """
+    config = manifest_config(main = 'x = 1')
+    library = ConfigurationLibrary()
+    library.missing_files([file_hash('x = 1')])
+    library.add_files( config.file_contents().items() )
+    assert_raises( ValueError, library.add_manifest, config.name, config.manifest,
+            file_hash('something else') )
+    assert_raises( KeyError, library.get, config.hash )
+    assert_equal( [file_hash('x = 1')], library.missing_files([file_hash('x = 1')]) )
+
+def test_library_max_configurations():
+    """
+    Make sure that the least recently used configurations are dropped,
+    along with the files only they needed
+    """
+    first = manifest_config(main = 'x = 1', other = 'y = 2')
+    second = manifest_config(main = 'x = 3', other = 'y = 2')
+    third = manifest_config(main = 'x = 4', other = 'y = 2')
+    library = ConfigurationLibrary(max_configurations = 2)
+    for config in [first, second]:
+        library.add_files( config.file_contents().items() )
+        library.add_manifest(config.name, config.manifest, config.hash)
+    library.get(first.hash)
+
+    library.add_files( third.file_contents().items() )
+    library.add_manifest(third.name, third.manifest, third.hash)
+    assert_raises( KeyError, library.get, second.hash )
+    assert_equal( first.hash, library.get(first.hash).hash )
+    assert_equal( [file_hash('x = 3')], library.missing_files(
+            [file_hash('x = 1'), file_hash('x = 3'), file_hash('y = 2')]) )
+
+def test_library_abandoned_upload():
+    """
+    Make sure that the files of an upload which never finished are
+    forgotten eventually
+    """
+    first = manifest_config(main = 'x = 1')
+    second = manifest_config(main = 'x = 3')
+    library = ConfigurationLibrary()
+    library.add_files( first.file_contents().items() )
+    library.add_manifest(first.name, first.manifest)
+
+    library.missing_files([file_hash('x = 3')])
+    library.add_files( second.file_contents().items() )
+    with patch('time.time', return_value = time.time() + 2 * pymultinode.configuration.UPLOAD_TIMEOUT):
+        library.remove(first.hash)
+    assert_equal( [file_hash('x = 3')], library.missing_files([file_hash('x = 3')]) )
+
+@contextlib.contextmanager
+def script_directory(**scripts):
+    """
+    Create a directory holding the given scripts
+    """
+    with cache_directory() as directory:
+        for name, contents in scripts.items():
+            with open(os.path.join(directory, name + '.py'), 'w') as script:
+                script.write(contents)
+        yield directory
+
+def counting_compile():
+    return patch('pymultinode.configuration.compile_python_file',
+            side_effect = pymultinode.configuration.compile_python_file)
+
+def test_manifest_cache():
+    """
+    Make sure that the cache gives the same configuration as building it
+    from scratch, only compiling scripts once
+    """
+    with script_directory(main = 'x = 1', other = 'y = 2') as scripts:
+        with cache_directory() as directory:
+            main = os.path.join(scripts, 'main.py')
+            cache = ManifestCache(directory)
+            with counting_compile() as compile_python_file:
+                config = cache.extract_configuration(main)
+                assert_equal( 2, compile_python_file.call_count )
+                assert cache.extract_configuration(main) is config
+                assert_equal( 2, compile_python_file.call_count )
+
+            assert_equal( extract_configuration(main).hash, config.hash )
+            assert_equal( 'main', config.name )
+
+def test_manifest_cache_on_disk():
+    """
+    Make sure that a new cache reuses what was saved by the last one
+    """
+    with script_directory(main = 'x = 1') as scripts:
+        with cache_directory() as directory:
+            main = os.path.join(scripts, 'main.py')
+            config = ManifestCache(directory).extract_configuration(main)
+            with counting_compile() as compile_python_file:
+                assert_equal( config.hash, ManifestCache(directory).extract_configuration(main).hash )
+                assert_equal( 0, compile_python_file.call_count )
+
+def test_manifest_cache_changed():
+    """
+    Make sure that only changed scripts are compiled again
+    """
+    with script_directory(main = 'x = 1', other = 'y = 2') as scripts:
+        with cache_directory() as directory:
+            main = os.path.join(scripts, 'main.py')
+            cache = ManifestCache(directory)
+            first = cache.extract_configuration(main)
+
+            with open(os.path.join(scripts, 'other.py'), 'w') as script:
+                script.write('y = 300')
+            with counting_compile() as compile_python_file:
+                second = cache.extract_configuration(main)
+                assert_equal( 1, compile_python_file.call_count )
+            assert first.hash != second.hash
+            assert_equal( extract_configuration(main).hash, second.hash )
+
+def test_memory_zip():
+    """
+    Make sure that modules and packages can be imported from memory
+    """
+    output = StringIO()
+    zipped = zipfile.ZipFile(output, 'w')
+    zipped.writestr('memory_module.py', 'value = 42')
+    zipped.writestr('memory_package/__init__.py', 'from memory_package.inner import value')
+    zipped.writestr('memory_package/inner.py', 'value = 43')
+    zipped.close()
+
+    path = add_memory_zip('memory-test', output.getvalue())
+    sys.path.append(path)
+    try:
+        module = __import__('memory_module')
+        assert_equal(42, module.value)
+        assert module.__file__.startswith(path)
+        assert_equal('value = 42', module.__loader__.get_source('memory_module'))
+
+        package = __import__('memory_package')
+        assert_equal(43, package.value)
+        assert_equal(43, sys.modules['memory_package.inner'].value)
+        assert_raises(ImportError, __import__, 'memory_package.missing')
+    finally:
+        sys.path.remove(path)
+        for name in ['memory_module', 'memory_package', 'memory_package.inner']:
+            sys.modules.pop(name, None)
@@ -1,9 +1,12 @@
 """
 Tests for the dispatcher code
 """
-from .dispatcher import Dispatcher
+from .dispatcher import Dispatcher, PoisonTaskError
+from .worker import SlaveCrashed
 from .protocol import ConnectionLost
-from nose.tools import assert_equals
+from nose.tools import assert_equals, assert_raises
+import eventlet
+import eventlet.semaphore
 
 class DoubleWorker(object):
     """
@@ -13,25 +16,37 @@ class DoubleWorker(object):
     def __init__(self):
         self.calls = 0
 
-    def do_task(self, configuration_id, task):
+    def do_task(self, configuration_id, task, timeout = None):
         """
         Do a silly implementation of a task
         """
         self.calls += 1
         return task + task
 
+    def prespawn(self, configuration_id, count):
+        self.prespawned = configuration_id, count
+
+    def warm_configurations(self):
+        return []
+
 class GiveUpWorker(object):
     """
     Implements the Worker interface by giving up every time
     """
 
-    def do_task(self, configuration_id, task):
+    def do_task(self, configuration_id, task, timeout = None):
         """
         This raises ConnectionLost which indicates that the worker cannot 
         perform tasks for some reason
         """
         raise ConnectionLost()
 
+    def prespawn(self, configuration_id, count):
+        pass
+
+    def warm_configurations(self):
+        return []
+
 def test_dispatcher():
     """
     Make sure that the tasks do get done
@@ -96,3 +111,371 @@ def test_disabled_workers_multiple():
     tasks = [dispatcher.do_task(None, '') for x in range(10)]
     for task in tasks:
         assert_equals('', task.wait() )
+
+def test_cancelled_not_run():
+    """
+    Tasks cancelled while waiting for a worker should never be run
+    """
+    dispatcher = Dispatcher()
+    event = dispatcher.do_task(None, 'yellow')
+    event.cancel()
+    worker = DoubleWorker()
+    dispatcher.add_worker(worker, 1)
+    assert_equals( 'greengreen', dispatcher.do_task(None, 'green').wait() )
+    assert_equals( 1, worker.calls )
+
+def test_prespawn_recent():
+    """
+    New workers should be asked to warm up for the latest configuration
+    """
+    dispatcher = Dispatcher()
+    dispatcher.do_task('alpha', 'yellow')
+    dispatcher.do_task('beta', 'yellow')
+    worker = DoubleWorker()
+    dispatcher.add_worker(worker, 3)
+    assert_equals( ('beta', 3), worker.prespawned )
+
+class RecordingWorker(object):
+    """
+    Implements the worker interface, remembering the order in which
+    configurations were asked for, and keeping every one it was given
+    loaded
+    """
+    def __init__(self):
+        self.configurations = []
+        self.tasks = []
+        self.warm = set()
+
+    def do_task(self, configuration_id, task, timeout = None):
+        self.configurations.append(configuration_id)
+        self.tasks.append(task)
+        self.warm.add(configuration_id)
+        return task
+
+    def prespawn(self, configuration_id, count):
+        self.warm.add(configuration_id)
+
+    def warm_configurations(self):
+        return list(self.warm)
+
+def test_prefers_warm_configuration():
+    """
+    A worker should be given tasks for the configuration it has loaded first
+    """
+    dispatcher = Dispatcher()
+    events = [dispatcher.do_task('cold', ''), dispatcher.do_task('warm', '')]
+    # the worker gets prespawned for the most recent configuration: warm
+    worker = RecordingWorker()
+    dispatcher.add_worker(worker, 1)
+    for event in events:
+        event.wait()
+    assert_equals( ['warm', 'cold'], worker.configurations )
+
+class WarmWorker(RecordingWorker):
+    """
+    Implements the worker interface, with only the given configurations
+    loaded whatever it is asked to prespawn
+    """
+    def __init__(self, warm):
+        RecordingWorker.__init__(self)
+        self.warm = set(warm)
+
+    def prespawn(self, configuration_id, count):
+        pass
+
+def test_follows_reported_warm():
+    """
+    The dispatcher should go by the configurations the worker says it has
+    loaded rather than what it was asked to prespawn
+    """
+    dispatcher = Dispatcher()
+    events = [dispatcher.do_task('alpha', ''), dispatcher.do_task('beta', '')]
+    worker = WarmWorker(['alpha'])
+    dispatcher.add_worker(worker, 1)
+    for event in events:
+        event.wait()
+    assert_equals( ['alpha', 'beta'], worker.configurations )
+
+def test_no_starvation():
+    """
+    A task for another configuration only gets passed over so many times
+    """
+    dispatcher = Dispatcher(patience = 2)
+    events = [dispatcher.do_task('cold', '')]
+    events.extend( dispatcher.do_task('warm', '') for x in range(5) )
+    worker = RecordingWorker()
+    dispatcher.add_worker(worker, 1)
+    for event in events:
+        event.wait()
+    assert_equals( ['warm', 'warm', 'cold', 'warm', 'warm', 'warm'], worker.configurations )
+
+def run_in_order(dispatcher, events):
+    """
+    Give the dispatcher a worker with one slot and return the order in
+    which it ran the tasks
+    """
+    worker = RecordingWorker()
+    dispatcher.add_worker(worker, 1)
+    for event in events:
+        event.wait()
+    return worker.tasks
+
+def test_priority():
+    """
+    Tasks with a higher priority should skip the queue
+    """
+    dispatcher = Dispatcher()
+    events = [dispatcher.do_task(None, 'batch') for x in range(3)]
+    events.append( dispatcher.do_task(None, 'urgent', priority = 1) )
+    assert_equals( ['urgent', 'batch', 'batch', 'batch'], run_in_order(dispatcher, events) )
+
+def test_fair_share():
+    """
+    A client submitting a few tasks shouldn't wait behind everything
+    another client submitted first
+    """
+    dispatcher = Dispatcher()
+    events = [dispatcher.do_task(None, 'b', client = 'batch') for x in range(5)]
+    events.extend( dispatcher.do_task(None, 'i', client = 'interactive') for x in range(2) )
+    assert_equals( list('bibibbb'), run_in_order(dispatcher, events) )
+
+def test_fair_share_weights():
+    """
+    A client with twice the weight should get twice the turns
+    """
+    dispatcher = Dispatcher()
+    events = [dispatcher.do_task(None, 'b', client = 'b') for x in range(2)]
+    events.extend( dispatcher.do_task(None, 'a', client = 'a', weight = 2) for x in range(4) )
+    assert_equals( list('baabaa'), run_in_order(dispatcher, events) )
+    assert_raises( ValueError, dispatcher.do_task, None, 'a', weight = 0 )
+
+class SleepyWorker(object):
+    """
+    Implements the worker interface, taking delay seconds for every task
+    and returning its name
+    """
+    def __init__(self, name, delay):
+        self.name = name
+        self.delay = delay
+
+    def do_task(self, configuration_id, task, timeout = None):
+        eventlet.sleep(self.delay)
+        return self.name
+
+    def prespawn(self, configuration_id, count):
+        pass
+
+    def warm_configurations(self):
+        return []
+
+    def data(self):
+        return {'type' : 'sleepy'}
+
+def straggling_dispatcher():
+    """
+    Returns a dispatcher which knows tasks take 0.01 seconds, with a fast
+    worker busy on a task and a slow worker free
+    """
+    dispatcher = Dispatcher()
+    dispatcher.add_worker(SleepyWorker('fast', 0.01), 1)
+    for x in range(5):
+        dispatcher.do_task(None, '').wait()
+    dispatcher.do_task(None, '')
+    dispatcher.add_worker(SleepyWorker('slow', 1.0), 1)
+    return dispatcher
+
+def test_speculative_execution():
+    """
+    A speculative task stuck on a slow worker should be run again elsewhere
+    """
+    dispatcher = straggling_dispatcher()
+    event = dispatcher.do_task(None, '', speculative = True)
+    with eventlet.Timeout(0.5):
+        assert_equals( 'fast', event.wait() )
+    assert_equals( 1, dispatcher.data()['speculated'] )
+
+def test_speculation_scaled_by_count():
+    """
+    A chunk covering many elements should be expected to take as much
+    longer than single ones
+    """
+    dispatcher = Dispatcher()
+    first = SleepyWorker('first', 0.01)
+    dispatcher.add_worker(first, 1)
+    for x in range(5):
+        dispatcher.do_task(None, '').wait()
+    first.delay = 0.1
+    dispatcher.add_worker(SleepyWorker('second', 0.1), 1)
+    event = dispatcher.do_task(None, '', speculative = True, count = 50)
+    event.wait()
+    assert_equals( 0, dispatcher.data()['speculated'] )
+
+class QueueWorker(SleepyWorker):
+    """
+    Implements the worker interface, running one task at a time and
+    queueing up the rest
+    """
+    def __init__(self, name, delay):
+        SleepyWorker.__init__(self, name, delay)
+        self.semaphore = eventlet.semaphore.Semaphore(1)
+
+    def do_task(self, configuration_id, task, timeout = None):
+        with self.semaphore:
+            return SleepyWorker.do_task(self, configuration_id, task, timeout)
+
+def test_prefetch_not_timed():
+    """
+    The time a task spends prefetched by a worker shouldn't count towards
+    how long tasks take
+    """
+    dispatcher = Dispatcher()
+    dispatcher.add_worker(QueueWorker('queue', 0.02), 1, prefetch = 3)
+    events = [dispatcher.do_task(None, '') for x in range(8)]
+    for event in events:
+        event.wait()
+    assert dispatcher._durations.expected(None) < 0.03
+
+class StubbornWorker(QueueWorker):
+    """
+    A QueueWorker which takes a while to refuse giving back any task
+    """
+    def steal(self):
+        eventlet.sleep(0.05)
+        return False
+
+def test_failed_steal():
+    """
+    A task which comes in while an idle worker is trying to steal one
+    should go to it once the steal fails
+    """
+    dispatcher = Dispatcher()
+    dispatcher.add_worker(StubbornWorker('busy', 1.0), 1, prefetch = 2)
+    events = [dispatcher.do_task(None, '') for x in range(3)]
+    dispatcher.add_worker(SleepyWorker('idle', 0.01), 1)
+    event = dispatcher.do_task(None, '')
+    with eventlet.Timeout(0.5):
+        assert_equals( 'idle', event.wait() )
+    for event in events:
+        event.cancel()
+
+def test_no_speculation_by_default():
+    """
+    Tasks which didn't ask for it should not be run twice
+    """
+    dispatcher = straggling_dispatcher()
+    event = dispatcher.do_task(None, '')
+    assert_equals( 'slow', event.wait() )
+    assert_equals( 0, dispatcher.data()['speculated'] )
+
+def test_cancel_running():
+    """
+    Cancelling a task which is running should stop it, freeing the worker
+    """
+    dispatcher = Dispatcher()
+    worker = SleepyWorker('slow', 10.0)
+    dispatcher.add_worker(worker, 1)
+    event = dispatcher.do_task(None, '')
+    eventlet.sleep(0.01)
+    assert event.cancel()
+    eventlet.sleep(0.01)
+    assert_equals( 0, dispatcher.data()['workers'][0]['active'] )
+    worker.delay = 0
+    with eventlet.Timeout(1):
+        assert_equals( 'slow', dispatcher.do_task(None, '').wait() )
+
+def test_speculation_stops_loser():
+    """
+    The copy of a task which finishes second should be stopped
+    """
+    dispatcher = straggling_dispatcher()
+    event = dispatcher.do_task(None, '', speculative = True)
+    event.wait()
+    eventlet.sleep(0.01)
+    active = [worker['active'] for worker in dispatcher.data()['workers']]
+    assert_equals( [0, 0], active )
+
+class FailingWorker(SleepyWorker):
+    """
+    Implements the worker interface, failing every task after a delay
+    """
+    def do_task(self, configuration_id, task, timeout = None):
+        eventlet.sleep(self.delay)
+        raise ValueError(self.name)
+
+def test_speculation_survives_failure():
+    """
+    A copy of a task failing shouldn't fail the task while another copy
+    is still running
+    """
+    dispatcher = Dispatcher()
+    fast = SleepyWorker('fast', 0.01)
+    dispatcher.add_worker(fast, 1)
+    for x in range(5):
+        dispatcher.do_task(None, '').wait()
+    fast.delay = 0.05
+    dispatcher.do_task(None, '')
+    eventlet.sleep()
+    fast.delay = 0.3
+    dispatcher.add_worker(FailingWorker('failing', 0.1), 1)
+
+    event = dispatcher.do_task(None, '', speculative = True)
+    assert_equals( 'fast', event.wait() )
+    assert_equals( 1, dispatcher.data()['speculated'] )
+
+class CrashingWorker(object):
+    """
+    Implements the worker interface with tasks which crash the slave
+    the first crashes times they are run
+    """
+    def __init__(self, crashes):
+        self.crashes = crashes
+        self.calls = 0
+
+    def do_task(self, configuration_id, task, timeout = None):
+        self.calls += 1
+        if self.calls <= self.crashes:
+            raise SlaveCrashed('crashed')
+        return task
+
+    def prespawn(self, configuration_id, count):
+        pass
+
+    def warm_configurations(self):
+        return []
+
+def test_crash_retried():
+    """
+    A task which crashed a slave should be retried
+    """
+    dispatcher = Dispatcher(retry_delay = 0.01)
+    dispatcher.add_worker(CrashingWorker(2), 1)
+    assert_equals( 'red', dispatcher.do_task(None, 'red').wait() )
+    assert_equals( 2, dispatcher._retried )
+
+def test_crash_retries_run_out():
+    """
+    A task which keeps crashing slaves should be given up on
+    """
+    dispatcher = Dispatcher(max_retries = 2, retry_delay = 0.01)
+    worker = CrashingWorker(100)
+    dispatcher.add_worker(worker, 1)
+    assert_raises( PoisonTaskError, dispatcher.do_task(None, 'red').wait )
+    assert_equals( 3, worker.calls )
+
+def test_poison_task_quarantined():
+    """
+    A task crashing slaves on several workers should be given up on
+    """
+    dispatcher = Dispatcher(poison_workers = 2, retry_delay = 0.01)
+    workers = [CrashingWorker(100), CrashingWorker(100)]
+    for worker in workers:
+        dispatcher.add_worker(worker, 1)
+    event = dispatcher.do_task(None, 'red')
+    assert_raises( PoisonTaskError, event.wait )
+    # the retry went to the other worker
+    assert_equals( [1, 1], [worker.calls for worker in workers] )
+    assert_equals( 1, dispatcher._poisoned )
+    # other tasks can still be run
+    workers[0].crashes = 0
+    workers[1].crashes = 0
+    assert_equals( 'blue', dispatcher.do_task(None, 'blue').wait() )
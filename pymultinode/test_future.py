@@ -0,0 +1,111 @@
+"""
+Tests for pymultinode.future
+"""
+from .future import Future, CancelledError, TimeoutError
+from .future import as_completed, wait, FIRST_COMPLETED, FIRST_EXCEPTION
+from nose.tools import assert_equals, assert_raises
+import eventlet
+
+def test_result():
+    """
+    The result sent should be the result given
+    """
+    future = Future()
+    future.send(42)
+    assert future.done()
+    assert_equals(42, future.result())
+    assert_equals(42, future.wait())
+
+def test_exception():
+    """
+    Exceptions sent should be raised
+    """
+    future = Future()
+    future.send_exception(IndexError())
+    assert_raises(IndexError, future.result)
+    assert isinstance(future.exception(), IndexError)
+
+def test_timeout():
+    """
+    A future that never finishes should time out
+    """
+    future = Future()
+    assert_raises(TimeoutError, future.result, 0.01)
+    assert not future.done()
+
+def test_cancel():
+    """
+    Cancelled futures should stay cancelled, even if a result comes in later
+    """
+    future = Future()
+    assert future.cancel()
+    future.send(42)
+    assert future.cancelled()
+    assert_raises(CancelledError, future.result)
+    assert not future.cancel()
+
+def test_callbacks():
+    """
+    Callbacks should be called once done, even if added late
+    """
+    called = []
+    future = Future()
+    future.add_done_callback(called.append)
+    assert_equals([], called)
+    future.send(1)
+    future.add_done_callback(called.append)
+    assert_equals([future, future], called)
+
+def test_failing_callback():
+    """
+    A callback which raises shouldn't stop the others, or the send
+    """
+    def broken(future):
+        raise RuntimeError('broken')
+    called = []
+    future = Future()
+    future.add_done_callback(broken)
+    future.add_done_callback(called.append)
+    future.send(1)
+    assert_equals([future], called)
+    assert_equals(1, future.result())
+
+def test_as_completed_order():
+    """
+    as_completed should produce the futures in the order they finish
+    """
+    futures = [Future() for x in range(3)]
+    eventlet.spawn_after(0.02, futures[0].send, 0)
+    eventlet.spawn_after(0.01, futures[1].send, 1)
+    futures[2].send(2)
+    assert_equals( [futures[2], futures[1], futures[0]], list(as_completed(futures)) )
+
+def test_as_completed_timeout():
+    """
+    as_completed should give up after the timeout
+    """
+    futures = [Future(), Future()]
+    futures[0].send(0)
+    iterator = as_completed(futures, 0.01)
+    assert_equals(futures[0], iterator.next())
+    assert_raises(TimeoutError, iterator.next)
+
+def test_wait_first_exception():
+    """
+    wait should return once an exception comes in
+    """
+    futures = [Future(), Future()]
+    eventlet.spawn_after(0.01, futures[1].send_exception, IndexError())
+    done, not_done = wait(futures, return_when = FIRST_EXCEPTION)
+    assert_equals( set([futures[1]]), done)
+    assert_equals( set([futures[0]]), not_done)
+
+def test_wait_timeout():
+    """
+    wait should give up after the timeout
+    """
+    futures = [Future(), Future()]
+    futures[0].send(0)
+    done, not_done = wait(futures, timeout = 0.01)
+    assert_equals( set([futures[0]]), done)
+    assert_equals( set([futures[1]]), not_done)
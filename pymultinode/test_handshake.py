@@ -3,10 +3,13 @@ from test_protocol import create_pipes
 from .dispatcher import Dispatcher
 from .configuration import ConfigurationLibrary
 import eventlet
-from .handshake import ConnectionHandler, client_handshake, WebServer, client_web_connect
+from .handshake import ConnectionHandler, client_handshake, WebServer, client_web_connect, reconnect
+from .proxy import DispatcherClient
 from nose.tools import assert_raises, assert_equals
 from .protocol import ConnectionLost
 from eventlet.green import urllib2
+from .test_dispatcher import DoubleWorker
+import time
 
 
 
@@ -21,12 +24,31 @@ def test_server_handshake():
     client_dispatcher, client_library = client_handshake(client, 'secret')
     client_dispatcher.add_worker(None, 7)
     client_library.add('Yellow')
-    eventlet.sleep()
+    eventlet.sleep(0.01)
 
 
     assert dispatcher.add_worker.called
     library.add.assert_called_with('Yellow')
 
+def test_busy_client_not_dropped():
+    """
+    A client which keeps the hub busy for longer than the server's
+    heartbeats allow should still be able to submit tasks afterwards
+    """
+    server, client = create_pipes()
+    dispatcher = Dispatcher()
+    dispatcher.add_worker(DoubleWorker(), 1)
+    handler = ConnectionHandler(dispatcher, Mock(ConfigurationLibrary), 'secret',
+            heartbeat_interval = 0.02, heartbeat_misses = 3)
+    eventlet.spawn( handler.new_connection, server )
+
+    client_dispatcher, client_library = client_handshake(client, 'secret')
+    assert_equals( 'alphaalpha', client_dispatcher.do_task(None, 'alpha').wait() )
+    # blocks everything, heartbeats included
+    time.sleep(0.2)
+    with eventlet.Timeout(1):
+        assert_equals( 'betabeta', client_dispatcher.do_task(None, 'beta').wait() )
+
 def test_server_handshake_unauthorized():
     server, client = create_pipes()
     dispatcher = Mock(Dispatcher)
@@ -70,3 +92,25 @@ def test_not_web():
     data = client.read(5)
     assert_equals(data, 'HELLO')
 
+
+def test_reconnect():
+    """
+    reconnect should keep trying until the server is there, then move the
+    clients over to the new connection
+    """
+    listener = eventlet.listen( ('localhost', 0) )
+    address = listener.getsockname()
+    listener.close()
+
+    dispatcher = Mock(Dispatcher)
+    handler = ConnectionHandler(dispatcher, Mock(ConfigurationLibrary), 'secret')
+    def serve_later():
+        eventlet.sleep(0.05)
+        WebServer(None, handler).listen(address)
+    eventlet.spawn_n(serve_later)
+
+    client_dispatcher = DispatcherClient(None)
+    reconnect([client_dispatcher], address, 'secret', delay = 0.01)
+    client_dispatcher.add_worker(None, 3)
+    eventlet.sleep(0.01)
+    assert_equals( 3, dispatcher.add_worker.call_args[0][-1] )
@@ -0,0 +1,147 @@
+"""
+Tests for pymultinode.peer
+"""
+from .peer import SourceTracker, PeerServer, PeerLibrary, fetch
+from .protocol import ConnectionLost
+from .configuration import ConfigurationLibrary, ConfigurationCache, Configuration
+from .test_configuration import cache_directory, configuration_a, configuration_b
+from .test_proxy import create_libraries
+from nose.tools import assert_equals, assert_raises
+import eventlet
+
+def test_tracker_dispatcher_first():
+    """
+    With nobody else having the configuration, the dispatcher hands it out
+    """
+    tracker = SourceTracker()
+    assert_equals( None, tracker.locate('alpha') )
+
+def test_tracker_fanout():
+    """
+    Each source should only be handed fanout fetches at a time, and workers
+    which have fetched the configuration become sources
+    """
+    tracker = SourceTracker(fanout = 2)
+    assert_equals( None, tracker.locate('alpha') )
+    assert_equals( None, tracker.locate('alpha') )
+
+    third = eventlet.spawn(tracker.locate, 'alpha')
+    eventlet.sleep(0.01)
+    assert not third.dead
+
+    tracker.fetched('alpha', None, ('first', 1))
+    assert_equals( ('first', 1), third.wait() )
+    assert_equals( ('first', 1), tracker.locate('alpha') )
+
+def test_tracker_patience():
+    """
+    If no source frees up in time, the dispatcher has to do it
+    """
+    tracker = SourceTracker(fanout = 1, patience = 0.01)
+    tracker.locate('alpha')
+    assert_equals( None, tracker.locate('alpha') )
+
+def test_tracker_failed():
+    """
+    Sources which could not be reached should be forgotten
+    """
+    tracker = SourceTracker(fanout = 2)
+    tracker.locate('alpha')
+    tracker.fetched('alpha', None, ('first', 1))
+    tracker.fetched('beta', None, ('first', 1))
+    assert_equals( ('first', 1), tracker.locate('alpha') )
+    tracker.fetched('alpha', ('first', 1), None, failed = True)
+    assert_equals( None, tracker.locate('alpha') )
+    assert_equals( None, tracker.locate('beta') )
+
+def test_fetch_from_peer():
+    """
+    Make sure that configurations can be fetched from another worker's cache
+    """
+    library = ConfigurationLibrary()
+    library.add( configuration_a() )
+    with cache_directory() as directory:
+        cache = ConfigurationCache(library, directory)
+        address = PeerServer(cache, 'secret').listen('localhost')
+
+        config = fetch(address, 'secret', configuration_a().hash)
+        assert_equals( 'A', config.contents )
+        assert_equals( 'A', config.name )
+
+def test_peer_library():
+    """
+    Make sure that the worker goes where the dispatcher sends it, and
+    reports back
+    """
+    library = ConfigurationLibrary()
+    library.add( configuration_a() )
+    with cache_directory() as directory:
+        address = PeerServer( ConfigurationCache(library, directory), 'secret').listen('localhost')
+
+        upstream, client = create_libraries()
+        client.locate = lambda hash: address
+        fetched = []
+        client.fetched = lambda *args: fetched.append(args)
+
+        peers = PeerLibrary(client, 'secret', ('me', 1))
+        assert_equals( 'A', peers.get(configuration_a().hash).contents )
+        assert_equals( [(configuration_a().hash, address, ('me', 1), False)], fetched )
+
+def test_peer_library_failed():
+    """
+    If the peer can't be reached, the configuration comes from the dispatcher
+    """
+    upstream, client = create_libraries()
+    upstream.add( configuration_a() )
+    client.locate = lambda hash: ('localhost', 1)
+    fetched = []
+    client.fetched = lambda *args: fetched.append(args)
+
+    peers = PeerLibrary(client, 'secret')
+    assert_equals( 'A', peers.get(configuration_a().hash).contents )
+    assert_equals( [(configuration_a().hash, ('localhost', 1), None, True)], fetched )
+
+class ForgedLibrary(object):
+    """
+    Hands out a configuration which isn't the one asked for
+    """
+    def get(self, hash):
+        return configuration_b()
+
+def test_peer_library_forged():
+    """
+    A configuration from a peer which doesn't match its hash is ignored
+    """
+    with cache_directory() as directory:
+        address = PeerServer( ConfigurationCache(ForgedLibrary(), directory), 'secret').listen('localhost')
+
+        upstream, client = create_libraries()
+        upstream.add( configuration_a() )
+        client.locate = lambda hash: address
+        fetched = []
+        client.fetched = lambda *args: fetched.append(args)
+
+        peers = PeerLibrary(client, 'secret')
+        assert_equals( 'A', peers.get(configuration_a().hash).contents )
+        assert_equals( [(configuration_a().hash, address, None, True)], fetched )
+
+def test_peer_library_reports_errors():
+    """
+    The fetch is reported even when the dispatcher doesn't have it either
+    """
+    upstream, client = create_libraries()
+    client.locate = lambda hash: None
+    fetched = []
+    client.fetched = lambda *args: fetched.append(args)
+
+    peers = PeerLibrary(client, 'secret', ('me', 1))
+    assert_raises( KeyError, peers.get, configuration_a().hash )
+    assert_equals( [(configuration_a().hash, None, None, False)], fetched )
+
+def test_fetch_timeout():
+    """
+    A peer which never answers should not hang the worker
+    """
+    listener = eventlet.listen( ('localhost', 0) )
+    assert_raises( ConnectionLost, fetch, listener.getsockname(), 'secret',
+            configuration_a().hash, timeout = 0.1 )
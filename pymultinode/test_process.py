@@ -0,0 +1,37 @@
+"""
+Tests for pymultinode.process
+"""
+from .process import serve_worker
+from .dispatcher import Dispatcher
+from .configuration import ConfigurationLibrary
+from .handshake import ConnectionHandler, WebServer, standard_connect
+from .test_dispatcher import DoubleWorker
+from nose.tools import assert_equals
+import eventlet
+
+def start_server(dispatcher, **options):
+    """
+    Serve the dispatcher on a free port, returning the address
+    """
+    listener = eventlet.listen( ('localhost', 0) )
+    handler = ConnectionHandler(dispatcher, ConfigurationLibrary(), 'secret', **options)
+    server = WebServer(None, handler)
+    eventlet.spawn_n( eventlet.wsgi.server, listener, server._request )
+    return listener.getsockname()
+
+def test_serve_worker_reconnects():
+    """
+    A worker whose connection drops should come back by itself, as the
+    same worker
+    """
+    dispatcher = Dispatcher()
+    address = start_server(dispatcher)
+    worker = DoubleWorker()
+    dispatcher_client, library_client = standard_connect(address, 'secret')
+    eventlet.spawn_n( serve_worker, address, 'secret', dispatcher_client, library_client, worker, 1 )
+
+    assert_equals( 'redred', dispatcher.do_task(None, 'red').wait() )
+    dispatcher_client._protocol._abort()
+    assert_equals( 'blueblue', dispatcher.do_task(None, 'blue').wait() )
+    assert_equals( 1, len(dispatcher.data()['workers']) )
+    assert_equals( 2, worker.calls )
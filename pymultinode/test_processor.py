@@ -3,8 +3,10 @@ Tests for the processor
 """
 import eventlet
 import pickle
-from .worker import run_with_capture, evaluate_result
-from .processor import Processor
+from .worker import run_with_capture, evaluate_result, read_result
+from .serialization import as_pieces
+from .processor import Processor, AdaptiveChunkSize
+from .future import Future, as_completed, wait, FIRST_COMPLETED, CancelledError
 from nose.tools import assert_equals, assert_raises
 import math
 from StringIO import StringIO
@@ -15,19 +17,28 @@ def quick_task(task):
     """
     Does the same thing that worker does, but will less overhead
     """
-    input = StringIO(task)
+    input = StringIO( ''.join(str(piece) for piece in as_pieces(task)) )
     output = StringIO()
     run_with_capture(input, output, sys.stderr)
-    return output.getvalue()[4:]
+    return read_result( StringIO(output.getvalue()) )
 
 class FakeDispatcher(object):
     """
     Supports the same interface as the dispatcher, but avoids the
     overhead, and forces the correct configuration_id
     """
-    def do_task(self, configuration_id, task):
+    def do_task(self, configuration_id, task, timeout = None, speculative = False,
+            priority = 0, weight = 1.0, count = 1):
         assert CONFIG_ID == configuration_id
-        return eventlet.spawn( quick_task, task )
+        self.timeout = timeout
+        self.count = count
+        self.speculative = speculative
+        self.priority = priority
+        self.weight = weight
+        future = Future()
+        thread = eventlet.spawn( quick_task, task )
+        thread.link(lambda thread: future.send(thread.wait()))
+        return future
 
 
 def quick_processor():
@@ -83,6 +94,92 @@ def test_imap():
     for idx, element in enumerate(processor.imap(math.log, xrange(1, 200))):
         assert_equals( math.log(idx+1), element)
 
+def test_imap_chunked():
+    """
+    Chunked imap should give the same results in the same order
+    """
+    processor = quick_processor()
+    results = list(processor.imap(math.log, xrange(1, 200), chunksize = 7))
+    assert_equals( [math.log(x) for x in xrange(1, 200)], results)
+
+def test_imap_auto_chunked():
+    """
+    The automatic chunk size should also give the right results
+    """
+    processor = quick_processor()
+    results = list(processor.imap(pow, xrange(500), xrange(500), chunksize = 'auto'))
+    assert_equals( [pow(x, x) for x in xrange(500)], results)
+
+def test_imap_bad_option():
+    """
+    Misspelled options should be complained about
+    """
+    processor = quick_processor()
+    assert_raises(TypeError, processor.imap, math.log, [1], chunksze = 3)
+
+def test_adaptive_chunk_size():
+    """
+    The chunk size grows for quick tasks and shrinks for slow ones
+    """
+    sizer = AdaptiveChunkSize(target = 1.0)
+    sizer.record(1, 0.0)
+    sizer.record(2, 0.0)
+    assert_equals(4, sizer.size)
+    sizer.record(4, 8.0)
+    assert_equals(1, sizer.size)
+
+def test_imap_unordered():
+    """
+    All the results should come out of imap_unordered
+    """
+    processor = quick_processor()
+    results = processor.imap_unordered(math.log, xrange(1, 200))
+    assert_equals( sorted(math.log(x) for x in xrange(1, 200)), sorted(results) )
+
+def test_imap_unordered_chunked():
+    """
+    Chunking should work when the order doesn't matter
+    """
+    processor = quick_processor()
+    results = processor.imap_unordered(math.log, xrange(1, 200), chunksize = 'auto')
+    assert_equals( sorted(math.log(x) for x in xrange(1, 200)), sorted(results) )
+
+class CountingDispatcher(FakeDispatcher):
+    """
+    Keeps track of the largest number of tasks outstanding at once
+    """
+    def __init__(self):
+        self.outstanding = 0
+        self.most = 0
+
+    def do_task(self, configuration_id, task, **options):
+        self.outstanding += 1
+        self.most = max(self.most, self.outstanding)
+        future = FakeDispatcher.do_task(self, configuration_id, task, **options)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        self.outstanding -= 1
+
+def test_max_in_flight():
+    """
+    Make sure we never have more tasks outstanding than we allowed
+    """
+    dispatcher = CountingDispatcher()
+    processor = Processor(CONFIG_ID, dispatcher, max_in_flight = 5)
+    list(processor.imap(math.log, xrange(1, 100)))
+    assert_equals(5, dispatcher.most)
+
+def test_max_in_flight_unordered():
+    """
+    Make sure that imap_unordered keeps to the window it was given
+    """
+    dispatcher = CountingDispatcher()
+    processor = Processor(CONFIG_ID, dispatcher)
+    list(processor.imap_unordered(math.log, xrange(1, 100), max_in_flight = 3))
+    assert_equals(3, dispatcher.most)
+
 def complain():
     """
     Raise an error
@@ -97,6 +194,71 @@ def test_error():
     event = processor.request(complain)
     assert_raises(IndexError, event.wait)
 
+def test_imap_chunked_error():
+    """
+    An error in a chunk should be raised at the right place
+    """
+    processor = quick_processor()
+    results = processor.imap(math.sqrt, [4, 9, -1, 16], chunksize = 4)
+    assert_equals(2, results.next())
+    assert_equals(3, results.next())
+    assert_raises(ValueError, results.next)
+
+def test_submit():
+    """
+    Submit a task and get the result through the future
+    """
+    future = quick_processor().submit(log, 8, base = 2)
+    assert_equals(3, future.result())
+    assert future.done()
+    assert_equals(None, future.exception())
+
+def test_submit_error():
+    """
+    Errors should be available from the future
+    """
+    future = quick_processor().submit(complain)
+    assert isinstance(future.exception(), IndexError)
+    assert_raises(IndexError, future.result)
+
+def test_submit_callback():
+    """
+    Callbacks should get the future once the task is finished
+    """
+    finished = []
+    future = quick_processor().submit(returns_42)
+    future.add_done_callback(finished.append)
+    future.result()
+    assert_equals([future], finished)
+
+def test_submit_cancel():
+    """
+    A cancelled future should refuse to give a result
+    """
+    future = quick_processor().submit(returns_42)
+    assert future.cancel()
+    assert future.cancelled()
+    assert_raises(CancelledError, future.result)
+
+def test_as_completed():
+    """
+    Every submitted future should come out of as_completed
+    """
+    processor = quick_processor()
+    futures = [processor.submit(math.log, x) for x in xrange(1, 20)]
+    finished = list(as_completed(futures))
+    assert_equals( set(futures), set(finished) )
+
+def test_wait_first_completed():
+    """
+    Waiting for the first completed should leave at least one done
+    """
+    processor = quick_processor()
+    futures = [processor.submit(math.log, x) for x in xrange(1, 20)]
+    done, not_done = wait(futures, return_when = FIRST_COMPLETED)
+    assert done
+    assert_equals( set(futures), done | not_done )
+
 def test_repeat():
     """
     Use the repeat function
@@ -104,3 +266,73 @@ def test_repeat():
     processor = quick_processor()
     for element in processor.repeat(100, returns_42):
         assert_equals(element, 42)
+
+def test_timeout_passed_on():
+    """
+    The timeout should make it to the dispatcher, scaled up for chunks
+    """
+    dispatcher = FakeDispatcher()
+    processor = Processor(CONFIG_ID, dispatcher, timeout = 2)
+    processor.submit(returns_42).result()
+    assert_equals(2, dispatcher.timeout)
+    processor.with_options(timeout = 3).submit(returns_42).result()
+    assert_equals(3, dispatcher.timeout)
+    list(processor.imap(math.log, xrange(1, 5), chunksize = 4, timeout = 5))
+    assert_equals(20, dispatcher.timeout)
+    assert_equals(4, dispatcher.count)
+    list(processor.imap_unordered(math.log, xrange(1, 5), timeout = 5))
+    assert_equals(5, dispatcher.timeout)
+
+def test_speculative_option():
+    """
+    Tasks should only be marked speculative when asked for
+    """
+    dispatcher = FakeDispatcher()
+    processor = Processor(CONFIG_ID, dispatcher)
+    processor.submit(returns_42).result()
+    assert not dispatcher.speculative
+    list(processor.imap(math.log, xrange(1, 5), speculative = True))
+    assert dispatcher.speculative
+    processor.with_options(speculative = True).submit(returns_42).result()
+    assert dispatcher.speculative
+    assert_raises(TypeError, processor.with_options, colour = 'red')
+
+def test_priority_options():
+    """
+    The priority and weight should be passed along to the dispatcher
+    """
+    dispatcher = FakeDispatcher()
+    processor = Processor(CONFIG_ID, dispatcher, priority = 2, weight = 0.5)
+    processor.submit(returns_42).result()
+    assert_equals( (2, 0.5), (dispatcher.priority, dispatcher.weight) )
+    list(processor.imap(math.log, xrange(1, 5), priority = -1))
+    assert_equals( (-1, 0.5), (dispatcher.priority, dispatcher.weight) )
+    assert_raises( ValueError, Processor, CONFIG_ID, dispatcher, weight = 0 )
+    assert_raises( ValueError, processor.with_options, weight = -1 )
+
+class CancellingDispatcher(FakeDispatcher):
+    """
+    Keeps track of the futures it handed out
+    """
+    def __init__(self):
+        self.futures = []
+
+    def do_task(self, configuration_id, task, **options):
+        future = FakeDispatcher.do_task(self, configuration_id, task, **options)
+        self.futures.append(future)
+        return future
+
+def test_imap_close_cancels():
+    """
+    Closing an imap iterator early should cancel the outstanding tasks
+    """
+    for method in ('imap', 'imap_unordered'):
+        for chunksize in (1, 2):
+            dispatcher = CancellingDispatcher()
+            processor = Processor(CONFIG_ID, dispatcher, max_in_flight = 5)
+            results = getattr(processor, method)(math.log, xrange(1, 100), chunksize = chunksize)
+            next(results)
+            results.close()
+            assert_equals( 5 + 1, len(dispatcher.futures) )
+            assert any( future.cancelled() for future in dispatcher.futures )
+            assert all( future.done() for future in dispatcher.futures )
@@ -2,12 +2,14 @@
 test for the protocol
 """
 import os
+import mmap
 import eventlet
 from nose.tools import assert_equals, assert_raises
 import socket
 from mock import Mock
 
-from .protocol import Protocol, MESSAGE_HEADER, RequestProtocol, ConnectionLost
+from .protocol import Protocol, MESSAGE_HEADER, RequestProtocol, ConnectionLost, FRAME_SIZE
+from .protocol import CommandCodes, SMALL_MESSAGE
 
 class PipeFile(object):
     def __init__(self):
@@ -17,7 +19,7 @@ class PipeFile(object):
         self._closed = False
 
     def write(self, content):
-        self._waiting += content
+        self._waiting += str(content)
 
     def flush(self):
         self.other._incoming.put(self._waiting)
@@ -69,6 +71,187 @@ def test_simple():
     protocol.send('X', 24, 'alpha')
     assert_equals( ('X', 24, 'alpha'), protocol2.wait() )
 
+class CountingFile(object):
+    """
+    A file which records each write made to it
+    """
+    def __init__(self, error = None):
+        self.writes = []
+        self.error = error
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def test_coalesced():
+    """
+    Messages sent together should be written out in one go
+    """
+    file = CountingFile()
+    protocol = Protocol(file)
+    for sequence in range(10):
+        protocol.send('X', sequence, 'alpha')
+    assert_equals( [], file.writes )
+    eventlet.sleep(0.01)
+    assert_equals( 1, len(file.writes) )
+
+    read, write = create_pipes()
+    write.write( file.writes[0] )
+    write.flush()
+    reader = Protocol(read)
+    for sequence in range(10):
+        assert_equals( ('X', sequence, 'alpha'), reader.wait() )
+
+def test_max_delay():
+    """
+    Messages sent within the delay should be written together
+    """
+    file = CountingFile()
+    protocol = Protocol(file, max_delay = 0.05)
+    protocol.send('X', 1, 'alpha')
+    eventlet.sleep(0.01)
+    protocol.send('X', 2, 'beta')
+    eventlet.sleep(0.1)
+    assert_equals( 1, len(file.writes) )
+
+def test_max_buffer():
+    """
+    Filling up the buffer should write it out without waiting for the delay
+    """
+    file = CountingFile()
+    protocol = Protocol(file, max_delay = 10, max_buffer = 100)
+    protocol.send('X', 1, 'a' * 200)
+    eventlet.sleep(0.01)
+    assert_equals( 1, len(file.writes) )
+
+def test_close_flushes():
+    """
+    Closing should not lose queued messages
+    """
+    file = CountingFile()
+    protocol = Protocol(file, max_delay = 10)
+    protocol.send('X', 1, 'alpha')
+    protocol.close()
+    assert_equals( 1, len(file.writes) )
+
+def test_write_error():
+    """
+    A failed write should be reported by the next send
+    """
+    protocol = Protocol( CountingFile( socket.error() ) )
+    protocol.send('X', 1, 'alpha')
+    eventlet.sleep(0.01)
+    assert_raises(socket.error, protocol.send, 'X', 2, 'beta')
+
+def test_large():
+    """
+    Messages larger than a frame should be split up and put back together
+    """
+    protocol, protocol2 = quick_protocols()
+    data = ''.join(chr(x % 251) for x in xrange(3 * FRAME_SIZE + 17))
+    protocol.send('X', 24, data)
+    command, sequence, received = protocol2.wait()
+    assert_equals( ('X', 24), (command, sequence) )
+    assert isinstance(received, bytearray)
+    assert_equals( data, str(received) )
+
+def test_send_mmap():
+    """
+    Memory mapped data, as handed over by slaves, should be sent as is
+    """
+    protocol, protocol2 = quick_protocols()
+    for size in [100, FRAME_SIZE + 1]:
+        data = mmap.mmap(-1, size)
+        data.write('y' * size)
+        protocol.send('X', 1, data)
+        command, sequence, received = protocol2.wait()
+        assert_equals( 'y' * size, str(received) )
+
+def test_large_pieces_not_joined():
+    """
+    Large pieces should be written as they are rather than being joined
+    into a string with everything else
+    """
+    file = CountingFile()
+    protocol = Protocol(file)
+    data = bytearray('b' * (FRAME_SIZE // 2))
+    protocol.send('X', 1, ['header', data])
+    protocol.flush()
+    assert_equals( [MESSAGE_HEADER.pack('X', 0, 1, len(data) + 6) + 'header', str(data)],
+            [str(written) for written in file.writes] )
+    assert not isinstance(file.writes[1], str)
+
+def test_large_interleaved():
+    """
+    Small messages should not have to wait for a large one to finish
+    """
+    file = CountingFile()
+    protocol = Protocol(file)
+    protocol.send('X', 1, 'a' * (2 * FRAME_SIZE))
+    protocol.send('X', 2, 'small')
+    protocol.flush()
+
+    read, write = create_pipes()
+    write.write( ''.join(str(data) for data in file.writes) )
+    write.flush()
+    reader = Protocol(read)
+    assert_equals( ('X', 2, 'small'), reader.wait() )
+    command, sequence, data = reader.wait()
+    assert_equals( 'a' * (2 * FRAME_SIZE), str(data) )
+
+class StuckFile(CountingFile):
+    """
+    A file whose writes don't go through until it is released
+    """
+    def __init__(self):
+        CountingFile.__init__(self)
+        self.released = eventlet.event.Event()
+
+    def write(self, data):
+        self.released.wait()
+        CountingFile.write(self, data)
+
+def test_small_skips_backpressure():
+    """
+    Small messages should be queued right away even while a large one is
+    holding up the connection, larger ones wait for room
+    """
+    file = StuckFile()
+    protocol = Protocol(file, max_pending = 1000)
+    protocol.send('X', 1, 'a' * 2000)
+    eventlet.sleep(0.01)
+    # the first one is being written, this one fills up the queue
+    protocol.send('X', 2, 'a' * 2000)
+    with eventlet.Timeout(0.05):
+        protocol.send('K', 3, 'cancel')
+    sent = False
+    with eventlet.Timeout(0.05, False):
+        protocol.send('X', 4, 'b' * (SMALL_MESSAGE + 1))
+        sent = True
+    assert not sent
+    file.released.send()
+
+def test_truncated_large():
+    """
+    A large message cut off part way should give us None
+    """
+    file = CountingFile()
+    protocol = Protocol(file)
+    protocol.send('X', 1, 'a' * (2 * FRAME_SIZE))
+    protocol.flush()
+
+    read, write = create_pipes()
+    write.write( ''.join(str(data) for data in file.writes)[:FRAME_SIZE] )
+    write.close()
+    assert_equals( None, Protocol(read).wait() )
+
 def test_empty():
     """
     Make sure that a closed connection gives us None
@@ -83,7 +266,7 @@ def test_truncated():
     Make sure a truncated message gives us None
     """
     read, write = create_pipes()
-    write.write( MESSAGE_HEADER.pack('X', 4, 2) )
+    write.write( MESSAGE_HEADER.pack('X', 0, 4, 2) )
     write.write( '1' )
     write.flush()
     write.close()
@@ -113,6 +296,27 @@ def test_request():
     event = protocol1.request('X', 'monkeys')
     assert_equals( 'banana', event.wait() )
 
+def test_cancel_request():
+    """
+    Cancelling a request should tell the other side, and the late response
+    should be ignored
+    """
+    cancelled = []
+    def callback(command, sequence, data):
+        pass
+    def cancel(command, sequence, data):
+        cancelled.append(sequence)
+        protocol2.respond( sequence, 'banana' )
+    protocol1, protocol2 = quick_request(callback)
+    protocol2.register_handler('Y', cancel)
+    event = protocol1.request('X', 'monkeys', 'Y')
+    event.cancel()
+    eventlet.sleep(0.01)
+    assert_equals( [0], cancelled )
+    # the connection is still fine
+    protocol2.register_handler('X', lambda command, sequence, data: protocol2.respond(sequence, 'apple'))
+    assert_equals( 'apple', protocol1.request('X', 'monkeys').wait() )
+
 
 def test_command():
     """
@@ -158,3 +362,83 @@ def test_ioerror():
     request_protocol = RequestProtocol(protocol)
     assert_raises(ConnectionLost, request_protocol.request, 'X', 'milk')
  
+
+def test_heartbeat_keeps_alive():
+    """
+    Connections sending heartbeats should stay up while idle
+    """
+    protocol1, protocol2 = quick_protocols()
+    protocol1 = RequestProtocol(protocol1, heartbeat_interval = 0.02)
+    protocol2 = RequestProtocol(protocol2, heartbeat_interval = 0.02)
+    protocol2.register_handler('X', lambda command, sequence, data: protocol2.respond(sequence, data))
+    eventlet.sleep(0.2)
+    assert_equals( 'milk', protocol1.request('X', 'milk').wait() )
+    protocol1.close()
+    protocol2.close()
+
+def test_heartbeat_missed():
+    """
+    A connection which has gone quiet should be dropped, failing the
+    requests waiting on it
+    """
+    protocol1, protocol2 = quick_protocols()
+    protocol1 = RequestProtocol(protocol1, heartbeat_interval = 0.02, heartbeat_misses = 3)
+    # the other side says it sends heartbeats, then never sends anything else
+    protocol2.send(CommandCodes.Heartbeat, 0, '')
+    event = protocol1.request('X', 'milk')
+    with eventlet.Timeout(1):
+        assert_raises( ConnectionLost, event.wait )
+    assert_raises( ConnectionLost, protocol1.request, 'X', 'milk' )
+
+def test_no_heartbeats_not_dropped():
+    """
+    A side which never sent a heartbeat shouldn't be dropped for going quiet
+    """
+    protocol1, protocol2 = quick_protocols()
+    protocol1 = RequestProtocol(protocol1, heartbeat_interval = 0.02, heartbeat_misses = 3)
+    protocol2 = RequestProtocol(protocol2)
+    protocol1.register_handler('X', lambda command, sequence, data: protocol1.respond(sequence, data))
+    eventlet.sleep(0.2)
+    assert protocol1.connected()
+    assert_equals( 'milk', protocol2.request('X', 'milk').wait() )
+
+class SlowPipeFile(PipeFile):
+    """
+    A pipe which takes a while to read from, like a slow network link
+    """
+    def read(self, length):
+        eventlet.sleep(0.01)
+        return PipeFile.read(self, length)
+
+def test_heartbeat_large_message():
+    """
+    A large message which takes longer than the heartbeat allows to come
+    in should not get the connection dropped
+    """
+    fast, slow = PipeFile(), SlowPipeFile()
+    fast.other, slow.other = slow, fast
+    sender = Protocol(fast)
+    receiver = RequestProtocol(Protocol(slow), heartbeat_interval = 0.02, heartbeat_misses = 5)
+    received = eventlet.event.Event()
+    receiver.register_handler('X', lambda command, sequence, data: received.send(len(data)))
+    sender.send(CommandCodes.Heartbeat, 0, '')
+    sender.send('X', 1, 'a' * (8 * FRAME_SIZE))
+    with eventlet.Timeout(5):
+        assert_equals( 8 * FRAME_SIZE, received.wait() )
+    assert receiver.connected()
+
+def test_heartbeat_skips_queue():
+    """
+    Heartbeats should neither wait for room nor queue up behind a large
+    message
+    """
+    file = CountingFile()
+    protocol = Protocol(file, max_pending = 100)
+    protocol.send('X', 1, 'a' * (2 * FRAME_SIZE))
+    protocol.send(CommandCodes.Heartbeat, 0, '')
+    protocol.flush()
+    read, write = create_pipes()
+    write.write( ''.join(str(data) for data in file.writes) )
+    write.flush()
+    reader = Protocol(read)
+    assert_equals( (CommandCodes.Heartbeat, 0, ''), reader.wait() )
@@ -1,14 +1,20 @@
 from .test_protocol import quick_request
 from .configuration import ConfigurationLibrary
-from .test_configuration import NullConfiguration
-from .test_dispatcher import DoubleWorker, GiveUpWorker
+from .test_configuration import NullConfiguration, manifest_config
+from .configuration import file_hash
+from .test_dispatcher import DoubleWorker, GiveUpWorker, SleepyWorker
 from .proxy import ConfigurationLibraryServer, ConfigurationLibraryClient
 from .proxy import WorkerServer, WorkerClient
-from .proxy import DispatcherServer, DispatcherClient
+from .proxy import DispatcherServer, DispatcherClient, WorkerSessions
+from .proxy import encode_task, decode_task
 from nose.tools import assert_equals, assert_raises
 from mock import Mock, sentinel
-from .dispatcher import Dispatcher
+from .dispatcher import Dispatcher, TaskStolen
+from .protocol import FRAME_SIZE, ConnectionLost
 import eventlet
+from greenlet import GreenletExit
+from .future import Future
+from .worker import SlaveCrashed
 
 def create_libraries():
     client, server = quick_request()
@@ -23,10 +29,58 @@ def test_library_proxy():
     library, client = create_libraries()
     config = NullConfiguration('alpha')
     client.add(config)
-    eventlet.sleep()
+    eventlet.sleep(0.01)
 
     assert_equals( config.hash, library.get(config.hash).hash )
 
+def test_library_proxy_manifest():
+    """
+    Only the files which changed should be uploaded
+    """
+    library, client = create_libraries()
+    library.add_files = Mock(side_effect = library.add_files)
+
+    first = manifest_config(main = 'x = 1', other = 'y = 2')
+    client.add(first)
+    eventlet.sleep(0.01)
+    assert_equals( first.contents, library.get(first.hash).contents )
+
+    second = manifest_config(main = 'x = 3', other = 'y = 2')
+    client.add(second)
+    eventlet.sleep(0.01)
+    assert_equals( second.contents, library.get(second.hash).contents )
+    assert_equals( [(file_hash('x = 3'), 'x = 3')], library.add_files.call_args[0][0] )
+
+    # nothing at all needs to be sent the second time
+    client.add(second)
+    eventlet.sleep(0.01)
+    assert_equals( 2, library.add_files.call_count )
+
+def test_library_proxy_missing_file():
+    """
+    A manifest naming a file the library doesn't have should fail for the
+    client, and leave the connection working
+    """
+    library, client = create_libraries()
+    config = manifest_config(main = 'x = 1')
+    library.missing_files = Mock(return_value = [])
+    assert_raises( KeyError, client.add, config )
+
+    other = NullConfiguration('alpha')
+    library.add(other)
+    assert_equals( other.hash, client.get(other.hash).hash )
+
+def test_library_proxy_wrong_hash():
+    """
+    A configuration which comes out differently on the other side should
+    fail for the client rather than being kept under another hash
+    """
+    library, client = create_libraries()
+    config = manifest_config(main = 'x = 1')
+    config.hash = file_hash('something else')
+    assert_raises( ValueError, client.add, config )
+    assert_raises( KeyError, library.get, config.hash )
+
 def test_library_proxy_download():
     library, client = create_libraries()
     config = NullConfiguration('alpha')
@@ -35,12 +89,22 @@ def test_library_proxy_download():
 
     assert_equals( config.hash, client.get(config.hash).hash )
 
+def test_library_proxy_unknown():
+    """
+    Asking for a configuration the library doesn't have raises KeyError
+    """
+    library, client = create_libraries()
+    assert_raises( KeyError, client.get, 'nothing' )
+    config = NullConfiguration('alpha')
+    library.add(config)
+    assert_equals( config.hash, client.get(config.hash).hash )
+
 def test_library_proxy_remove():
     library, client = create_libraries()
     config = NullConfiguration('alpha')
     library.add(config)
     client.remove(config.hash)
-    eventlet.sleep()
+    eventlet.sleep(0.01)
     
     assert_raises( KeyError, library.get, config.hash )
 
@@ -53,6 +117,34 @@ def test_worker_proxy():
 
     assert_equals( 'alphaalpha', worker_client.do_task(None, 'alpha') )
 
+def test_worker_proxy_large():
+    """
+    Tasks and results larger than a single frame should make it through
+    """
+    client, server = quick_request()
+    worker_server = WorkerServer(DoubleWorker(), server)
+    worker_client = WorkerClient(client)
+
+    task = 'x' * (FRAME_SIZE + 1)
+    assert_equals( task + task, str(worker_client.do_task(None, task)) )
+
+def test_task_encoding():
+    """
+    The configuration id and task should survive being encoded
+    """
+    encoded = ''.join( encode_task('fred', 'red', {'timeout' : 5}) )
+    assert_equals( ('fred', 'red', {'timeout' : 5}), decode_task(encoded) )
+
+def test_task_encoding_large():
+    """
+    Large tasks should not be copied when decoded
+    """
+    encoded = bytearray( ''.join( encode_task('fred', 'r' * 100) ) )
+    configuration_id, task, options = decode_task(encoded)
+    assert_equals( 'fred', configuration_id )
+    assert isinstance(task, buffer)
+    assert_equals( 'r' * 100, str(task) )
+
 def test_dispatcher_proxy_add_worker():
     client, server = quick_request()
     dispatcher = Mock(Dispatcher)
@@ -60,7 +152,7 @@ def test_dispatcher_proxy_add_worker():
     dispatcher_client = DispatcherClient(client)
 
     dispatcher_client.add_worker(sentinel.worker, 7)
-    eventlet.sleep()
+    eventlet.sleep(0.01)
 
     assert_equals(7, dispatcher.add_worker.call_args[0][-1])
 
@@ -75,13 +167,262 @@ def test_dispatcher_proxy_do_task():
     dispatcher.do_task.return_value = my_event
 
     event = dispatcher_client.do_task('fred', 'red')
-    eventlet.sleep()
+    eventlet.sleep(0.01)
 
-    dispatcher.do_task.assert_called_with('fred', 'red')
+    dispatcher.do_task.assert_called_with('fred', 'red', timeout = None, speculative = False,
+            priority = 0, weight = 1.0, count = 1, client = dispatcher_server._client)
     my_event.send('blue')
 
     assert_equals( 'blue', event.wait() )
 
+def test_dispatcher_proxy_bad_options():
+    """
+    A task the dispatcher refuses should fail for the client without
+    breaking the connection
+    """
+    client, server = quick_request()
+    dispatcher_server = DispatcherServer(Dispatcher(), server)
+    dispatcher_client = DispatcherClient(client)
+
+    assert_raises( ValueError, dispatcher_client.do_task('fred', 'red', weight = 0).wait )
+    dispatcher_server._dispatcher.add_worker(DoubleWorker(), 1)
+    assert_equals( 'redred', dispatcher_client.do_task('fred', 'red').wait() )
+
+
+
+
+
+class CancellableWorker(object):
+    """
+    Implements the worker interface with tasks that never finish on their
+    own, remembering which were cancelled
+    """
+    def __init__(self):
+        self.started = []
+        self.cancelled = []
+
+    def do_task(self, configuration_id, task, timeout = None):
+        self.started.append(task)
+        try:
+            eventlet.sleep(10)
+        except GreenletExit:
+            self.cancelled.append(task)
+            raise
+
+    def warm_configurations(self):
+        return []
+
+def test_worker_proxy_cancel():
+    """
+    Killing the green thread waiting on a remote task should stop the task
+    """
+    client, server = quick_request()
+    worker = CancellableWorker()
+    worker_server = WorkerServer(worker, server)
+    worker_client = WorkerClient(client)
+
+    thread = eventlet.spawn(worker_client.do_task, None, 'alpha')
+    eventlet.sleep(0.01)
+    assert_equals( ['alpha'], worker.started )
+    thread.kill()
+    eventlet.sleep(0.01)
+    assert_equals( ['alpha'], worker.cancelled )
+
+def test_dispatcher_proxy_cancel():
+    """
+    Cancelling a task submitted through the proxy should cancel it in the
+    dispatcher
+    """
+    client, server = quick_request()
+    dispatcher = Mock(Dispatcher)
+    dispatcher_server = DispatcherServer(dispatcher, server)
+    dispatcher_client = DispatcherClient(client)
+
+    my_future = Future()
+    dispatcher.do_task.return_value = my_future
+
+    future = dispatcher_client.do_task('fred', 'red')
+    eventlet.sleep(0.01)
+    future.cancel()
+    eventlet.sleep(0.01)
+    assert my_future.cancelled()
+
+class WarmWorker(DoubleWorker):
+    def warm_configurations(self):
+        return ['alpha']
+
+def test_worker_proxy_warm():
+    """
+    The worker should let the dispatcher know which configurations it has
+    loaded by the time a task is done
+    """
+    client, server = quick_request()
+    WorkerServer(WarmWorker(), server)
+    worker_client = WorkerClient(client)
+    assert_equals( [], worker_client.warm_configurations() )
+    assert_equals( 'betabeta', worker_client.do_task('alpha', 'beta') )
+    assert_equals( ['alpha'], worker_client.warm_configurations() )
+
+class CrashingWorker(object):
+    def do_task(self, configuration_id, task, timeout = None):
+        raise SlaveCrashed('crashed')
+
+    def warm_configurations(self):
+        return []
+
+def test_worker_proxy_crash():
+    """
+    A slave crashing should be reported without dropping the connection
+    """
+    client, server = quick_request()
+    worker_server = WorkerServer(CrashingWorker(), server)
+    worker_client = WorkerClient(client)
+
+    assert_raises( SlaveCrashed, worker_client.do_task, None, 'alpha' )
+    worker_server._worker = DoubleWorker()
+    assert_equals( 'alphaalpha', worker_client.do_task(None, 'alpha') )
+
+class SlowWorker(object):
+    """
+    Doubles tasks after a little while, counting how many it ran
+    """
+    def __init__(self):
+        self.count = 0
+
+    def do_task(self, configuration_id, task, timeout = None):
+        self.count += 1
+        eventlet.sleep(0.05)
+        return task + task
+
+    def warm_configurations(self):
+        return []
+
+def connect_worker(dispatcher, sessions, worker, session):
+    """
+    Connect the worker to the dispatcher through a new pair of protocols
+    """
+    client, server = quick_request()
+    DispatcherServer(dispatcher, server, sessions)
+    return (client, server), DispatcherClient(client).add_worker(worker, 1, session)
+
+def disconnect(protocols):
+    for protocol in protocols:
+        protocol.close()
+
+def test_worker_proxy_resume():
+    """
+    A task which finishes while the worker is disconnected shouldn't need
+    running again once it comes back
+    """
+    dispatcher = Mock(Dispatcher)
+    sessions = WorkerSessions()
+    worker = SlowWorker()
+    protocols, worker_server = connect_worker(dispatcher, sessions, worker, 'session')
+    worker_client = dispatcher.add_worker.call_args[0][0]
+
+    thread = eventlet.spawn(worker_client.do_task, None, 'alpha')
+    eventlet.sleep(0.01)
+    disconnect(protocols)
+    eventlet.sleep(0.1)
+
+    connect_worker(dispatcher, sessions, worker_server, 'session')
+    assert_equals( 'alphaalpha', thread.wait() )
+    assert_equals( 1, worker.count )
+    assert_equals( 1, dispatcher.add_worker.call_count )
+
+def test_worker_proxy_resume_expired():
+    """
+    Tasks fail if the worker takes too long to reconnect, and it comes
+    back as a new worker
+    """
+    dispatcher = Mock(Dispatcher)
+    sessions = WorkerSessions(resume_timeout = 0.05)
+    protocols, worker_server = connect_worker(dispatcher, sessions, SlowWorker(), 'session')
+    worker_client = dispatcher.add_worker.call_args[0][0]
+
+    thread = eventlet.spawn(worker_client.do_task, None, 'alpha')
+    eventlet.sleep(0.01)
+    disconnect(protocols)
+    assert_raises( ConnectionLost, thread.wait )
+
+    connect_worker(dispatcher, sessions, worker_server, 'session')
+    assert_equals( 2, dispatcher.add_worker.call_count )
+    assert not worker_server._unsent
+
+def test_worker_proxy_steal():
+    """
+    Tasks waiting for their turn can be taken back, those already running can't
+    """
+    client, server = quick_request()
+    worker = SlowWorker()
+    worker_server = WorkerServer(worker, server, running = 1)
+    worker_client = WorkerClient(client)
+
+    threads = [eventlet.spawn(worker_client.do_task, None, task) for task in ('alpha', 'beta')]
+    eventlet.sleep(0.01)
+    assert worker_client.steal()
+    assert not worker_client.steal()
+    assert_equals( 'alphaalpha', threads[0].wait() )
+    assert_raises( TaskStolen, threads[1].wait )
+    assert_equals( 1, worker.count )
+
+def test_dispatcher_steals():
+    """
+    An idle worker should take tasks another worker prefetched
+    """
+    dispatcher = Dispatcher()
+    client, server = quick_request()
+    busy = SleepyWorker('busy', 0.1)
+    WorkerServer(busy, server, running = 1)
+    dispatcher.add_worker(WorkerClient(client), 1, prefetch = 2)
+    events = [dispatcher.do_task(None, '') for x in range(3)]
+    eventlet.sleep(0.01)
+
+    dispatcher.add_worker(SleepyWorker('idle', 0.01), 1)
+    results = [event.wait() for event in events]
+    assert 'idle' in results
+    assert_equals( 3, len(results) )
+    assert dispatcher.data()['stolen'] >= 1
+
+def test_idle_worker_expires():
+    """
+    A worker whose connection drops while it has nothing to do should be
+    forgotten once it has had its chance to come back
+    """
+    dispatcher = Dispatcher()
+    sessions = WorkerSessions(resume_timeout = 0.05)
+    protocols, worker_server = connect_worker(dispatcher, sessions, SlowWorker(), 'session')
+    other_protocols, other_server = connect_worker(dispatcher, sessions, SlowWorker(), None)
+    connect_worker(dispatcher, sessions, SlowWorker(), None)
+    assert_equals( 3, len(dispatcher.data()['workers']) )
+
+    # without a session it can't come back, so it goes right away
+    disconnect(other_protocols)
+    disconnect(protocols)
+    eventlet.sleep(0.01)
+    assert_equals( 2, len(dispatcher.data()['workers']) )
+    eventlet.sleep(0.1)
+    assert_equals( 1, len(dispatcher.data()['workers']) )
+    assert_equals( 'alphaalpha', dispatcher.do_task(None, 'alpha').wait() )
 
+def test_disconnected_worker_paused():
+    """
+    A worker which may still come back shouldn't be given new tasks
+    while it is gone, but should be once it is back
+    """
+    dispatcher = Dispatcher()
+    sessions = WorkerSessions(resume_timeout = 10)
+    remote = SleepyWorker('remote', 0.01)
+    protocols, worker_server = connect_worker(dispatcher, sessions, remote, 'session')
+    dispatcher.add_worker(SleepyWorker('local', 0.01), 1)
+    disconnect(protocols)
+    eventlet.sleep(0.01)
 
+    events = [dispatcher.do_task(None, '') for x in range(2)]
+    with eventlet.Timeout(1):
+        assert_equals( ['local', 'local'], [event.wait() for event in events] )
 
+    worker_server._worker = SleepyWorker('remote', 0.05)
+    connect_worker(dispatcher, sessions, worker_server, 'session')
+    events = [dispatcher.do_task(None, '') for x in range(2)]
+    assert 'remote' in [event.wait() for event in events]
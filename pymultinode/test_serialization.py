@@ -0,0 +1,96 @@
+"""
+Tests for pymultinode.serialization
+"""
+from .serialization import dumps, dumps_out_of_band, loads, load
+from .serialization import OUT_OF_BAND_THRESHOLD
+from nose.tools import assert_equals
+from nose import SkipTest
+from StringIO import StringIO
+import pickle
+
+def join(pieces):
+    return ''.join(str(piece) for piece in pieces)
+
+def require_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest('numpy is not available')
+    return numpy
+
+def test_small_is_plain_pickle():
+    """
+    Make sure that without large arrays we just get an ordinary pickle
+    """
+    pieces = dumps_out_of_band([1, 2, 'three'])
+    assert_equals(len(pieces), 1)
+    assert_equals(pickle.loads(pieces[0]), [1, 2, 'three'])
+
+def test_plain_pickle_loads():
+    """
+    Make sure that data pickled the old way can still be loaded
+    """
+    assert_equals(loads( dumps({'a' : 1}) ), {'a' : 1})
+    assert_equals(load( StringIO(pickle.dumps({'a' : 1})) ), {'a' : 1})
+
+def test_bytearray_out_of_band():
+    """
+    Make sure that a large bytearray is not copied into the pickle
+    """
+    data = bytearray('x' * OUT_OF_BAND_THRESHOLD)
+    pieces = dumps_out_of_band( ('label', data, data) )
+    assert len(pieces[1]) < OUT_OF_BAND_THRESHOLD
+    # both references share the single buffer
+    assert_equals(len(pieces), 3)
+
+    label, first, second = loads( join(pieces) )
+    assert_equals(label, 'label')
+    assert_equals(first, data)
+    assert first is second
+
+def test_load_from_file():
+    """
+    Make sure that out of band data can be read directly from a file
+    """
+    data = bytearray('y' * OUT_OF_BAND_THRESHOLD)
+    result = load( StringIO( join(dumps_out_of_band([data, 5])) ) )
+    assert_equals(result, [data, 5])
+
+def test_numpy_out_of_band():
+    """
+    Make sure that numpy arrays come back the same, whatever their layout
+    """
+    numpy = require_numpy()
+    array = numpy.arange(OUT_OF_BAND_THRESHOLD, dtype = 'float64').reshape(256, -1)
+    for original in [array, array.T, array[::2], array.astype('int16')]:
+        pieces = dumps_out_of_band(original)
+        assert len(pieces) > 1
+        result = loads( bytearray( join(pieces) ) )
+        assert_equals(result.dtype, original.dtype)
+        assert_equals(result.shape, original.shape)
+        assert (result == original).all()
+        # arrays should be usable as normal
+        result[0] = 1
+
+def test_numpy_shared_copy():
+    """
+    Make sure that an array which has to be copied to be contiguous is
+    only sent once however often it is referred to
+    """
+    numpy = require_numpy()
+    array = numpy.arange(OUT_OF_BAND_THRESHOLD, dtype = 'float64')[::2]
+    pieces = dumps_out_of_band( [array, array] )
+    assert_equals(len(pieces), 3)
+    first, second = loads( join(pieces) )
+    assert first is second
+    assert (first == array).all()
+
+def test_numpy_small_array():
+    """
+    Make sure that small arrays are pickled as usual
+    """
+    numpy = require_numpy()
+    array = numpy.arange(10)
+    pieces = dumps_out_of_band(array)
+    assert_equals(len(pieces), 1)
+    assert (loads(pieces[0]) == array).all()
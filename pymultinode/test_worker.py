@@ -1,14 +1,23 @@
 """
 Tests for pymultinode.worker
 """
-from .worker import Worker, evaluate_result
+from .worker import Worker, evaluate_result, SHARED_MEMORY_DIRECTORY, FORK_SERVER_AVAILABLE
+from .worker import SlaveCrashed, write_shared
+from .future import TimeoutError
 from .configuration import ConfigurationLibrary, single_file_configuration
 from .test_configuration import NullConfiguration
 import pickle
 from nose.tools import assert_equals, assert_raises
 from nose import SkipTest
+from mock import patch
 import sys
 from StringIO import StringIO
+import mmap
+import glob
+import os
+import signal
+import time
+import eventlet
 
 def return_42():
     """
@@ -193,3 +202,331 @@ def test_configuration_error():
     worker = Worker(library)
     result = worker.do_task(config.hash, pickle.dumps(return_42) )
     assert_raises( IndexError, evaluate_result, result)
+
+def process_id():
+    """
+    Return the process id of the slave
+    """
+    import os
+    return os.getpid()
+
+def two_configuration_worker(max_processes = None):
+    """
+    Returns a worker with the configurations 'first' and 'second'
+    """
+    library = ConfigurationLibrary()
+    library.add( NullConfiguration('first') )
+    library.add( NullConfiguration('second') )
+    return Worker(library, max_processes)
+
+def test_warm_slaves_per_configuration():
+    """
+    Switching between configurations should reuse the slaves for each
+    """
+    worker = two_configuration_worker()
+    first = evaluate_result( worker.do_task('first', pickle.dumps(process_id)) )
+    second = evaluate_result( worker.do_task('second', pickle.dumps(process_id)) )
+    assert first != second
+    assert_equals( first, evaluate_result( worker.do_task('first', pickle.dumps(process_id)) ) )
+    assert_equals( second, evaluate_result( worker.do_task('second', pickle.dumps(process_id)) ) )
+    assert_equals( set(['first', 'second']), set(worker.warm_configurations()) )
+
+def test_evicts_least_recently_used():
+    """
+    When out of room, the slave for the least recently used configuration
+    should be stopped
+    """
+    worker = two_configuration_worker(max_processes = 1)
+    worker.do_task('first', pickle.dumps(return_42))
+    worker.do_task('second', pickle.dumps(return_42))
+    assert_equals( ['second'], worker.warm_configurations() )
+    assert_equals( 1, worker.data()['processes'] )
+    assert_equals( set(['second']), worker.configurations_in_use() )
+
+def test_back_under_limit():
+    """
+    Slaves started while all the others were busy should be stopped once
+    they are done, bringing the worker back under max_processes
+    """
+    worker = two_configuration_worker(max_processes = 1)
+    first = eventlet.spawn(worker.do_task, 'first', pickle.dumps(return_42))
+    second = eventlet.spawn(worker.do_task, 'second', pickle.dumps(return_42))
+    assert_equals( 42, evaluate_result(first.wait()) )
+    assert_equals( 42, evaluate_result(second.wait()) )
+    assert_equals( 1, worker.data()['processes'] )
+    assert_equals( 1, len(worker.warm_configurations()) )
+
+def test_prespawn():
+    """
+    Prespawning should leave idle slaves waiting
+    """
+    import eventlet
+    worker = two_configuration_worker()
+    worker.prespawn('first', 2)
+    while len(worker._idle.get('first', [])) < 2:
+        eventlet.sleep(0.01)
+    assert_equals( 42, evaluate_result( worker.do_task('first', pickle.dumps(return_42)) ) )
+    assert_equals( 2, worker.data()['processes'] )
+
+def large_array():
+    import numpy
+    return numpy.arange(100000)
+
+def test_large_array_result():
+    """
+    Make sure that large arrays make it back from the slave
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest('numpy is not available')
+    assert (quick_task(large_array) == numpy.arange(100000)).all()
+
+def large_string():
+    return 'x' * 100000
+
+def test_shared_memory_result():
+    """
+    Make sure that results can be passed back in shared memory
+    """
+    if SHARED_MEMORY_DIRECTORY is None:
+        raise SkipTest('there is no shared memory directory')
+    library = ConfigurationLibrary()
+    worker = Worker(library, shared_memory_threshold = 1000)
+    library.add( NullConfiguration('nothing') )
+
+    small = worker.do_task('nothing', pickle.dumps(return_42))
+    assert isinstance(small, str)
+    assert_equals(evaluate_result(small), 42)
+
+    large = worker.do_task('nothing', pickle.dumps(large_string))
+    assert isinstance(large, mmap.mmap)
+    assert_equals(evaluate_result(large), large_string())
+    # the segment is gone from the filesystem once it has been mapped
+    assert_equals(glob.glob(os.path.join(SHARED_MEMORY_DIRECTORY, 'pymultinode-*')), [])
+
+def leave_shared():
+    """
+    Write a shared memory file and then hang, as if killed before its
+    result was sent
+    """
+    write_shared(['x' * 1000])
+    time.sleep(10)
+
+def test_shared_memory_killed():
+    """
+    Make sure that a slave killed after writing a shared memory file
+    doesn't leave it behind
+    """
+    if SHARED_MEMORY_DIRECTORY is None:
+        raise SkipTest('there is no shared memory directory')
+    library = ConfigurationLibrary()
+    worker = Worker(library, shared_memory_threshold = 1000)
+    library.add( NullConfiguration('nothing') )
+    assert_raises( TimeoutError, evaluate_result,
+            worker.do_task('nothing', pickle.dumps(leave_shared), timeout = 0.5) )
+    eventlet.sleep(0.2)
+    assert_equals(glob.glob(os.path.join(SHARED_MEMORY_DIRECTORY, 'pymultinode-*')), [])
+
+def test_no_shared_memory():
+    """
+    Without a tmpfs to put them in, large results should come through the
+    pipe rather than a file on disk
+    """
+    library = ConfigurationLibrary()
+    with patch('pymultinode.worker.SHARED_MEMORY_DIRECTORY', None):
+        worker = Worker(library, shared_memory_threshold = 1000)
+    library.add( NullConfiguration('nothing') )
+    large = worker.do_task('nothing', pickle.dumps(large_string))
+    assert not isinstance(large, mmap.mmap)
+    assert_equals(evaluate_result(large), large_string())
+
+def test_shared_memory_array():
+    """
+    Make sure that arrays can be used straight from shared memory
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest('numpy is not available')
+    library = ConfigurationLibrary()
+    worker = Worker(library, shared_memory_threshold = 1000)
+    library.add( NullConfiguration('nothing') )
+    result = evaluate_result( worker.do_task('nothing', pickle.dumps(large_array)) )
+    assert (result == numpy.arange(100000)).all()
+    result[0] = 5
+
+def process_ids():
+    return os.getpid(), os.getppid()
+
+def fork_worker(**options):
+    if not FORK_SERVER_AVAILABLE:
+        raise SkipTest('fork server is not available')
+    library = ConfigurationLibrary()
+    worker = Worker(library, fork_server = True, **options)
+    library.add( NullConfiguration('nothing') )
+    return worker
+
+def test_fork_server():
+    """
+    Make sure that slaves get forked from a single template
+    """
+    worker = fork_worker()
+    threads = [eventlet.spawn(worker.do_task, 'nothing', pickle.dumps(process_ids))
+            for idx in xrange(3)]
+    ids = [evaluate_result(thread.wait()) for thread in threads]
+
+    assert_equals( 3, len(set(pid for pid, parent in ids)) )
+    assert_equals( 1, len(set(parent for pid, parent in ids)) )
+    assert_equals( 1, worker.data()['templates'] )
+    assert_equals( 3, worker.data()['processes'] )
+
+def test_fork_server_code():
+    """
+    Make sure that forked slaves have the configuration applied
+    """
+    if not FORK_SERVER_AVAILABLE:
+        raise SkipTest('fork server is not available')
+    config = single_file_configuration('alfred', 'def calc(): return 8')
+    library = ConfigurationLibrary()
+    library.add(config)
+    worker = Worker(library, fork_server = True)
+    assert_equals( 8, evaluate_result( worker.do_task(config.hash, PICKLED_MAIN_CALC) ) )
+
+def test_fork_server_template_died():
+    """
+    Make sure that a new template is started if the old one goes away
+    """
+    # every slave is replaced after its task, so the next one is forked
+    worker = fork_worker(max_tasks_per_slave = 1)
+    pid, template = evaluate_result( worker.do_task('nothing', pickle.dumps(process_ids)) )
+    os.kill(template, signal.SIGKILL)
+    eventlet.sleep(0.1)
+    pid, new_template = evaluate_result( worker.do_task('nothing', pickle.dumps(process_ids)) )
+    assert new_template != template
+
+def recycling_worker(**options):
+    library = ConfigurationLibrary()
+    library.add( NullConfiguration('nothing') )
+    return Worker(library, **options)
+
+def test_max_tasks_per_slave():
+    """
+    Slaves should be replaced once they have run enough tasks
+    """
+    worker = recycling_worker(max_tasks_per_slave = 2)
+    pids = [evaluate_result( worker.do_task('nothing', pickle.dumps(process_id)) )
+            for idx in xrange(4)]
+    assert_equals( pids[0], pids[1] )
+    assert_equals( pids[2], pids[3] )
+    assert pids[0] != pids[2]
+    assert_equals( 2, worker.data()['recycled'] )
+
+def test_replacement_started_in_background():
+    """
+    The replacement for a recycled slave should be ready before it is needed
+    """
+    worker = recycling_worker(max_tasks_per_slave = 1)
+    first = evaluate_result( worker.do_task('nothing', pickle.dumps(process_id)) )
+    while 'nothing' not in worker._idle:
+        eventlet.sleep(0.01)
+    replacement = worker._idle['nothing'][0].process.pid
+    second = evaluate_result( worker.do_task('nothing', pickle.dumps(process_id)) )
+    assert first != second
+    assert_equals( replacement, second )
+
+def test_max_memory():
+    """
+    Slaves using too much memory should be replaced
+    """
+    if not os.path.exists('/proc/self/statm'):
+        raise SkipTest('memory use is not available')
+    worker = recycling_worker(max_memory = 1)
+    first = evaluate_result( worker.do_task('nothing', pickle.dumps(process_id)) )
+    second = evaluate_result( worker.do_task('nothing', pickle.dumps(process_id)) )
+    assert first != second
+
+def cpu_limit():
+    import resource
+    return resource.getrlimit(resource.RLIMIT_CPU)[0]
+
+def test_limits():
+    """
+    Resource limits should be applied to the slaves
+    """
+    worker = recycling_worker(limits = {'RLIMIT_CPU' : 1000})
+    assert_equals( 1000, evaluate_result( worker.do_task('nothing', pickle.dumps(cpu_limit)) ) )
+
+def test_limits_fork_server():
+    """
+    Resource limits should be applied to forked slaves but not the template
+    """
+    if not FORK_SERVER_AVAILABLE:
+        raise SkipTest('fork server is not available')
+    worker = recycling_worker(limits = {'RLIMIT_CPU' : 1000}, fork_server = True)
+    assert_equals( 1000, evaluate_result( worker.do_task('nothing', pickle.dumps(cpu_limit)) ) )
+
+def sleeps():
+    import time
+    time.sleep(30)
+
+def test_timeout():
+    """
+    A task taking too long should be killed and fail with a TimeoutError
+    """
+    worker = quick_worker()
+    first = evaluate_result( worker.do_task('nothing', pickle.dumps(process_id)) )
+    assert_raises( TimeoutError, evaluate_result,
+            worker.do_task('nothing', pickle.dumps(sleeps), timeout = 0.5) )
+    eventlet.sleep(0.1)
+    assert_raises( OSError, os.kill, first, 0 )
+    assert_equals( 1, worker.data()['timed_out'] )
+    # the slave gets replaced
+    second = evaluate_result( worker.do_task('nothing', pickle.dumps(process_id)) )
+    assert first != second
+
+def test_timeout_fork_server():
+    """
+    Forked slaves should get killed too
+    """
+    worker = fork_worker()
+    first, template = evaluate_result( worker.do_task('nothing', pickle.dumps(process_ids)) )
+    assert_raises( TimeoutError, evaluate_result,
+            worker.do_task('nothing', pickle.dumps(sleeps), timeout = 0.5) )
+    second, template = evaluate_result( worker.do_task('nothing', pickle.dumps(process_ids)) )
+    assert first != second
+
+def test_cancel():
+    """
+    Killing the green thread running a task should kill the slave
+    """
+    worker = quick_worker()
+    first = evaluate_result( worker.do_task('nothing', pickle.dumps(process_id)) )
+    thread = eventlet.spawn(worker.do_task, 'nothing', pickle.dumps(sleeps))
+    eventlet.sleep(0.1)
+    thread.kill()
+    eventlet.sleep(0.1)
+    assert_raises( OSError, os.kill, first, 0 )
+    assert_equals( 1, worker.data()['cancelled'] )
+    assert_equals( 42, evaluate_result( worker.do_task('nothing', pickle.dumps(return_42)) ) )
+
+def segfault():
+    os.kill(os.getpid(), signal.SIGSEGV)
+
+def test_slave_crash():
+    """
+    A slave dying in the middle of a task should raise SlaveCrashed and
+    get replaced
+    """
+    worker = quick_worker()
+    assert_raises( SlaveCrashed, worker.do_task, 'nothing', pickle.dumps(segfault) )
+    assert_equals( 1, worker.data()['crashed'] )
+    assert_equals( 42, evaluate_result( worker.do_task('nothing', pickle.dumps(return_42)) ) )
+
+def test_slave_crash_fork_server():
+    """
+    Forked slaves which crash should be noticed too
+    """
+    worker = fork_worker()
+    assert_raises( SlaveCrashed, worker.do_task, 'nothing', pickle.dumps(segfault) )
+    assert_equals( 42, evaluate_result( worker.do_task('nothing', pickle.dumps(return_42)) ) )
@@ -6,23 +6,105 @@ They work by launching a subprocess and doing it there.
 """
 import pickle
 import sys
-from eventlet.green import subprocess
+import os
+import time
+import mmap
+import tempfile
+import glob
+import collections
+import random
+import signal
+import _multiprocessing
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, which can't use the fork server anyway
+    fcntl = None
+try:
+    import resource
+except ImportError:
+    resource = None
+import eventlet
+import eventlet.semaphore
+from greenlet import GreenletExit
+from eventlet import greenio
+from eventlet.green import subprocess, socket
 import traceback
 from StringIO import StringIO
-from .serialization import dumps, dump
+from .serialization import dumps, dump, dumps_out_of_band, as_pieces
+from .serialization import load, loads, read_exactly, OUT_OF_BAND_THRESHOLD, READ_SIZE
+from .future import TimeoutError
 
 # this constant controls the version of the pickle protocol being used
 PICKLE_PROTOCOL = 2
 
+# results at least this large are a good candidate for shared memory
+SHARED_MEMORY_THRESHOLD = 1024 * 1024
+# slaves which have grown past this are replaced rather than reused
+MAX_SLAVE_MEMORY = 2 * 1024 * 1024 * 1024
+
+def shared_memory_directory():
+    """
+    Return /dev/shm if it is a tmpfs, whose files are never written to
+    disk, otherwise None
+    """
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if fields[1:3] == ['/dev/shm', 'tmpfs']:
+                    return '/dev/shm'
+    except IOError:
+        pass
+    return None
+
+# where shared memory segments are created, without one results always
+# go through the pipe rather than through files on disk
+SHARED_MEMORY_DIRECTORY = shared_memory_directory()
+
 import struct
 
+def capture_error():
+    """
+    Return the exception currently being handled with the original_traceback
+    attached to it
+    """
+    error_type, error_value, error_tb = sys.exc_info()
+    if not hasattr(error_value, 'original_traceback'):
+        error_value.original_traceback = traceback.format_exc()
+    return error_value
+
+class TaskChunk(object):
+    """
+    A TaskChunk applies the same task to a list of argument tuples in one go.
+
+    It is sent over as a single task and so the overhead of getting a task
+    to a slave is only paid once for the whole chunk. Calling it returns
+    the time spent working and a list of (success, value) pairs, one for
+    each argument tuple in order.
+    """
+    def __init__(self, task, arguments):
+        self.task = task
+        self.arguments = arguments
+
+    def __call__(self):
+        start = time.time()
+        outcomes = []
+        for args in self.arguments:
+            try:
+                outcomes.append( (True, self.task(*args)) )
+            except:
+                # one failing element should not lose the rest of the chunk
+                outcomes.append( (False, capture_error()) )
+        return time.time() - start, outcomes
+
 def prepare_pipe(file):
     if sys.platform == 'win32':
         import msvcrt, os
         msvcrt.setmode(file.fileno(), os.O_BINARY)
 
 
-def run_with_capture(input, output, error):
+def run_with_capture(input, output, error, shared_memory_threshold = None):
     """
     This is the entry point for the subprocesses.
 
@@ -46,11 +128,12 @@ def run_with_capture(input, output, error):
 
 
     try:
-        function = pickle.load(input)
+        function = load(input)
         # the actual task itself is in function
         result = function()
         # report everything that happened back to the parent process
-        encode_result(output, True, result, fake_stdout.getvalue(), fake_stderr.getvalue())
+        encode_result(output, True, result, fake_stdout.getvalue(), fake_stderr.getvalue(),
+                shared_memory_threshold)
     except:
         # if somemething goes wrong...
         # first, stop redirecting the output
@@ -59,23 +142,31 @@ def run_with_capture(input, output, error):
         sys.stderr = standard_error
 
         # get the exception, and attach the original_traceback to the message
-        error_type, error_value, error_tb = sys.exc_info()
-        if not hasattr(error_value, 'original_traceback'):
-            error_value.original_traceback = traceback.format_exc()
+        error_value = capture_error()
 
         # report the result back to the parent process
-        encode_result(output, False, error_value, fake_stdout.getvalue(), fake_stderr.getvalue())
+        encode_result(output, False, error_value, fake_stdout.getvalue(), fake_stderr.getvalue(),
+                shared_memory_threshold)
     else:
         sys.stdout = standard_output
         sys.stderr = standard_error
 
-def subtask():
+def subtask(shared_memory_threshold = None, template = False, limits = None):
     """
     This is the entry point for the subprocesses.
 
     It reads the configuration and task from the standard input as pickled
     objects.
     It writes a tuple back to standard output indicating what happened
+
+    Results of at least shared_memory_threshold bytes are passed back in
+    a shared memory segment rather than through the pipe
+
+    If template is True, the process doesn't run tasks itself but forks
+    off slaves which do, see serve_forks
+
+    limits are the resource limits applied to the process running the tasks,
+    see apply_limits
     """
     standard_error = sys.stderr
     standard_output = sys.stdout
@@ -88,6 +179,8 @@ def subtask():
 
     sys.stdout = sys.stderr
     try:
+        if not template:
+            apply_limits(limits)
         # the first thing we should read is the configuration object
         # pymultinode.configuration
         print >> standard_error, "Loading configuration"
@@ -96,129 +189,753 @@ def subtask():
         with configuration.apply():
             standard_output.write('1')
             standard_output.flush()
-            command = ProcessCommandCodes.Task
-
-            while command == ProcessCommandCodes.Task:
-                command = sys.stdin.read(1)
-
-                if command == ProcessCommandCodes.Task:
-                    # the actual task itself is in function
-                    run_with_capture(sys.stdin, standard_output, standard_error)
+            if template:
+                serve_forks(shared_memory_threshold, limits)
+            else:
+                serve_tasks(sys.stdin, standard_output, standard_error,
+                        shared_memory_threshold)
     except:
         standard_output.write('0')
         # get the exception, and attach the original_traceback to the message
-        error_type, error_value, error_tb = sys.exc_info()
-        if not hasattr(error_value, 'original_traceback'):
-            error_value.original_traceback = traceback.format_exc()
+        error_value = capture_error()
 
         # report the result back to the parent process
         encode_result(standard_output, False, error_value)
 
+def serve_tasks(input, output, error, shared_memory_threshold):
+    """
+    Run the tasks sent over input until told to quit
+    """
+    command = ProcessCommandCodes.Task
+
+    while command == ProcessCommandCodes.Task:
+        command = input.read(1)
+
+        if command == ProcessCommandCodes.Task:
+            # the actual task itself is in function
+            run_with_capture(input, output, error, shared_memory_threshold)
+
+def apply_limits(limits):
+    """
+    Set resource limits on this process. limits is a dictionary from the names
+    of limits in the resource module, like 'RLIMIT_AS', to their new value.
+    Limits can only be set where the resource module is available.
+    """
+    if not limits:
+        return
+    if resource is None:
+        print >> sys.stderr, "Resource limits are not supported here"
+        return
+
+    for name, value in limits.items():
+        limit = getattr(resource, name)
+        soft, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit, (value, hard))
+
+def serve_forks(shared_memory_threshold, limits = None):
+    """
+    The main loop of a template process
+
+    Its standard input and output are a unix socket. Each fork request comes
+    with the file descriptors for a new slave's input and output, a slave
+    is forked off with them, and its process id is sent back.
+    Since everything was imported before forking, the slave can start
+    running tasks right away.
+    """
+    # nobody here waits for the slaves, this has them cleaned up
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # the socket may have been left non-blocking by the parent's eventlet
+    flags = fcntl.fcntl(0, fcntl.F_GETFL)
+    fcntl.fcntl(0, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+
+    while os.read(0, 1) == ProcessCommandCodes.Fork:
+        input = _multiprocessing.recvfd(0)
+        output = _multiprocessing.recvfd(0)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                forked_slave(input, output, shared_memory_threshold, limits)
+            finally:
+                os._exit(0)
+        os.close(input)
+        os.close(output)
+        os.write(1, PROCESS_ID.pack(pid))
+
+def forked_slave(input, output, shared_memory_threshold, limits = None):
+    """
+    Run tasks in a slave forked from a template, using the file descriptors
+    input and output to talk to the parent
+    """
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    apply_limits(limits)
+    os.dup2(input, 0)
+    os.dup2(output, 1)
+    os.close(input)
+    os.close(output)
+
+    # slaves shouldn't all produce the same random numbers
+    random.seed()
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+
+    serve_tasks(os.fdopen(0, 'rb'), os.fdopen(1, 'wb'), sys.stderr, shared_memory_threshold)
+
 class ProcessCommandCodes:
     Quit = 'Q'
     Task = 'T'
+    # asks a template for a new slave
+    Fork = 'F'
+
+PROCESS_ID = struct.Struct('!L')
+
+# whether slaves can be forked from templates on this platform
+FORK_SERVER_AVAILABLE = hasattr(_multiprocessing, 'sendfd')
+# how many template processes a worker keeps
+MAX_TEMPLATES = 8
+
+class ResultCodes:
+    # the result follows on the pipe
+    Inline = 'I'
+    # the name of a shared memory file holding the result follows
+    Shared = 'S'
 
 LENGTH = struct.Struct('L')
 
+if hasattr(os, 'sysconf') and 'SC_PAGE_SIZE' in os.sysconf_names:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+else:
+    PAGE_SIZE = 4096
+
+class ConfigurationFailed(Exception):
+    """
+    Raised when a slave could not load its configuration, output holds the
+    encoded error reported by the slave
+    """
+    def __init__(self, output):
+        Exception.__init__(self)
+        self.output = output
+
+class SlaveCrashed(Exception):
+    """
+    Raised when a slave dies in the middle of a task, rather than the task
+    raising an exception
+    """
+
+class Slave(object):
+    """
+    A subprocess which has a particular configuration loaded
+    """
+    def __init__(self, configuration_id, process):
+        self.configuration_id = configuration_id
+        self.process = process
+        # how many tasks the slave has been given
+        self.tasks = 0
+
+    def memory(self):
+        """
+        Return the resident memory of the slave in bytes, or None if that
+        can't be found out on this platform
+        """
+        try:
+            with open('/proc/%d/statm' % self.process.pid) as statm:
+                return int( statm.read().split()[1] ) * PAGE_SIZE
+        except (IOError, IndexError, ValueError):
+            return None
+
+    def run(self, task):
+        """
+        Have the slave run the task, returning the encoded result
+        """
+        self.tasks += 1
+        try:
+            self.process.stdin.write( ProcessCommandCodes.Task )
+            for piece in as_pieces(task):
+                self.process.stdin.write(piece)
+            self.process.stdin.flush()
+            return read_result(self.process.stdout)
+        except (EOFError, IOError):
+            raise SlaveCrashed('slave %d died while running the task' % (self.process.pid,))
+
+    def quit(self):
+        """
+        Ask the slave to exit and wait for it to do so
+        """
+        self.process.stdin.write( ProcessCommandCodes.Quit )
+        self.process.stdin.flush()
+        self.process.wait()
+
+    def kill(self):
+        """
+        Kill the slave without waiting for whatever it is doing to finish,
+        along with any shared memory it left behind for a result nobody
+        will read
+        """
+        try:
+            self.process.kill()
+        except OSError:
+            # it already exited
+            pass
+        self.process.wait()
+        remove_shared(self.process.pid)
+
+class ForkedProcess(object):
+    """
+    Stands in for the Popen object of a slave forked from a template
+    """
+    def __init__(self, pid, stdin, stdout):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+
+    def wait(self):
+        """
+        The slave isn't our child, so wait for it to close its output instead
+        """
+        while self.stdout.read(READ_SIZE):
+            pass
+        self.stdin.close()
+        self.stdout.close()
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+class Template(object):
+    """
+    A process with a particular configuration loaded, which new slaves for
+    that configuration are forked from
+    """
+    def __init__(self, configuration_id, process, control):
+        self.configuration_id = configuration_id
+        self.process = process
+        self._control = control
+        # only one fork may be in progress at once
+        self._lock = eventlet.semaphore.Semaphore()
+
+    def fork(self):
+        """
+        Return a new Slave forked from the template
+        Raises EOFError if the template has gone away
+        """
+        with self._lock:
+            task_read, task_write = os.pipe()
+            result_read, result_write = os.pipe()
+            try:
+                self._control.sendall(ProcessCommandCodes.Fork)
+                _multiprocessing.sendfd(self._control.fileno(), task_read)
+                _multiprocessing.sendfd(self._control.fileno(), result_write)
+                response = ''
+                while len(response) < PROCESS_ID.size:
+                    data = self._control.recv(PROCESS_ID.size - len(response))
+                    if not data:
+                        raise EOFError()
+                    response += data
+            except (socket.error, OSError):
+                os.close(task_write)
+                os.close(result_read)
+                raise EOFError()
+            except:
+                os.close(task_write)
+                os.close(result_read)
+                raise
+            finally:
+                os.close(task_read)
+                os.close(result_write)
+
+        process = ForkedProcess(PROCESS_ID.unpack(response)[0],
+                greenio.GreenPipe(task_write, 'wb'), greenio.GreenPipe(result_read, 'rb'))
+        return Slave(self.configuration_id, process)
+
+    def quit(self):
+        """
+        Ask the template to exit, the slaves forked from it keep going
+        """
+        try:
+            self._control.sendall(ProcessCommandCodes.Quit)
+        except socket.error:
+            pass
+        self._control.close()
+        self.process.wait()
+
+def start_template(configuration_id, configuration, shared_memory_threshold = None, limits = None):
+    """
+    Start a new template process with the configuration loaded
+
+    Raises ConfigurationFailed if it could not load it
+    """
+    program = ('import pymultinode.worker;'
+            'pymultinode.worker.subtask(%r, template = True, limits = %r)') % (
+            shared_memory_threshold, limits)
+
+    if hasattr(sys.stderr, 'fileno'):
+        error = sys.stderr
+    else:
+        error = subprocess.PIPE
+
+    # the template needs a unix socket to be sent file descriptors over
+    control, remote = socket.socketpair()
+    try:
+        # the template must not hold on to our end of the socket, or it
+        # would never see it close
+        process = subprocess.Popen([sys.executable, '-c', program], executable = sys.executable,
+                stdout = remote.fileno(), stdin = remote.fileno(), stderr = error,
+                close_fds = True)
+    finally:
+        remote.close()
+
+    stream = control.makefile('rwb')
+    dump(configuration, stream)
+    stream.flush()
+    response = stream.read(1)
+    if response != '1':
+        print >> sys.stderr, "Template failed to configure"
+        output = read_result(stream)
+        control.close()
+        process.wait()
+        raise ConfigurationFailed(output)
+    return Template(configuration_id, process, control)
+
+def start_slave(configuration_id, configuration, shared_memory_threshold = None, limits = None):
+    """
+    Start a new slave process with the configuration loaded
+
+    Raises ConfigurationFailed if the slave could not load it
+    """
+    # load a python process that import this module and calls subtask
+    program = 'import pymultinode.worker;pymultinode.worker.subtask(%r, limits = %r)' % (
+            shared_memory_threshold, limits)
+
+    # if sys.stderr is a real file, just hook the client stderr to it
+    # else connect it to a pipe which we ignore
+    if hasattr(sys.stderr, 'fileno'):
+        error = sys.stderr
+    else:
+        error = subprocess.PIPE
+
+    process = subprocess.Popen([sys.executable, '-c', program], executable = sys.executable,
+            stdout = subprocess.PIPE, stdin = subprocess.PIPE,
+            stderr = error)
+    prepare_pipe(process.stdin)
+    prepare_pipe(process.stdout)
+
+    # write configuration on the processes stdin
+    dump(configuration, process.stdin)
+    process.stdin.flush()
+    response = process.stdout.read(1)
+    if response == '0':
+        print >> sys.stderr, "Slave failed to configure"
+        output = read_result(process.stdout)
+        process.wait()
+        raise ConfigurationFailed(output)
+    return Slave(configuration_id, process)
+
 class Worker(object):
     """
     The Worker object takes care of handing to task off to a subprocess
+
+    Slaves are kept around after finishing a task, in a warm pool for each
+    configuration, so that the next task for the same configuration can
+    use them without starting a new python interpreter.
+
+    In fork server mode, new slaves are forked from a template process
+    which already has the configuration loaded, rather than each starting
+    from scratch.
     """
-    def __init__(self, library):
+    def __init__(self, library, max_processes = None, shared_memory_threshold = None,
+            fork_server = False, max_tasks_per_slave = None, max_memory = None, limits = None):
         """
         Construct a worker
 
         library should be a ConfigurationLibrary instance, used to obtain the
         configurations
+
+        max_processes limits the number of slaves kept alive. When the limit
+        is reached, idle slaves for the least recently used configuration are
+        stopped to make room. If they are all busy, a slave is started
+        anyway, and slaves are stopped as they finish until the worker is
+        back under the limit. None means no limit.
+
+        Results of at least shared_memory_threshold bytes are handed over
+        by the slaves in shared memory instead of being copied through a
+        pipe. None means results always go through the pipe, as they do
+        where there is no SHARED_MEMORY_DIRECTORY.
+
+        fork_server turns on fork server mode, where the platform supports
+        it. The template processes do not count towards max_processes,
+        but only the MAX_TEMPLATES most recently used are kept.
+
+        Slaves are replaced after running max_tasks_per_slave tasks, or
+        once their resident memory is over max_memory bytes. The
+        replacement is started in the background. None means no limit.
+
+        limits are resource limits for each slave, a dictionary from the
+        names of limits in the resource module to their value, for example
+        {'RLIMIT_AS' : 2 ** 30, 'RLIMIT_CPU' : 3600}
         """
         self._library = library
-        self._processes = []
+        self._max_processes = max_processes
+        if SHARED_MEMORY_DIRECTORY is None:
+            shared_memory_threshold = None
+        self._shared_memory_threshold = shared_memory_threshold
+        self._fork_server = fork_server and FORK_SERVER_AVAILABLE
+        self._max_tasks_per_slave = max_tasks_per_slave
+        self._max_memory = max_memory
+        self._limits = limits
+        # how many slaves have been replaced, and killed for taking too long
+        self._recycled = 0
+        self._timed_out = 0
+        # and how many were killed because their task was cancelled
+        self._cancelled = 0
+        # how many died in the middle of a task
+        self._crashed = 0
+        # templates for each configuration, least recently used first
+        self._templates = collections.OrderedDict()
+        # events for the templates being started
+        self._starting = {}
+        # idle slaves for each configuration_id
+        # ordered from the least to the most recently used configuration
+        self._idle = collections.OrderedDict()
+        # all slaves, including those busy or starting up
+        self._count = 0
+        # and how many of them there are for each configuration
+        self._running = collections.Counter()
 
     def data(self):
         data = {
             'type' : 'local',
-            'processes' : len(self._processes)
+            'processes' : self._count,
+            'configurations' : len(self._idle),
+            'templates' : len(self._templates),
+            'recycled' : self._recycled,
+            'timed_out' : self._timed_out,
+            'cancelled' : self._cancelled,
+            'crashed' : self._crashed
         }
         return data
 
-    def do_task(self, configuration_id, task):
+    def warm_configurations(self):
         """
-        Actual method to do the task
+        Return the configuration ids for which there are idle slaves waiting
+        """
+        return self._idle.keys()
 
-        configuration_id should be the hash of the configuration object
-        task should be a string which is a pickled callable doing the actual
-        job
+    def configurations_in_use(self):
         """
-        if self._processes:
-            current_configuration_id, process = self._processes.pop()
-            if current_configuration_id != configuration_id:
-                process.stdin.write( ProcessCommandCodes.Quit )
-                process.wait()
-                process = None
-        else:
-            process = None
+        Return the configuration ids which have slaves or templates, which
+        may still import from the configuration
+        """
+        return set(self._running) | set(self._templates) | set(self._starting)
 
+    def _forget(self, slave):
+        """
+        Stop counting a slave which is going away
+        """
+        self._count -= 1
+        self._running[slave.configuration_id] -= 1
+        if not self._running[slave.configuration_id]:
+            del self._running[slave.configuration_id]
 
-        if process is None:
-            print "Starting new slave"
+    def _acquire(self, configuration_id):
+        """
+        Obtain a slave for the configuration, starting one if need be
+        """
+        slaves = self._idle.get(configuration_id)
+        if slaves:
+            slave = slaves.pop()
+            if not slaves:
+                del self._idle[configuration_id]
+            return slave
+
+        if self._max_processes is not None:
+            while self._count >= self._max_processes and self._evict():
+                pass
+        return self._start(configuration_id)
+
+    def _release(self, slave):
+        """
+        Put a slave back in the pool, marking its configuration as the most
+        recently used one, then stop idle slaves while there are too many
+        """
+        slaves = self._idle.pop(slave.configuration_id, [])
+        slaves.append(slave)
+        self._idle[slave.configuration_id] = slaves
+        if self._max_processes is not None:
+            while self._count > self._max_processes and self._evict():
+                pass
+
+    def _evict(self):
+        """
+        Stop an idle slave from the least recently used configuration
+        Returns False if there was no idle slave to stop
+        """
+        for configuration_id, slaves in self._idle.items():
+            slave = slaves.pop(0)
+            if not slaves:
+                del self._idle[configuration_id]
+            self._stop(slave)
+            return True
+        return False
+
+    def _start(self, configuration_id):
+        self._count += 1
+        try:
+            if self._fork_server:
+                slave = self._fork(configuration_id)
+            else:
+                configuration = self._library.get(configuration_id)
+                slave = start_slave(configuration_id, configuration,
+                        self._shared_memory_threshold, self._limits)
+        except:
+            self._count -= 1
+            raise
+        self._running[configuration_id] += 1
+        return slave
+
+    def _fork(self, configuration_id):
+        """
+        Fork a new slave from the template for the configuration
+        """
+        template = self._template(configuration_id)
+        try:
+            return template.fork()
+        except EOFError:
+            # the template has died, so start another
+            self._forget_template(template)
+            return self._template(configuration_id).fork()
+
+    def _template(self, configuration_id):
+        """
+        Return the template for the configuration, starting it if need be
+        """
+        if configuration_id in self._starting:
+            return self._starting[configuration_id].wait()
+
+        template = self._templates.pop(configuration_id, None)
+        if template is None:
+            # the template is started in its own green thread, so that it
+            # carries on even if the task which needed it is cancelled
+            event = eventlet.event.Event()
+            self._starting[configuration_id] = event
+            eventlet.spawn_n(self._start_template, configuration_id, event)
+            return event.wait()
+
+        self._templates[configuration_id] = template
+        return template
+
+    def _start_template(self, configuration_id, event):
+        try:
             configuration = self._library.get(configuration_id)
+            template = start_template(configuration_id, configuration,
+                    self._shared_memory_threshold, self._limits)
+        except Exception as error:
+            del self._starting[configuration_id]
+            event.send_exception(error)
+            return
+        del self._starting[configuration_id]
+
+        self._templates[configuration_id] = template
+        while len(self._templates) > MAX_TEMPLATES:
+            oldest_id, oldest = self._templates.popitem(last = False)
+            oldest.quit()
+        event.send(template)
+
+    def _forget_template(self, template):
+        if self._templates.get(template.configuration_id) is template:
+            del self._templates[template.configuration_id]
+        template.quit()
+
+    def _stop(self, slave):
+        self._forget(slave)
+        slave.quit()
+
+    def _worn_out(self, slave):
+        """
+        Return True if the slave should be replaced rather than reused
+        """
+        if self._max_tasks_per_slave is not None and slave.tasks >= self._max_tasks_per_slave:
+            return True
+        if self._max_memory is not None:
+            memory = slave.memory()
+            if memory is not None and memory > self._max_memory:
+                return True
+        return False
+
+    def _replace(self, slave, stop):
+        """
+        Get rid of the slave by calling stop, and start a replacement,
+        both in the background
+        """
+        self._forget(slave)
+        eventlet.spawn_n(stop)
+        if self._max_processes is None or self._count < self._max_processes:
+            eventlet.spawn_n(self._prespawn_one, slave.configuration_id)
 
-            # load a python process that import this module and calls subtask
-            program = 'import pymultinode.worker;pymultinode.worker.subtask()'
+    def prespawn(self, configuration_id, count):
+        """
+        Start slaves for the configuration in the background until there are
+        count idle ones, so that the first tasks do not have to wait for them.
+        Idle slaves will not be evicted to make room for these.
+        """
+        missing = count - len(self._idle.get(configuration_id, []))
+        if self._max_processes is not None:
+            missing = min(missing, self._max_processes - self._count)
+
+        for idx in xrange(missing):
+            eventlet.spawn_n(self._prespawn_one, configuration_id)
+
+    def _prespawn_one(self, configuration_id):
+        try:
+            slave = self._start(configuration_id)
+        except Exception:
+            # whatever went wrong will be reported when a task actually
+            # needs the slave
+            return
+        self._release(slave)
+
+    def do_task(self, configuration_id, task, timeout = None):
+        """
+        Actual method to do the task
 
-            # if sys.stderr is a real file, just hook the client stderr to it
-            # else connect it to a pipe which we ignore
-            if hasattr(sys.stderr, 'fileno'):
-                error = sys.stderr
-            else:
-                error = subprocess.PIPE
-
-            process = subprocess.Popen([sys.executable, '-c', program], executable = sys.executable,
-                    stdout = subprocess.PIPE, stdin = subprocess.PIPE,
-                    stderr = error)
-            prepare_pipe(process.stdin)
-            prepare_pipe(process.stdout)
-
-            # write configuration on the processes stdin
-            print "Sending slave configuration data"
-            dump(configuration, process.stdin)
-            process.stdin.flush()
-            print "Awaiting slave response"
-            response = process.stdout.read(1)
-            if response == '0':
-                print "Slave failed to configure"
-                length = LENGTH.unpack( process.stdout.read(LENGTH.size) )[0]
-                output = process.stdout.read(length)
-                process.wait()
-                return output
-
-
-        print "Submitting slave task"
-        process.stdin.write( ProcessCommandCodes.Task )
-        process.stdin.write(task)
-        process.stdin.flush()
-        print "Waiting for slave response"
-        length = LENGTH.unpack( process.stdout.read(LENGTH.size) )[0]
-        output = process.stdout.read(length)
-
-        self._processes.append( (configuration_id, process) )
-        print "Returning response"
+        configuration_id should be the hash of the configuration object
+        task should be a string which is a pickled callable doing the actual
+        job
+
+        If the task takes more than timeout seconds, the slave is killed
+        and the task fails with a TimeoutError. Killing the green thread
+        running do_task cancels the task, killing the slave as well.
+
+        Raises SlaveCrashed if the slave died running the task
+        """
+        try:
+            slave = self._acquire(configuration_id)
+        except ConfigurationFailed as failure:
+            return failure.output
+
+        output = None
+        try:
+            with eventlet.Timeout(timeout, False):
+                output = slave.run(task)
+        except GreenletExit:
+            print >> sys.stderr, "Killing slave running a cancelled task"
+            self._cancelled += 1
+            self._replace(slave, slave.kill)
+            raise
+        except SlaveCrashed:
+            print >> sys.stderr, "Replacing slave which crashed"
+            self._crashed += 1
+            self._replace(slave, slave.kill)
+            raise
+
+        if output is None:
+            print >> sys.stderr, "Killing slave which timed out"
+            self._timed_out += 1
+            self._replace(slave, slave.kill)
+            error = TimeoutError('task took longer than %s seconds' % (timeout,))
+            return dumps( (False, error, '', ''), PICKLE_PROTOCOL )
+        elif self._worn_out(slave):
+            self._recycled += 1
+            self._replace(slave, slave.quit)
+        else:
+            self._release(slave)
         # the standard output contains the representation of the result
         return output
 
-def encode_result(output, success, value, stdout = '', stderr = ''):
+def encode_result(output, success, value, stdout = '', stderr = '', shared_memory_threshold = None):
     product = (success, value, stdout, stderr)
-    encoded = dumps(product, PICKLE_PROTOCOL)
-    output.write( LENGTH.pack(len(encoded)) )
-    output.write(encoded)
+    # large arrays in the result are written straight from their own memory
+    pieces = dumps_out_of_band(product, PICKLE_PROTOCOL)
+    length = sum(len(piece) for piece in pieces)
+
+    if shared_memory_threshold is not None and length >= shared_memory_threshold:
+        path = write_shared(pieces)
+        output.write(ResultCodes.Shared)
+        output.write( LENGTH.pack(len(path)) )
+        output.write(path)
+    else:
+        output.write(ResultCodes.Inline)
+        output.write( LENGTH.pack(length) )
+        for piece in pieces:
+            output.write(piece)
     output.flush()
 
+def shared_prefix(pid):
+    """
+    Return how the names of the shared memory files of process pid start
+    """
+    return 'pymultinode-%d-' % (pid,)
+
+def write_shared(pieces):
+    """
+    Write the pieces into a new shared memory file, returning its path
+    The reader is responsible for removing it
+    """
+    descriptor, path = tempfile.mkstemp(prefix = shared_prefix(os.getpid()),
+            dir = SHARED_MEMORY_DIRECTORY)
+    try:
+        with os.fdopen(descriptor, 'wb') as segment:
+            for piece in pieces:
+                segment.write(piece)
+    except:
+        os.unlink(path)
+        raise
+    return path
+
+def remove_shared(pid):
+    """
+    Remove the shared memory files written by process pid which are still
+    there, once it is dead and they will never be read
+    """
+    if SHARED_MEMORY_DIRECTORY is None:
+        return
+    for path in glob.glob( os.path.join(SHARED_MEMORY_DIRECTORY, shared_prefix(pid) + '*') ):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def read_shared(path):
+    """
+    Map a file written by write_shared into memory and remove it
+
+    The file is removed as soon as it is open, so that it can't be left
+    behind whatever happens next. The mapping is copy on write, so the
+    result can be used and even modified in place without ever copying
+    all of it.
+    """
+    with open(path, 'rb') as segment:
+        os.unlink(path)
+        return mmap.mmap(segment.fileno(), 0, access = mmap.ACCESS_COPY)
+
+def read_result(input):
+    """
+    Read a result written by encode_result
+    Large results are read into a bytearray or mapped from shared memory,
+    so that arrays in them can use that memory directly
+
+    Raises EOFError if the input ends before the whole result is there
+    """
+    header = input.read(1 + LENGTH.size)
+    if len(header) != 1 + LENGTH.size:
+        raise EOFError()
+    code = header[0]
+    length = LENGTH.unpack(header[1:])[0]
+    if code == ResultCodes.Shared:
+        return read_shared( str(read_exactly(input, length)) )
+    elif length < OUT_OF_BAND_THRESHOLD:
+        data = input.read(length)
+        if len(data) != length:
+            raise EOFError()
+        return data
+    else:
+        return read_exactly(input, length)
+
 def evaluate_result(pickled_result):
     """
     Take the result returned from Worker.do_task and interpret it
     """
     # its a pickled object with four parts
-    code, result, stdout, stderr = pickle.loads(pickled_result)
+    code, result, stdout, stderr = loads(pickled_result)
     # just dump the stderr and stdout
     sys.stderr.write(stderr)
     sys.stdout.write(stdout)